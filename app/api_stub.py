@@ -0,0 +1,320 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import logging
+logger = logging.getLogger('root')
+
+# Local stand-in for the Shazam, Spotify and Apple Music APIs, so that the set pipeline runs without network nor quota.
+# The clients are pointed at it through their base urls (see base_urls()), it also answers when used as SHAZAM_PROXY_URL.
+# Responses are replayed from API_STUB_FIXTURES_DIR/<route>/*.json when there are recorded ones for the route
+# (picked by a hash of the request, so the same request always gets the same response), synthetic otherwise.
+API_STUB_FIXTURES_DIR = os.getenv('API_STUB_FIXTURES_DIR')
+API_STUB_NB_TRACKS = int(os.getenv('API_STUB_NB_TRACKS', 300)) # size of the synthetic catalogue
+API_STUB_NO_MATCH_RATE = float(os.getenv('API_STUB_NO_MATCH_RATE', 0.15)) # share of the recognitions without a match
+
+# Fault injection, to load test the concurrency limits, retries and caches of the API clients.
+# Every decision is a hash of the request and of its attempt number : the same run gets the same faults,
+# whatever the order the concurrent requests arrive in, and a retried request can succeed.
+API_STUB_LATENCY_MS = float(os.getenv('API_STUB_LATENCY_MS', 0))
+API_STUB_JITTER_MS = float(os.getenv('API_STUB_JITTER_MS', 0)) # latency is uniform in latency +/- jitter
+API_STUB_429_RATE = float(os.getenv('API_STUB_429_RATE', 0))
+API_STUB_5XX_RATE = float(os.getenv('API_STUB_5XX_RATE', 0))
+API_STUB_TIMEOUT_RATE = float(os.getenv('API_STUB_TIMEOUT_RATE', 0)) # requests left hanging for API_STUB_TIMEOUT_S, then dropped
+API_STUB_TIMEOUT_S = float(os.getenv('API_STUB_TIMEOUT_S', 60))
+API_STUB_MAX_RPS = float(os.getenv('API_STUB_MAX_RPS', 0)) # per route, 429 above it. 0 : no limit
+API_STUB_RETRY_AFTER_S = int(os.getenv('API_STUB_RETRY_AFTER_S', 1))
+API_STUB_SEED = os.getenv('API_STUB_SEED', '0')
+# Overrides per service or per route, e.g. {"spotify": {"rate_429": 0.2}, "shazam_recognize": {"latency_ms": 800}}
+API_STUB_FAULTS = os.getenv('API_STUB_FAULTS')
+
+ROUTES = ( # method, path, route (also the fixtures sub directory)
+    ('POST', re.compile(r'^/shazam/discovery/v5/.+/tag/'), 'shazam_recognize'),
+    ('GET', re.compile(r'^/shazam/discovery/v5/.+/track/(?P<track_id>\d+)'), 'shazam_about_track'),
+    ('GET', re.compile(r'^/shazam/shazam/v3/.+/track-similarities-id-(?P<track_id>\d+)'), 'shazam_related_tracks'),
+    ('GET', re.compile(r'^/shazam/services/search/'), 'shazam_search'),
+    ('POST', re.compile(r'^/spotify/api/token'), 'spotify_token'),
+    ('GET', re.compile(r'^/spotify/v1/search'), 'spotify_search'),
+    ('GET', re.compile(r'^/apple/v1/catalog/\w+/songs'), 'apple_songs'),
+)
+
+FAULT_KEYS = ('latency_ms', 'jitter_ms', 'rate_429', 'rate_5xx', 'rate_timeout', 'timeout_s', 'max_rps')
+
+GENRES = ('House', 'Techno', 'Deep House', 'Disco', 'Electronic', 'Dance', 'Soul', 'Hip-Hop/Rap', 'Jazz', 'Funk')
+
+
+def stable_hash(value):
+    return int(hashlib.sha1(value if isinstance(value, bytes) else str(value).encode()).hexdigest()[:12], 16)
+
+
+def default_faults():
+    """ The fault profiles from the settings : '*' for every route, overridden by service ('shazam', 'spotify', 'apple') then by route. """
+    faults = {'*': {
+        'latency_ms': API_STUB_LATENCY_MS,
+        'jitter_ms': API_STUB_JITTER_MS,
+        'rate_429': API_STUB_429_RATE,
+        'rate_5xx': API_STUB_5XX_RATE,
+        'rate_timeout': API_STUB_TIMEOUT_RATE,
+        'timeout_s': API_STUB_TIMEOUT_S,
+        'max_rps': API_STUB_MAX_RPS,
+    }}
+    if API_STUB_FAULTS:
+        for name, profile in json.loads(API_STUB_FAULTS).items():
+            faults.setdefault(name, {}).update(profile)
+    return faults
+
+
+def fault_profile(faults, route):
+    return {**faults.get('*', {}), **faults.get(route.split('_')[0], {}), **faults.get(route, {})}
+
+
+def load_fixtures(fixtures_dir):
+    """ route -> list of recorded responses, from <fixtures_dir>/<route>/*.json """
+    fixtures = {}
+    if not fixtures_dir or not os.path.isdir(fixtures_dir):
+        return fixtures
+    for _method, _path, route in ROUTES:
+        route_dir = os.path.join(fixtures_dir, route)
+        if os.path.isdir(route_dir):
+            fixtures[route] = [json.load(open(os.path.join(route_dir, name))) for name in sorted(os.listdir(route_dir)) if name.endswith('.json')]
+    return fixtures
+
+
+def synthetic_shazam_track(i):
+    """ A track of the synthetic catalogue, shaped like the 'track' of a Shazam response (see process_shazam_json). """
+    return {
+        'key': str(900000000 + i),
+        'title': f'Stub Track {i}',
+        'subtitle': f'Stub Artist {i % 97}',
+        'images': {'coverart': f'https://stub.invalid/cover/{i}.jpg'},
+        'genres': {'primary': GENRES[i % len(GENRES)]},
+        'hub': {'actions': [
+            {'type': 'applemusicplay', 'id': str(1500000000 + i)},
+            {'type': 'uri', 'uri': f'https://stub.invalid/preview/{i}.m4a'},
+        ]},
+        'sections': [{'metadata': [{'text': f'Stub Album {i}'}, {'text': f'Stub Label {i % 31}'}, {'text': str(1980 + i % 45)}]}],
+        'releasedate': f'{1 + i % 28:02d}-{1 + i % 12:02d}-{1980 + i % 45}',
+    }
+
+
+def synthetic_response(route, match, query, body):
+    if route == 'shazam_recognize':
+        h = stable_hash(body)
+        if (h % 1000) / 1000 < API_STUB_NO_MATCH_RATE:
+            return {'matches': [], 'tagid': str(h)}
+        return {'matches': [{'id': str(h), 'offset': 0, 'timeskew': 0, 'frequencyskew': 0}], 'track': synthetic_shazam_track(h % API_STUB_NB_TRACKS)}
+
+    if route == 'shazam_about_track':
+        return synthetic_shazam_track(int(match['track_id']) % API_STUB_NB_TRACKS)
+
+    if route == 'shazam_related_tracks':
+        i = int(match['track_id'])
+        return {'tracks': [synthetic_shazam_track((i + n) % API_STUB_NB_TRACKS) for n in range(1, 21)]}
+
+    if route == 'shazam_search':
+        term = query.get('query', query.get('term', ['']))[0]
+        return {'tracks': {'hits': [{'track': synthetic_shazam_track(stable_hash(term) % API_STUB_NB_TRACKS)}]}}
+
+    if route == 'spotify_token':
+        return {'access_token': 'stub-token', 'token_type': 'Bearer', 'expires_in': 3600}
+
+    if route == 'spotify_search':
+        q = query.get('q', [''])[0]
+        i = stable_hash(q) % API_STUB_NB_TRACKS
+        if query.get('type', ['track'])[0] == 'artist':
+            return {'artists': {'total': 1, 'items': [{'id': f'stubartist{i % 97}', 'genres': [GENRES[i % len(GENRES)].lower()], 'popularity': i % 100}]}}
+        return {'tracks': {'total': 1, 'items': [{
+            'id': f'stubtrack{i}',
+            'preview_url': f'https://stub.invalid/spotify/{i}.mp3',
+            'duration_ms': 180000 + i * 1000 % 240000,
+            'album': {'name': f'Stub Album {i}', 'release_date': f'{1980 + i % 45}-01-01', 'images': [{'url': f'https://stub.invalid/spotify/{i}.jpg'}]},
+        }]}}
+
+    if route == 'apple_songs':
+        ids = [song_id for song_id in query.get('ids', [''])[0].split(',') if song_id]
+        return {'data': [{
+            'id': song_id,
+            'attributes': {
+                'playParams': {'id': song_id},
+                'genreNames': [GENRES[stable_hash(song_id) % len(GENRES)], 'Music'],
+                'releaseDate': f'{1980 + stable_hash(song_id) % 45}-01-01',
+                'previews': [{'url': f'https://stub.invalid/apple/{song_id}.m4a'}],
+                'artwork': {'url': f'https://stub.invalid/apple/{song_id}/{{w}}x{{h}}bb.jpg'},
+                'url': f'https://stub.invalid/apple/song/{song_id}',
+                'durationInMillis': 180000 + stable_hash(song_id) % 240000,
+            },
+            'relationships': {'artists': {'data': [{'id': str(stable_hash(song_id) % 97)}]}},
+        } for song_id in ids]}
+
+
+class ApiStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, like the real APIs
+
+    def log_message(self, format, *args):
+        logger.debug(f'api stub: {format % args}')
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def respond(self, method):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        url = urlsplit(self.path) # also the absolute urls of proxied requests
+        stub = self.server.stub
+        if url.path.startswith('/_stub/'):
+            return self.control(method, url.path, body)
+
+        for route_method, path, route in ROUTES:
+            match = path.match(url.path)
+            if route_method == method and match:
+                break
+        else:
+            return self.send_json(404, {'error': f'No stub for {method} {url.path}'})
+
+        fault = stub.inject_fault(route, self.path.encode() + body)
+        if fault == 'timeout':
+            self.close_connection = True # no response at all, the client times out
+            return
+        if fault == 429:
+            return self.send_json(429, {'error': 'Too many requests'}, {'Retry-After': str(API_STUB_RETRY_AFTER_S)})
+        if fault:
+            return self.send_json(fault, {'error': 'Stub server error'})
+
+        recorded = stub.fixtures.get(route)
+        if recorded:
+            payload = recorded[stable_hash(self.path.encode() + body) % len(recorded)]
+        else:
+            payload = synthetic_response(route, match, parse_qs(url.query), body)
+        self.send_json(200, payload)
+
+    def control(self, method, path, body):
+        """ GET /_stub/stats : requests and faults per route. POST /_stub/faults : replaces the fault profiles (same format as API_STUB_FAULTS, plus '*'). """
+        stub = self.server.stub
+        if method == 'GET' and path == '/_stub/stats':
+            return self.send_json(200, stub.stats())
+        if method == 'POST' and path == '/_stub/faults':
+            try:
+                stub.set_faults(json.loads(body or b'{}'))
+            except (ValueError, AttributeError) as e:
+                return self.send_json(400, {'error': f'Invalid fault profiles: {e}'})
+            return self.send_json(200, {'faults': stub.faults})
+        return self.send_json(404, {'error': f'No stub control {method} {path}'})
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class ApiStubServer:
+    """
+    The stub, served from a background thread.
+
+        with ApiStubServer(faults={'spotify': {'rate_429': 0.1}}) as stub:
+            os.environ.update(stub.base_urls())  # before web.lib.av_apis is imported
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, fixtures_dir=API_STUB_FIXTURES_DIR, faults=None):
+        self.fixtures = load_fixtures(fixtures_dir)
+        self.faults = default_faults()
+        self.set_faults(faults or {})
+        self.requests = {} # route -> nb of requests received
+        self.injected = {} # route -> {fault: nb}
+        self.attempts = {} # request hash -> nb of times it was received
+        self.recent = {} # route -> times of the requests of the last second, for max_rps
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), ApiStubHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def base_urls(self):
+        """ The settings pointing the Shazam, Spotify and Apple clients at this stub. """
+        return {
+            'SHAZAM_API_URL': f'{self.url}/shazam',
+            'SPOTIFY_API_URL': f'{self.url}/spotify/v1',
+            'SPOTIFY_ACCOUNTS_URL': f'{self.url}/spotify/api/token',
+            'APPLE_MUSIC_API_URL': f'{self.url}/apple/v1',
+        }
+
+    def set_faults(self, faults):
+        for name, profile in faults.items():
+            unknown = set(profile) - set(FAULT_KEYS)
+            if unknown:
+                raise ValueError(f'unknown fault settings {sorted(unknown)} for {name}')
+            self.faults.setdefault(name, {}).update(profile)
+
+    def inject_fault(self, route, request_key):
+        """
+        Counts the request, waits for its latency and returns the fault to answer with :
+        None, 'timeout', 429 or a 5xx status.
+        """
+        profile = fault_profile(self.faults, route)
+        now = time.monotonic()
+        with self.lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+            attempt = self.attempts[request_key] = self.attempts.get(request_key, 0) + 1
+            recent = [t for t in self.recent.get(route, []) if now - t < 1]
+            over_limit = bool(profile.get('max_rps')) and len(recent) >= profile['max_rps']
+            if not over_limit:
+                recent.append(now)
+            self.recent[route] = recent
+
+        def roll(kind):
+            return stable_hash(f'{API_STUB_SEED}:{kind}:{attempt}:'.encode() + request_key) % 10**6 / 10**6
+
+        latency_ms = profile.get('latency_ms', 0) + profile.get('jitter_ms', 0) * (2 * roll('latency') - 1)
+        if latency_ms > 0:
+            time.sleep(latency_ms / 1000)
+
+        if over_limit or roll('429') < profile.get('rate_429', 0):
+            fault = 429
+        elif roll('timeout') < profile.get('rate_timeout', 0):
+            fault = 'timeout'
+            time.sleep(profile.get('timeout_s', API_STUB_TIMEOUT_S))
+        elif roll('5xx') < profile.get('rate_5xx', 0):
+            fault = (500, 502, 503, 504)[int(roll('status') * 4)]
+        else:
+            return None
+
+        with self.lock:
+            route_faults = self.injected.setdefault(route, {})
+            route_faults[str(fault)] = route_faults.get(str(fault), 0) + 1
+        return fault
+
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'faults': {route: dict(faults) for route, faults in self.injected.items()}}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f'API stub listening on {self.url} ({len(self.fixtures)} recorded routes)')
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
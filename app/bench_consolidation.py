@@ -0,0 +1,202 @@
+"""
+Checks and benchmarks web/lib/consolidation.py against the list of dicts rules it replaced in set_process,
+kept below as the reference (merge_tracks_by_shazam_key, remove_small_unidentified_segments, then count_unique_tracks).
+
+The check runs both on random synthetic sets (seeded, so a failure can be replayed) and compares the songs and the
+unique tracks count. consolidate must also leave its input as it is and give the same result run after run.
+
+    python bench_consolidation.py --check 2000
+    python bench_consolidation.py --segments 10000 --repeat 20
+"""
+import argparse
+import copy
+import os
+import random
+import sys
+import time
+
+from bench_insert_set import BENCH_ENV_DEFAULTS, median
+
+
+def synthetic_segments(rng, nb_segments, segment_length_s=120):
+    """
+    Deduplicated segments of a synthetic set : tracks played a few segments in a row, some found again a bit later,
+    unidentified segments in between, and the fields Shazam sometimes leaves empty.
+    """
+    pool = [f'{rng.randrange(10**8)}' for _ in range(max(2, nb_segments // 3))]
+    segments = []
+    start = 0
+    while len(segments) < nb_segments:
+        if rng.random() < 0.25:
+            key = None
+        elif segments and segments[-1]['key_track_shazam'] and rng.random() < 0.3:
+            key = rng.choice([s['key_track_shazam'] for s in segments[-6:] if s['key_track_shazam']])
+        else:
+            key = rng.choice(pool)
+        duration = rng.choice([segment_length_s, segment_length_s, 2 * segment_length_s, rng.randint(10, 3 * segment_length_s)])
+        segments.append({
+            'start_time': start,
+            'end_time': start + duration,
+            'key_track_shazam': key,
+            'title': f'Title {key}' if key and rng.random() < 0.95 else None,
+            'artist_name': f'Artist {int(key) % 50}' if key and rng.random() < 0.9 else None,
+            'label': f'Label {key}' if key and rng.random() < 0.5 else None,
+            'release_year': '2020' if key and rng.random() < 0.5 else None,
+        })
+        start += duration
+    return segments
+
+
+def merge_tracks_by_shazam_key(tracks, look_ahead):
+    """
+    Merges track records based on their 'key_track_shazam' field, looking ahead within a specified range
+    to find and merge duplicate records. The function updates track records by extending 'end_time' and
+    filling in missing details from duplicate records found within the look-ahead range.
+
+    Args:
+        tracks (list of dict): List of track records, each with 'key_track_shazam' and other metadata.
+        look_ahead (int): Number of subsequent records to check for duplicates based on 'key_track_shazam'.
+
+    Returns:
+        list of dict: List of merged and updated track records.
+    """
+
+    def update_record(current, new):
+        """Update current record with non-empty values from new record, except 'start_time'."""
+        for key, value in new.items():
+            if key != 'start_time' and value and not current.get(key):
+                current[key] = value
+
+    processed_tracks = []
+    i = 0
+
+    while i < len(tracks):
+        current_track = tracks[i]
+        j = i + 1
+
+        while j < len(tracks) and j <= i + look_ahead:
+            if current_track['key_track_shazam'] is not None and tracks[j]['key_track_shazam'] == current_track['key_track_shazam']:
+                current_track['end_time'] = tracks[j]['end_time']
+                update_record(current_track, tracks[j])
+                i = j  # move to the next record after the found duplicate
+            j += 1
+
+        processed_tracks.append(current_track)
+        i += 1
+
+    return processed_tracks
+
+def remove_small_unidentified_segments(tracks, min_duration_s):
+    """
+    Removes small unidentified segments from a list of tracks and adjusts the end time of the previous identified track accordingly.
+
+    Parameters:
+    tracks (list of dict): A list of track dictionaries, where each dictionary represents a track with 'title', 'start_time', and 'end_time' keys.
+    min_duration_s (int or float): The minimum duration in seconds. Unidentified tracks with a duration less than this value will be removed.
+
+    Returns:
+    list of dict: A cleaned list of tracks with small unidentified segments removed and the end times of the previous identified tracks adjusted.
+
+    Example:
+    tracks = [
+        {'title': 'Song 1', 'start_time': 0, 'end_time': 30},
+        {'title': '', 'start_time': 30, 'end_time': 32},  # This will be removed if min_duration_s is > 2
+        {'title': 'Song 2', 'start_time': 32, 'end_time': 60}
+    ]
+    min_duration_s = 3
+    cleaned_tracks = remove_small_unidentified_segments(tracks, min_duration_s)
+    # cleaned_tracks will be:
+    # [
+    #     {'title': 'Song 1', 'start_time': 0, 'end_time': 32},
+    #     {'title': 'Song 2', 'start_time': 32, 'end_time': 60}
+    # ]
+    """
+    
+    cleaned_tracks = []
+
+    for i in range(len(tracks)):
+        current_track = tracks[i]
+
+        # If the current track is unidentified and its duration is less than min_duration_s
+        if (not current_track['title']) and (current_track['end_time'] - current_track['start_time'] < min_duration_s):
+            # Extend the end_time of the previous identified track if there is one
+            if cleaned_tracks:
+                cleaned_tracks[-1]['end_time'] = current_track['end_time']
+        else:
+            cleaned_tracks.append(current_track)
+
+    return cleaned_tracks
+
+
+def count_unique_tracks(tracks_json):
+ 
+    tracks_unique = {}
+    try:
+        for track in tracks_json:
+            if track and 'title' in track and 'artist_name' in track and track['title'] and track['artist_name']:
+                key = track['title'] + track['artist_name']
+                if key not in tracks_unique:
+                    tracks_unique[key] = track
+    except Exception as e:
+        return 0
+      
+    return len(tracks_unique)
+
+
+def reference(segments, look_ahead, min_unidentified_s):
+    songs = merge_tracks_by_shazam_key(copy.deepcopy(segments), look_ahead)
+    songs = remove_small_unidentified_segments(songs, min_unidentified_s)
+    return songs, count_unique_tracks(songs)
+
+
+def check(nb_sets, seed):
+    from web.lib.consolidation import consolidate
+    rng = random.Random(seed)
+    for n in range(nb_sets):
+        segments = synthetic_segments(rng, rng.randint(0, 80))
+        look_ahead = rng.choice([0, 1, 2, 4, 8])
+        min_unidentified_s = rng.choice([0, 60, 90, 300])
+        original = copy.deepcopy(segments)
+
+        result = consolidate(segments, look_ahead, min_unidentified_s)
+        expected = reference(segments, look_ahead, min_unidentified_s)
+        if result != expected or segments != original or consolidate(segments, look_ahead, min_unidentified_s) != result:
+            print(f'Mismatch on set {n} (seed {seed}, look_ahead {look_ahead}, min_unidentified_s {min_unidentified_s})')
+            print(f'segments: {original}\nexpected: {expected}\ngot: {result}')
+            return 1
+    print(f'{nb_sets} sets, same songs as the reference')
+    return 0
+
+
+def bench(nb_segments, repeat, seed):
+    from web.lib.consolidation import consolidate
+    segments = synthetic_segments(random.Random(seed), nb_segments)
+    for name, run in (('reference', lambda: reference(segments, 4, 90)), ('consolidate', lambda: consolidate(segments, 4, 90))):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            songs, nb_unique_tracks = run()
+            timings.append(time.perf_counter() - started)
+        print(f'{name:12} {nb_segments} segments -> {len(songs)} songs ({nb_unique_tracks} unique) : {median(timings) * 1000:.2f} ms median of {repeat}')
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--check', type=int, metavar='SETS', help='compare with the reference on that many random sets')
+    parser.add_argument('--segments', type=int, default=10_000, help='segments of the benchmarked set')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # before anything from web is imported : the settings are read at import time
+    for key, value in BENCH_ENV_DEFAULTS.items():
+        os.environ.setdefault(key, value)
+
+    if args.check:
+        return check(args.check, args.seed)
+    return bench(args.segments, args.repeat, args.seed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
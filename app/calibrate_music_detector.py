@@ -0,0 +1,69 @@
+"""
+Validates NON_MUSIC_THRESHOLD (web/lib/music_detector.py) on recorded segments.
+
+The fixtures are segments of real sets, sorted by hand :
+    <fixtures dir>/music/*      tracks, Shazam should be asked
+    <fixtures dir>/non_music/*  intros, talk, crowd, silence : Shazam answers "Unknown Track"
+
+Every segment is scored once, then for every threshold the report shows the Shazam calls saved (non music skipped)
+and the tracks lost (music skipped). The suggested threshold is the highest one losing at most --max-music-loss.
+
+    python calibrate_music_detector.py --fixtures-dir music_fixtures
+    python calibrate_music_detector.py --fixtures-dir music_fixtures --max-music-loss 0.01
+"""
+import argparse
+import os
+import sys
+
+from bench_insert_set import BENCH_ENV_DEFAULTS
+
+MUSIC_FIXTURES_DIR = os.getenv('MUSIC_FIXTURES_DIR', 'music_fixtures')
+THRESHOLDS = [round(0.05 * i, 2) for i in range(1, 20)]
+
+
+def fixture_scores(fixtures_dir, label):
+    from web.lib.music_detector import audio_features, decode_pcm, music_score
+    directory = os.path.join(fixtures_dir, label)
+    if not os.path.isdir(directory):
+        return []
+    scores = []
+    for name in sorted(os.listdir(directory)):
+        features = audio_features(decode_pcm(os.path.join(directory, name)))
+        scores.append(music_score(features))
+        print(f'{label:10} {scores[-1]:.2f} {features} {name}')
+    return scores
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixtures-dir', default=MUSIC_FIXTURES_DIR)
+    parser.add_argument('--max-music-loss', type=float, default=0, help='share of the music segments that may be skipped')
+    args = parser.parse_args()
+
+    # before anything from web is imported : the settings are read at import time
+    for key, value in BENCH_ENV_DEFAULTS.items():
+        os.environ.setdefault(key, value)
+
+    music = fixture_scores(args.fixtures_dir, 'music')
+    non_music = fixture_scores(args.fixtures_dir, 'non_music')
+    if not music or not non_music:
+        print(f'Both {args.fixtures_dir}/music and {args.fixtures_dir}/non_music must hold segments')
+        return 1
+
+    print(f'\n{"threshold":>9} {"calls saved":>12} {"music lost":>11}')
+    suggested = 0
+    for threshold in THRESHOLDS:
+        saved = sum(score < threshold for score in non_music) / len(non_music)
+        lost = sum(score < threshold for score in music) / len(music)
+        print(f'{threshold:9.2f} {saved:12.1%} {lost:11.1%}')
+        if lost <= args.max_music_loss:
+            suggested = threshold
+
+    from web.lib.music_detector import NON_MUSIC_THRESHOLD
+    print(f'\nSuggested NON_MUSIC_THRESHOLD={suggested} (current {NON_MUSIC_THRESHOLD}), '
+          f'{len(music)} music and {len(non_music)} non music segments')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
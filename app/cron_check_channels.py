@@ -5,14 +5,14 @@ import time
 from web.controller.channel import get_channel_to_check
 from web.controller.set import filter_out_existing_sets
 from web.controller.set_queue import pre_queue_set
-from web import create_app
+from web import create_worker_app
 from boilersaas.utils.db import db
 
 from web.lib.av_apis.youtube import youtube_get_channel_feed_video_ids
 from web.model import SetQueue
 
 def worker_set_queue():
-    app = create_app()
+    app = create_worker_app()
     with app.app_context():
         logger = logging.getLogger('root')
         logger.info('Queue Worker started')  # Log that the worker has started
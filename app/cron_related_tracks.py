@@ -0,0 +1,40 @@
+import logging
+import os
+import time
+from web import create_worker_app
+from web.lib.related_tracks import rebuild_related_tracks_from_sets
+from web.lib.set_similarity import build_set_similarity_index
+from web.lib.change_log import prune_change_log
+
+# How often the co-occurrence related tracks are recomputed. 1 day by default
+RELATED_TRACKS_REBUILD_INTERVAL_S = int(os.getenv('RELATED_TRACKS_REBUILD_INTERVAL_S', 86400))
+
+def worker_related_tracks():
+    app = create_worker_app()
+    with app.app_context():
+        logger = logging.getLogger('root')
+        logger.info('Related tracks Worker started')  # Log that the worker has started
+        while True:
+            start = time.time()
+            result = rebuild_related_tracks_from_sets()
+            if 'error' in result:
+                logger.error(result['error'])
+            else:
+                logger.info(f"{result['message']} in {time.time() - start:.1f}s")
+
+            # full rebuild of the sets like this one index, the publications only update it incrementally
+            try:
+                build_set_similarity_index()
+            except Exception as e:
+                logger.error(f'Error building the set similarity index: {e}')
+
+            result = prune_change_log()
+            if 'error' in result:
+                logger.error(result['error'])
+            else:
+                logger.info(result['message'])
+
+            time.sleep(RELATED_TRACKS_REBUILD_INTERVAL_S)
+
+if __name__ == '__main__':
+    worker_related_tracks()
@@ -0,0 +1,24 @@
+import logging
+import time
+from web.controller.related_tracks_queue import claim_related_tracks_job, process_related_tracks_job
+from web import create_worker_app
+
+def worker_related_tracks_queue():
+    app = create_worker_app()
+    with app.app_context():
+        logger = logging.getLogger('root')
+        logger.info('Related tracks queue Worker started')  # Log that the worker has started
+        while True:
+            job = claim_related_tracks_job()
+
+            if job is None:
+                time.sleep(1)  # jobs are user-triggered, keep the wait short
+                continue
+
+            try:
+                process_related_tracks_job(job)
+            except Exception as e:
+                logger.error(f'Error processing related tracks job {job.id}: {e}')
+
+if __name__ == '__main__':
+    worker_related_tracks_queue()
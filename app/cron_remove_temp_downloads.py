@@ -1,58 +1,34 @@
-import os
 import time
+from web import create_worker_app
 from web.logger import logger
-from datetime import datetime, timedelta
+from boilersaas.utils.db import db
+from web.lib.artifact_store import TEMP_DOWNLOADS_BUDGET_BYTES, TEMP_DOWNLOADS_PATH, evict_artifacts
+from web.lib.query_profiler import prune_query_profiles
 
-# Path to the "temp_downloads" directory relative to the script location
-TEMP_DOWNLOADS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp_downloads")
-
-# Time threshold for removing folders (1 day)
-THRESHOLD = timedelta(days=1)
-
-def get_folder_time(path):
-    """
-    Get the creation or modification time of a folder in a way that works
-    for both macOS and Unix-like systems.
-    """
-    stat = os.stat(path)
-    try:
-        # macOS-specific: use st_birthtime if available
-        return datetime.fromtimestamp(stat.st_birthtime)
-    except AttributeError:
-        # Fallback: use st_mtime (last modification time)
-        return datetime.fromtimestamp(stat.st_mtime)
-
-def remove_old_folders():
-    try:
-        now = datetime.now()
-        for folder_name in os.listdir(TEMP_DOWNLOADS_PATH):
-            folder_path = os.path.join(TEMP_DOWNLOADS_PATH, folder_name)
-
-            # Check if it's a directory
-            if os.path.isdir(folder_path):
-                logger.info(f"Checking folder: {folder_path}")
-                folder_time = get_folder_time(folder_path)
-                time_difference = now - folder_time
-
-                # If the folder is older than the threshold, remove it
-                if time_difference > THRESHOLD:
-                    logger.info(f"Removing folder {folder_path}, last modified/created {time_difference.days} days ago")
-                    try:
-                        # Remove the folder and its contents
-                        for root, dirs, files in os.walk(folder_path, topdown=False):
-                            for name in files:
-                                os.remove(os.path.join(root, name))
-                            for name in dirs:
-                                os.rmdir(os.path.join(root, name))
-                        os.rmdir(folder_path)
-
-                        logger.info(f"Removed folder: {folder_path} (created/modified {time_difference.days} days ago)")
-                    except Exception as e:
-                        logger.error(f"Error removing folder {folder_path}: {e}")
-    except Exception as e:
-        logger.error(f"Error while scanning folders: {e}")
+# The temp downloads are kept for retries, this evicts them : older than a day, or least recently used first
+# once over the budget. Sets being processed are pinned and never evicted (see web/lib/artifact_store.py).
+# The query profiles (see web/lib/query_profiler.py) are pruned along, once an hour.
+QUERY_PROFILES_PRUNE_INTERVAL_S = 3600
 
 if __name__ == "__main__":
+    logger.info(f'Evicting temp downloads from {TEMP_DOWNLOADS_PATH}, budget {TEMP_DOWNLOADS_BUDGET_BYTES / 2**30:.1f} GB')
+    app = create_worker_app()
+    last_prune = 0
     while True:
-        remove_old_folders()
+        try:
+            freed = evict_artifacts()
+            if freed:
+                logger.info(f'Freed {freed / 2**20:.0f} MB of temp downloads')
+        except Exception as e:
+            logger.error(f"Error while evicting temp downloads: {e}")
+        if time.time() - last_prune > QUERY_PROFILES_PRUNE_INTERVAL_S:
+            last_prune = time.time()
+            with app.app_context():
+                try:
+                    deleted = prune_query_profiles()
+                    if deleted:
+                        logger.info(f'Pruned {deleted} query profiles')
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Error while pruning the query profiles: {e}")
         time.sleep(60)  # Wait for 1 minute before checking again
@@ -1,17 +1,19 @@
 import logging
 import time
 from web.controller.set_queue import insert_set_from_queue
-from web import create_app
+from web import create_worker_app
+from web.lib.metrics import push_metrics
 from boilersaas.utils.db import db
 
 def worker_set_queue():
-    app = create_app()
+    app = create_worker_app()
     with app.app_context():
         logger = logging.getLogger('root')
         logger.info('Queue Worker started')  # Log that the worker has started
         once = True
         while once == True:
             result = insert_set_from_queue()
+            push_metrics('set_insert')
             #once = False
             
             if result is None:
@@ -0,0 +1,26 @@
+import logging
+import os
+import time
+from web import create_worker_app
+from web.lib.set_stats import refresh_stale_sets_stats
+
+# Sets are computed on publish, this catches the backfill and the sets whose tracks changed
+SET_STATS_REFRESH_INTERVAL_S = int(os.getenv('SET_STATS_REFRESH_INTERVAL_S', 600))
+
+def worker_set_stats():
+    app = create_worker_app()
+    with app.app_context():
+        logger = logging.getLogger('root')
+        logger.info('Set stats Worker started')  # Log that the worker has started
+        while True:
+            start = time.time()
+            result = refresh_stale_sets_stats()
+            if 'error' in result:
+                logger.error(result['error'])
+            else:
+                logger.info(f"{result['message']} in {time.time() - start:.1f}s")
+
+            time.sleep(SET_STATS_REFRESH_INTERVAL_S)
+
+if __name__ == '__main__':
+    worker_set_stats()
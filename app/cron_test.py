@@ -1,12 +1,12 @@
-import asyncio
 import logging
-from web import create_app
+from web import create_worker_app
+from web.lib.av_apis.http_client import run_async
 from web.lib.track_prompt import add_tracks_from_title_artists
 from boilersaas.utils.db import db
 
 
 def worker_set_queue():
-    app = create_app()
+    app = create_worker_app()
     with app.app_context():
         logger = logging.getLogger('root')
         logger.info('Queue Worker started')  # Log that the worker has started
@@ -22,7 +22,7 @@ def worker_set_queue():
                 "Okay - Shiba San",
             ]
 
-        asyncio.run(add_tracks_from_title_artists(track_titles_artists,db))
+        run_async(add_tracks_from_title_artists(track_titles_artists,db))
         
         # total_time = time.time() - total_start
         # print(f"Total execution time: {total_time:.2f} seconds")
@@ -8,7 +8,10 @@ background_scripts = [
     "python cron_check_channels.py",
     "python cron_remove_temp_downloads.py",
    # "python cron_set_insert.py",
-    "python cron_set_queue.py"
+    "python cron_set_queue.py",
+    "python cron_related_tracks.py",
+    "python cron_related_tracks_queue.py",
+    "python cron_set_stats.py"
 ]
 
 background_processes = [
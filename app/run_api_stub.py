@@ -0,0 +1,53 @@
+"""
+Serves the Shazam / Spotify / Apple Music stub (api_stub.py) in the foreground,
+to load test the API clients without the real services nor their quota.
+
+    python run_api_stub.py --port 8765 --latency-ms 150 --jitter-ms 100 --rate-429 0.05 --rate-5xx 0.02
+
+Then start the app or a worker with the printed settings (base urls, and the stub as SHAZAM_PROXY_URL if wanted).
+Fault profiles can be changed while it runs, e.g. throttle Spotify to 10 requests/s :
+
+    curl -X POST localhost:8765/_stub/faults -d '{"spotify": {"max_rps": 10}}'
+    curl localhost:8765/_stub/stats
+"""
+import argparse
+import json
+import time
+
+from api_stub import ApiStubServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fixtures-dir', help='recorded responses, <dir>/<route>/*.json')
+    parser.add_argument('--latency-ms', type=float)
+    parser.add_argument('--jitter-ms', type=float)
+    parser.add_argument('--rate-429', type=float)
+    parser.add_argument('--rate-5xx', type=float)
+    parser.add_argument('--rate-timeout', type=float)
+    parser.add_argument('--timeout-s', type=float)
+    parser.add_argument('--max-rps', type=float, help='per route')
+    parser.add_argument('--faults', help='per service / route profiles, as json (see API_STUB_FAULTS)')
+    args = parser.parse_args()
+
+    faults = json.loads(args.faults) if args.faults else {}
+    overrides = {key: getattr(args, key) for key in ('latency_ms', 'jitter_ms', 'rate_429', 'rate_5xx', 'rate_timeout', 'timeout_s', 'max_rps') if getattr(args, key) is not None}
+    faults['*'] = {**faults.get('*', {}), **overrides}
+
+    stub = ApiStubServer(args.host, args.port, args.fixtures_dir, faults)
+    with stub:
+        for name, value in {**stub.base_urls(), 'SHAZAM_PROXY_URL': stub.url}.items():
+            print(f'{name}={value}')
+        print(f'faults: {json.dumps(stub.faults)}')
+        try:
+            while True:
+                time.sleep(60)
+                print(f'stats: {json.dumps(stub.stats())}')
+        except KeyboardInterrupt:
+            print(f'stats: {json.dumps(stub.stats())}')
+
+
+if __name__ == '__main__':
+    main()
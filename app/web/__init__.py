@@ -1,31 +1,31 @@
+import time
+STARTED_AT = time.perf_counter() # first import of the web package, for the startup time (see log_startup)
+
 import logging
+import os
+import sys
 import traceback
 from flask import Flask, render_template
 from config import Config
 from sqlalchemy.exc import OperationalError
 from werkzeug.middleware.proxy_fix import ProxyFix # allows https to be detected by flask on Digital Ocean (reverse proxy)
 
-# important to import before. templates takes precedence
-#from web.init import init_app as init_extend_app 
-from boilersaas import init_boilerplate_app
-
-
-
 from boilersaas.utils.db import db
 #from app.utils.mail import mail
-from flask_migrate import Migrate
 
 
 from flask import Blueprint
-from flask_babel import Babel
-from boilersaas.utils.locale import get_locale,add_babel_translation_directory
 
-from web.inject_globals import inject_globals
 from web.lib.log_config import setup_logging
+from web.lib.metrics import init_metrics, observe_startup
+from web.lib.query_profiler import init_query_profiler
+from web.lib.spans import current_rss_mb
+
+# The tables have no migrations : the web app creates the missing ones on startup. Set to 0 where the schema is managed elsewhere.
+DB_CREATE_ALL = os.getenv('DB_CREATE_ALL', '1') == '1'
 
 
 bp = Blueprint('main', __name__,template_folder='templates')
-from web.routes import basic_bp, set_bp, spotify_bp,admin_bp,channel_bp,track_bp #,playlist_bp
 
 def set_global_exception_handler(app):
     @app.errorhandler(Exception)
@@ -48,6 +48,11 @@ def set_global_exception_handler(app):
         return render_template('error.html', error_message=error_message,traceback_formated=traceback_formated), 500
 
 def init_extend_app(app):
+    # routes (and the controllers and API SDKs they import) are only loaded by the web app, not by the workers
+    from flask_babel import Babel
+    from boilersaas.utils.locale import get_locale,add_babel_translation_directory
+    from web.routes import basic_bp, set_bp, spotify_bp,admin_bp,channel_bp,track_bp #,playlist_bp
+
     app.register_blueprint(basic_bp)
     app.register_blueprint(set_bp)
     app.register_blueprint(spotify_bp)
@@ -55,6 +60,8 @@ def init_extend_app(app):
     app.register_blueprint(admin_bp)
     app.register_blueprint(channel_bp)
     app.register_blueprint(track_bp)
+    init_metrics(app)
+    init_query_profiler(app)
     add_babel_translation_directory('translations',app)
     babel = Babel(app)
     babel.init_app(app,locale_selector=get_locale) 
@@ -70,7 +77,11 @@ def create_app(config_class=Config):
     Returns:
         app: A configured Flask application instance.
     """
-    from flask import Flask
+    # important to import before. templates takes precedence
+    #from web.init import init_app as init_extend_app 
+    from boilersaas import init_boilerplate_app
+    from flask_migrate import Migrate
+    from web.inject_globals import inject_globals
 
     try:
         print("Starting app creation...")
@@ -186,14 +197,46 @@ def create_app(config_class=Config):
     #from app.users.models import User, Invite
     
     migrate = Migrate(app, db,directory='../init_ressources/migrations')
-    with app.app_context():
-        print("Creating database tables...")
-        try:
-            db.create_all()
-            print("Database tables created successfully.")
-        except OperationalError as e:
-            print(f"Database connection failed: {e}")
+    if DB_CREATE_ALL:
+        with app.app_context():
+            print("Creating database tables...")
+            try:
+                db.create_all()
+                print("Database tables created successfully.")
+            except OperationalError as e:
+                print(f"Database connection failed: {e}")
 
 
     print("App creation complete.")
+    log_startup('web')
+    return app
+
+
+def create_worker_app(config_class=Config):
+    """
+    Lightweight application for the cron workers : config, logging and the database only.
+    No blueprints, templates nor schema creation, and the API SDKs are only imported by the code that uses them.
+
+    Args:
+        config_class: The configuration class to use for the app settings.
+
+    Returns:
+        app: A Flask application instance, to run the worker in its app context.
+    """
+    setup_logging()
+    app = Flask(__name__)
+    app.config.from_object(config_class)
+    db.init_app(app)
+    with app.app_context():
+        from boilersaas import models # the users table, referenced by the foreign keys of web.model
+    log_startup('worker')
     return app
+
+
+def log_startup(kind):
+    """ Logs and exports how long the process took to get an app, its memory and the number of modules loaded. """
+    seconds = time.perf_counter() - STARTED_AT
+    rss_mb = current_rss_mb()
+    observe_startup(kind, seconds, rss_mb, len(sys.modules))
+    logging.getLogger('root').info(f'{kind} app ready in {seconds:.2f}s ({rss_mb:.0f} MB, {len(sys.modules)} modules). '
+                                   'Run with PYTHONPROFILEIMPORTTIME=1 for the time spent importing every module.')
@@ -3,4 +3,5 @@ from .track import *
 from .channel import *
 from .set import *
 from .set_process import *
-from .set_queue import *
\ No newline at end of file
+from .set_queue import *
+from .related_tracks_queue import *
@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.exc import IntegrityError
+from boilersaas.utils.db import db
+from web.lib.related_tracks import save_related_tracks
+from web.model import RelatedTracksQueue, Track
+from web.logger import logger
+
+# A job stuck in 'processing' for longer than this (worker killed...) is put back in the queue
+RELATED_TRACKS_JOB_TIMEOUT = timedelta(minutes=10)
+
+
+def get_related_tracks_job(job_id):
+    return RelatedTracksQueue.query.get(job_id)
+
+
+def queue_related_tracks(track_id, user_id=None):
+    """
+    Queues a related tracks fetch for a track and returns the job.
+    Concurrent requests for the same track all get the same job : a pending or processing job is returned as is,
+    a finished one is only put back in the queue if it failed.
+    """
+    job = RelatedTracksQueue.query.filter_by(track_id=track_id).first()
+
+    if job is None:
+        job = RelatedTracksQueue(track_id=track_id, user_id=user_id, status='pending', queued_at=datetime.now(timezone.utc))
+        db.session.add(job)
+        try:
+            db.session.commit()
+            return job
+        except IntegrityError:
+            # another request queued the same track in the meantime
+            db.session.rollback()
+            return RelatedTracksQueue.query.filter_by(track_id=track_id).first()
+
+    if job.status == 'failed':
+        job.status = 'pending'
+        job.error = None
+        job.queued_at = datetime.now(timezone.utc)
+        db.session.commit()
+
+    return job
+
+
+def claim_related_tracks_job():
+    """ Takes the oldest pending job and marks it as processing. Safe with several workers. """
+    try:
+        stuck_before = datetime.now(timezone.utc) - RELATED_TRACKS_JOB_TIMEOUT
+        RelatedTracksQueue.query.filter(
+            RelatedTracksQueue.status == 'processing',
+            RelatedTracksQueue.updated_at < stuck_before
+        ).update({'status': 'pending'}, synchronize_session=False)
+
+        job = RelatedTracksQueue.query.filter_by(status='pending') \
+            .order_by(RelatedTracksQueue.queued_at.asc()) \
+            .with_for_update(skip_locked=True) \
+            .first()
+        if job is None:
+            db.session.commit()
+            return None
+
+        job.status = 'processing'
+        job.n_attempts += 1
+        job.updated_at = datetime.now(timezone.utc)
+        db.session.commit()
+        return job
+    except Exception as e:
+        logger.error(f'Error claiming related tracks job : {e}')
+        db.session.rollback()
+        return None
+
+
+def process_related_tracks_job(job):
+    track = Track.query.get(job.track_id)
+
+    if track is None:
+        job.status = 'failed'
+        job.error = 'Track does not exist in our papers.'
+    elif track.has_related_tracks():
+        job.status = 'done'
+    else:
+        ret = save_related_tracks(track)
+        if 'error' in ret:
+            job.status = 'failed'
+            job.error = ret['error']
+        else:
+            job.status = 'done'
+            job.error = None
+
+    job.updated_at = datetime.now(timezone.utc)
+    db.session.commit()
+    logger.info(f'Related tracks job {job.id} for track {job.track_id} : {job.status} {job.error or ""}')
+    return job
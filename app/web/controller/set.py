@@ -11,6 +11,8 @@ from web.logger import logger
 from web.controller.utils import sanitize_query
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import joinedload
+from web.lib.set_similarity import get_set_similarity_index
+from web.lib.set_stats import get_set_stats
 
 def get_set_id_by_video_id(video_id):
     set_record = Set.query.filter_by(video_id=video_id).first()
@@ -468,36 +470,29 @@ def get_set_with_tracks(set_id):
     return set_details
   
   
+def get_similar_sets(set_id, k=10):
+    """
+    Returns the k published sets most similar to set_id (shared tracks, genres and artist popularity), best first.
+    Each set gets a `similarity` attribute, between 0 and 1.
+    """
+    similar = get_set_similarity_index().similar(set_id, k)
+    if not similar:
+        return []
+
+    sets_by_id = {s.id: s for s in Set.query.filter(Set.id.in_([set_id for set_id, _ in similar]), Set.hidden == False).all()}
+    sets = []
+    for similar_set_id, similarity in similar:
+        set_instance = sets_by_id.get(similar_set_id)
+        if set_instance:
+            set_instance.similarity = similarity
+            sets.append(set_instance)
+    return sets
+
+
 def get_set_genres_by_occurrence(set_id):
-    # Query to get the count of each genre
-    genres_count = (
-        db.session.query(
-            Genre.name, 
-            func.count(TrackGenres.genre_id).label('genre_count')
-        )
-        .join(TrackGenres, Genre.id == TrackGenres.genre_id)
-        .join(Track, Track.id == TrackGenres.track_id)
-        .join(TrackSet, Track.id == TrackSet.track_id)
-        .filter(TrackSet.set_id == set_id)
-        .group_by(Genre.name)
-        .having(func.count(TrackGenres.genre_id) > 0)
-        .order_by(func.count(TrackGenres.genre_id).desc())
-        .all()
-    )
-    
-    # Calculate the total count of all genres
-    total_count = sum([genre.genre_count for genre in genres_count])
-    
-    # Calculate the percentage for each genre
-    genres_percentage = [
-        {
-            'name': genre.name,
-            'percentage': int( (genre.genre_count / total_count) * 100)
-        }
-        for genre in genres_count
-    ]
-    
-    return genres_percentage
+    """ [{'name': ..., 'percentage': ...}] by occurrence in the set, from the materialized SetStats. """
+    set_stats = get_set_stats(set_id)
+    return set_stats.genres if set_stats else []
 
 
 def get_all_featured_set_searches():
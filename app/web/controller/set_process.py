@@ -1,115 +1,222 @@
 
 
 
+import math
 import os
 import shutil
 import traceback
 from web.controller.set import validate_set_data
 from web.controller.utils import error_out
 import json
-from web.lib.count_unique_tracks import count_unique_tracks
-from web.lib.audio import cut_audio
+from web.lib.consolidation import consolidate, place_track_starts
+from web.lib.music_detector import NON_MUSIC_THRESHOLD
+from web.lib.audio import cut_audio, export_ranges, segment_ranges
 from web.lib.av_apis.apple import add_apple_track_data_from_json
-from web.lib.av_apis.shazam import sync_process_segments
+from web.lib.av_apis.shazam import SegmentRecognizer, sync_process_segments
 from web.lib.av_apis.spotify import add_tracks_spotify_data_from_json
-from web.lib.av_apis.youtube import download_youtube_video
+from web.lib.av_apis.youtube import FULL_AUDIO_NAME, extraction_is_valid, stream_youtube_audio, youtube_audio_source
 from web.lib.format import prepare_track_for_insertion
-from web.lib.process_shazam_json import write_deduplicated_segments, write_segments_from_chapter
+from web.lib.process_shazam_json import SEGMENT_RESULTS_FILE, TRACKLIST_RESULTS_FILE, latest_segment_results, segment_track_data, write_deduplicated_segments, write_segments_from_chapter
+from web.lib.tracklist import chapters_timeline, description_timeline
 from web.lib.utils import calculate_avg_properties
+from web.lib.set_similarity import update_set_similarity_index
+from web.lib.set_stats import refresh_sets_stats
+from web.lib.spans import count, span, trace_stages
+from web.lib.artifact_store import TEMP_DOWNLOADS_PATH, atomic_write_json, pinned
+from web.lib.metrics import observe_set_process
 from web.controller.channel import get_or_create_channel
-from web.model import RelatedTracks, Set, Track, TrackSet
+from web.model import RelatedTracks, Set, SetIdentification, SetProcessSpan, SetSegmentClassification, Track, TrackSet, YoutubeExtraction
 from datetime import datetime,timezone
 from boilersaas.utils.db import db
 from web.logger import logger
 from sqlalchemy.exc import SQLAlchemyError
 
 AUDIO_SEGMENTS_LENGTH = int(os.getenv('AUDIO_SEGMENTS_LENGTH'))#
+SET_MIN_DURATION_S = 900
+SET_MAX_DURATION_S = 14400
+SET_MIN_UNIQUE_TRACKS = 5
+# Segments spread over the set, recognized before it is downloaded, to discard the sets too poor in tracks early. 0 to disable
+SAMPLE_SEGMENTS = int(os.getenv('SAMPLE_SEGMENTS', 8))
+# Segments recognized before the download can be stopped for a set too poor in tracks
+EARLY_ABORT_MIN_SEGMENTS = int(os.getenv('EARLY_ABORT_MIN_SEGMENTS', 10))
+AVG_TRACK_LENGTH_S = int(os.getenv('AVG_TRACK_LENGTH_S', 240)) # to estimate the tracks of a set without chapters
+# Share of the chapters / tracklist lines that must be resolved from their titles for the set to skip the download
+# (the rest is fetched by range)
+TRACKLIST_MIN_RESOLVED = float(os.getenv('TRACKLIST_MIN_RESOLVED', 0.5))
+# Error of a set whose segments mostly failed to be recognized (Shazam or proxy down) : the set is queued again, not discarded
+SHAZAM_UNAVAILABLE = 'Shazam unavailable'
 
 
-def merge_tracks_by_shazam_key(tracks, look_ahead):
-    """
-    Merges track records based on their 'key_track_shazam' field, looking ahead within a specified range
-    to find and merge duplicate records. The function updates track records by extending 'end_time' and
-    filling in missing details from duplicate records found within the look-ahead range.
+dl_dir = TEMP_DOWNLOADS_PATH
 
-    Args:
-        tracks (list of dict): List of track records, each with 'key_track_shazam' and other metadata.
-        look_ahead (int): Number of subsequent records to check for duplicates based on 'key_track_shazam'.
 
-    Returns:
-        list of dict: List of merged and updated track records.
+def duration_error(duration_s):
+    if duration_s < SET_MIN_DURATION_S:
+        return f'Set too short ({duration_s}s). Min {SET_MIN_DURATION_S}s'
+    if duration_s > SET_MAX_DURATION_S:
+        return f'Set too long ({duration_s}s). Max {SET_MAX_DURATION_S}s'
+    return None
+
+
+def sample_segments(expected_segments, nb_samples=SAMPLE_SEGMENTS):
+    """ Indexes of nb_samples segments spread over the set, none if the set is too short for sampling to save anything. """
+    if not nb_samples or expected_segments < 2 * nb_samples:
+        return []
+    return sorted({int((k + 0.5) * expected_segments / nb_samples) for k in range(nb_samples)})
+
+
+def identification_stats(keys, expected_segments, duration_s, nb_chapters=0):
     """
+    Identification yield from the shazam keys of the segments recognized so far (segment file -> key or None, errors left out),
+    with the tracks expected over the whole set : the identified share of the chapters, or of the duration in average tracks.
+    """
+    recognized = list(keys.values())
+    identified = [key for key in recognized if key]
+    nb_unique_tracks = len(set(identified))
+    ratio = len(identified) / len(recognized) if recognized else 0
+    return {
+        'expected_segments': expected_segments,
+        'recognized_segments': len(recognized),
+        'identified_segments': len(identified),
+        'unique_tracks': nb_unique_tracks,
+        'estimated_tracks': max(nb_unique_tracks, ratio * (nb_chapters or duration_s / AVG_TRACK_LENGTH_S)),
+    }
+
+
+def shazam_outage_error(nb_errors, nb_segments):
+    """ Retryable error if most of the segments sent to Shazam failed, their stats say nothing of the set. None otherwise. """
+    if nb_segments and nb_errors > nb_segments / 2:
+        return f'{SHAZAM_UNAVAILABLE}: {nb_errors}/{nb_segments} segments failed to be recognized'
+    return None
+
+
+def early_abort_reason(stats, min_segments=EARLY_ABORT_MIN_SEGMENTS):
+    """ Reason to stop processing a set whose estimated tracks are under SET_MIN_UNIQUE_TRACKS. None to go on. """
+    if stats['recognized_segments'] < min_segments:
+        return None
+    if stats['estimated_tracks'] < SET_MIN_UNIQUE_TRACKS:
+        return f"{stats['unique_tracks']} unique tracks found in {stats['recognized_segments']} segments, {stats['estimated_tracks']:.0f} expected. Min {SET_MIN_UNIQUE_TRACKS}"
+    return None
 
-    def update_record(current, new):
-        """Update current record with non-empty values from new record, except 'start_time'."""
-        for key, value in new.items():
-            if key != 'start_time' and value and not current.get(key):
-                current[key] = value
 
-    processed_tracks = []
-    i = 0
+def save_identification(video_id, stage, stats, abort_reason=None, audio_downloaded_s=None):
+    """ Upserts the identification stats of video_id, see SetIdentification. """
+    try:
+        identification = SetIdentification.query.filter_by(video_id=video_id).first() or SetIdentification(video_id=video_id)
+        identification.stage = stage
+        for key, value in stats.items():
+            setattr(identification, key, value)
+        identification.aborted = abort_reason is not None
+        identification.abort_reason = abort_reason[:255] if abort_reason else None
+        identification.audio_downloaded_s = audio_downloaded_s
+        db.session.add(identification)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f'Error saving the identification stats of {video_id}: {e}')
+
 
-    while i < len(tracks):
-        current_track = tracks[i]
-        j = i + 1
+def save_segment_classification(video_id, results_path):
+    """ Upserts the number of segments of video_id not sent to Shazam, see SetSegmentClassification. """
+    if not os.path.exists(results_path):
+        return
+    try:
+        results = latest_segment_results(results_path)
+        skipped = sum(1 for record in results.values() if 'skipped' in record['result'])
+        logger.info(f'{skipped}/{len(results)} segments of {video_id} not sent to Shazam (not music)')
+        classification = SetSegmentClassification.query.filter_by(video_id=video_id).first() or SetSegmentClassification(video_id=video_id)
+        classification.segments = len(results)
+        classification.skipped_segments = skipped
+        classification.threshold = NON_MUSIC_THRESHOLD
+        db.session.add(classification)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f'Error saving the segment classification of {video_id}: {e}')
 
-        while j < len(tracks) and j <= i + look_ahead:
-            if current_track['key_track_shazam'] is not None and tracks[j]['key_track_shazam'] == current_track['key_track_shazam']:
-                current_track['end_time'] = tracks[j]['end_time']
-                update_record(current_track, tracks[j])
-                i = j  # move to the next record after the found duplicate
-            j += 1
 
-        processed_tracks.append(current_track)
-        i += 1
+def stored_extraction(video_id):
+    """ The yt-dlp extraction stored when the set was queued, in the shape of youtube.audio_extraction, None if none. """
+    row = YoutubeExtraction.query.filter_by(video_id=video_id).first()
+    if row is None:
+        return None
+    return {'info': row.info, 'expires_at': row.expires_at.timestamp() if row.expires_at else None}
 
-    return processed_tracks
 
-def remove_small_unidentified_segments(tracks, min_duration_s):
+def recognize_ranges(video_id, ranges, segments_dir, results_path, extraction=None):
     """
-    Removes small unidentified segments from a list of tracks and adjusts the end time of the previous identified track accordingly.
-
-    Parameters:
-    tracks (list of dict): A list of track dictionaries, where each dictionary represents a track with 'title', 'start_time', and 'end_time' keys.
-    min_duration_s (int or float): The minimum duration in seconds. Unidentified tracks with a duration less than this value will be removed.
+    Cuts {i: (start_s, end_s)} straight from the YouTube stream into segment_<i>.opus (ffmpeg seeks, only those ranges
+    are fetched) and recognizes them into the results log, as the full run would.
 
     Returns:
-    list of dict: A cleaned list of tracks with small unidentified segments removed and the end times of the previous identified tracks adjusted.
-
-    Example:
-    tracks = [
-        {'title': 'Song 1', 'start_time': 0, 'end_time': 30},
-        {'title': '', 'start_time': 30, 'end_time': 32},  # This will be removed if min_duration_s is > 2
-        {'title': 'Song 2', 'start_time': 32, 'end_time': 60}
-    ]
-    min_duration_s = 3
-    cleaned_tracks = remove_small_unidentified_segments(tracks, min_duration_s)
-    # cleaned_tracks will be:
-    # [
-    #     {'title': 'Song 1', 'start_time': 0, 'end_time': 32},
-    #     {'title': 'Song 2', 'start_time': 32, 'end_time': 60}
-    # ]
+        dict: segment file -> shazam key, None if not identified. The segments Shazam failed on are left out.
     """
-    
-    cleaned_tracks = []
+    url, input_options = youtube_audio_source(video_id, extraction)
+    count('external_calls', len(ranges) + (0 if extraction_is_valid(extraction) else 1))
+    paths = export_ranges(url, ranges, segments_dir, input_options=input_options)
+    with SegmentRecognizer(results_path) as recognizer:
+        for i in sorted(paths):
+            recognizer.submit(paths[i], *ranges[i])
+    return recognizer.keys
 
-    for i in range(len(tracks)):
-        current_track = tracks[i]
 
-        # If the current track is unidentified and its duration is less than min_duration_s
-        if (not current_track['title']) and (current_track['end_time'] - current_track['start_time'] < min_duration_s):
-            # Extend the end_time of the previous identified track if there is one
-            if cleaned_tracks:
-                cleaned_tracks[-1]['end_time'] = current_track['end_time']
-        else:
-            cleaned_tracks.append(current_track)
+def sample_identification(video_id, ranges, samples, segments_dir, results_path, extraction=None):
+    """
+    Recognizes the sampled segments (recognize_ranges). Their results are the ones of the full run, they are not recognized again.
 
-    return cleaned_tracks
+    Returns:
+        tuple: (shazam keys of the sampled segments, seconds of audio fetched)
+    """
+    keys = recognize_ranges(video_id, {i: ranges[i] for i in samples}, segments_dir, results_path, extraction)
+    return keys, sum(ranges[i][1] - ranges[i][0] for i in samples)
 
-dl_dir = 'temp_downloads'
+
+def write_tracklist_songs(video_id, timeline, segments_dir, results_path, output_file_path, extraction=None):
+    """
+    Writes the songs of a set named by its uploader, in the shape of write_deduplicated_segments, from its timeline
+    (see tracklist.chapters_timeline / description_timeline) : the resolved tracks as they are, the unresolved ranges
+    recognized from their audio, only those ranges being fetched.
+    """
+    ranges = {i: (start_s, end_s) for i, (start_s, end_s, track_data) in enumerate(timeline) if track_data is None}
+    if ranges:
+        logger.info(f'Recognizing {len(ranges)} parts out of {len(timeline)} from their audio')
+        with span('shazam'):
+            recognize_ranges(video_id, ranges, segments_dir, results_path, extraction)
+
+    results = latest_segment_results(results_path)
+    songs = []
+    for i, (start_s, end_s, track_data) in enumerate(timeline):
+        if track_data is None:
+            track_data = segment_track_data(results.get(i))
+        songs.append({'start_time': int(start_s), 'end_time': int(end_s), **track_data})
+    atomic_write_json(output_file_path, songs)
+    return songs
 
 
 def insert_set(video_info,delete_temp_files=True):
+    with trace_stages() as tracer, pinned(video_info['video_id']):
+        result = {'error': 'Interrupted'}
+        try:
+            result = _insert_set(video_info, delete_temp_files)
+            return result
+        finally:
+            observe_set_process(tracer, 'done' if 'set_id' in result else 'failed')
+            save_set_process_spans(video_info['video_id'], tracer)
+
+
+def save_set_process_spans(video_id, tracer):
+    """ Persists the spans of an insert_set run, for the admin stage summary. """
+    try:
+        db.session.rollback() # a failed stage can leave the session in a failed transaction
+        for stage_span in tracer.spans:
+            db.session.add(SetProcessSpan(video_id=video_id, run_started_at=tracer.started_at, **stage_span))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f'Error saving the process spans of {video_id}: {e}')
+
+
+def _insert_set(video_info,delete_temp_files=True):
     try:
         
         
@@ -119,71 +226,147 @@ def insert_set(video_info,delete_temp_files=True):
             chapters = []
        
 
-        set = upsert_set(video_info)  
+        with span('upsert_set'):
+            set = upsert_set(video_info)  
         if set is None:
             return error_out("Error creating Set.")
 
 
+        songs = None
         logger.info('Setup directories')
         vid_dir = f"{dl_dir}/{video_id}"
         segments_dir = f"{vid_dir}/segments"
-        shazam_json_dir = f"{vid_dir}/shazam_json"  
+        results_path = f"{vid_dir}/{SEGMENT_RESULTS_FILE}"
+        # the tracklist ranges are not the download ones, a fallback to the download must not reuse their results
+        tracklist_segments_dir = f"{vid_dir}/tracklist_segments"
+        tracklist_results_path = f"{vid_dir}/{TRACKLIST_RESULTS_FILE}"
         dedup_segments_filepath = f'{vid_dir}/segments_dedup.json'  
         complete_songs_path = f'{vid_dir}/songs_complete.json'
-        full_opus_path = f'{vid_dir}/full.opus'
+        full_audio_path = f'{vid_dir}/{FULL_AUDIO_NAME}'
         os.makedirs(vid_dir,exist_ok=True)
         os.makedirs(segments_dir,exist_ok=True)
-        os.makedirs(shazam_json_dir,exist_ok=True)
     
-        logger.debug(f"Constructed path: '{full_opus_path}'")
-        if not os.path.exists(full_opus_path):
+        logger.debug(f"Constructed path: '{full_audio_path}'")
+        if not os.path.exists(full_audio_path) and not os.path.exists(dedup_segments_filepath):
+            # chapters named "Artist - Title", or a tracklist in the description : no download,
+            # only the parts that could not be resolved are listened to
+            with span('tracklist'):
+                if len(chapters):
+                    timeline, nb_resolved, nb_named = chapters_timeline(chapters)
+                else:
+                    timeline, nb_resolved, nb_named = description_timeline(video_info.get('description'), video_info.get('duration') or 0, AUDIO_SEGMENTS_LENGTH)
+            if timeline and nb_resolved >= TRACKLIST_MIN_RESOLVED * nb_named:
+                logger.info(f'{nb_resolved}/{nb_named} tracks of {video_id} resolved from the {"chapters" if len(chapters) else "description"}')
+                try:
+                    songs = write_tracklist_songs(video_id, timeline, tracklist_segments_dir, tracklist_results_path, dedup_segments_filepath, stored_extraction(video_id))
+                    results_path = tracklist_results_path
+                except Exception as e:
+                    logger.warning(f'Recognizing the unresolved parts of {video_id} failed, downloading it whole: {e}')
+
+        if not os.path.exists(full_audio_path) and not os.path.exists(dedup_segments_filepath):
+            error = duration_error(video_info.get('duration') or 0)
+            if error:
+                raise Exception(error)
+            duration_s = video_info['duration']
+            extraction = stored_extraction(video_id)
+            ranges = segment_ranges(duration_s, chapters, AUDIO_SEGMENTS_LENGTH)
+            samples = sample_segments(len(ranges))
+            sampled = False
+            if samples:
+                logger.info(f'Sampling {len(samples)} segments of {video_id}')
+                try:
+                    with span('sample'):
+                        keys, audio_s = sample_identification(video_id, ranges, samples, segments_dir, results_path, extraction)
+                except Exception as e:
+                    logger.warning(f'Sampling {video_id} failed, downloading it whole: {e}')
+                else:
+                    outage = shazam_outage_error(len(samples) - len(keys), len(samples))
+                    if outage:
+                        raise Exception(outage)
+                    stats = identification_stats(keys, len(ranges), duration_s, len(chapters))
+                    abort_reason = early_abort_reason(stats, min_segments=len(samples))
+                    save_identification(video_id, 'sample', stats, abort_reason, audio_s)
+                    if abort_reason:
+                        raise Exception(abort_reason)
+                    sampled = True
+
             logger.info(f'Downloading video {video_id}')
-            download_youtube_video(video_id,vid_dir)
-        else:
+            # the segments are recognized while the rest downloads. Without a sample, the download stops early for a set too poor in tracks
+            recognizer = SegmentRecognizer(results_path)
+            progress = {'abort_reason': None, 'audio_s': 0}
+
+            def on_segment(i, segment_path):
+                recognizer.submit(segment_path, *(ranges[i] if i < len(ranges) else (None, None)))
+                progress['audio_s'] = ranges[min(i, len(ranges) - 1)][1]
+                if not sampled: # the first segments (intro, talk) say less than a sample spread over the set
+                    progress['abort_reason'] = early_abort_reason(identification_stats(recognizer.keys, len(ranges), duration_s, len(chapters)))
+                return progress['abort_reason']
+
+            try:
+                with span('download'), recognizer:
+                    stream_youtube_audio(video_id, vid_dir, segments_dir, chapters, AUDIO_SEGMENTS_LENGTH,
+                                         max_duration_s=SET_MAX_DURATION_S, on_segment=on_segment, extraction=extraction)
+                    count('external_calls')
+                    count('bytes_downloaded', os.path.getsize(full_audio_path))
+            finally:
+                save_identification(video_id, 'download', identification_stats(recognizer.keys, len(ranges), duration_s, len(chapters)),
+                                    progress['abort_reason'], progress['audio_s'])
+        elif not os.path.exists(dedup_segments_filepath):
             logger.info(f'Video {video_id} already downloaded.')
+            with span('cut_audio'):
+                cut_audio(full_audio_path,chapters, AUDIO_SEGMENTS_LENGTH, None, segments_dir)
         
         if not os.path.exists(dedup_segments_filepath):
-            cut_audio(full_opus_path,chapters, AUDIO_SEGMENTS_LENGTH, None, segments_dir)
-            sync_process_segments(segments_dir, shazam_json_dir)
-            if not len(chapters):
-                write_deduplicated_segments(shazam_json_dir, dedup_segments_filepath,AUDIO_SEGMENTS_LENGTH)
-            else:
-                write_segments_from_chapter(shazam_json_dir, dedup_segments_filepath, chapters)
+            with span('shazam'):
+                sync_process_segments(segments_dir, results_path, dict(enumerate(segment_ranges(video_info.get('duration') or 0, chapters, AUDIO_SEGMENTS_LENGTH))))
+            results = latest_segment_results(results_path)
+            outage = shazam_outage_error(sum(1 for record in results.values() if 'error' in record['result']), len(results))
+            if outage:
+                raise Exception(outage)
+            with span('dedup'):
+                if not len(chapters):
+                    songs = write_deduplicated_segments(results_path, dedup_segments_filepath,AUDIO_SEGMENTS_LENGTH)
+                else:
+                    songs = write_segments_from_chapter(results_path, dedup_segments_filepath, chapters)
         
         logger.info(f'Processing segments from {dedup_segments_filepath}')
     
         if not os.path.exists(complete_songs_path) or True :
-            songs = json.load(open(dedup_segments_filepath))
-            
-            songs = merge_tracks_by_shazam_key(songs, 4)
-      
-            
-            songs = remove_small_unidentified_segments(songs, 90)
-            #json.dump(songs,open('shazam_songs.json','w'),indent=4)
-            nb_unique_tracks = count_unique_tracks(songs)
-            logger.debug(f'Found {nb_unique_tracks} unique tracks.')
-            if nb_unique_tracks < 5:
-                raise Exception(f'{nb_unique_tracks} unique tracks found. Min 5')
+            with span('merge'):
+                if songs is None: # deduplicated by a previous run
+                    songs = json.load(open(dedup_segments_filepath))
+                
+                songs, nb_unique_tracks = consolidate(songs, look_ahead=4, min_unidentified_s=90)
+                if not len(chapters): # the uploader placed the chapters
+                    songs = place_track_starts(songs)
+                #json.dump(songs,open('shazam_songs.json','w'),indent=4)
+                logger.debug(f'Found {nb_unique_tracks} unique tracks.')
+                if nb_unique_tracks < SET_MIN_UNIQUE_TRACKS:
+                    raise Exception(f'{nb_unique_tracks} unique tracks found. Min {SET_MIN_UNIQUE_TRACKS}')
             
-            songs = add_tracks_spotify_data_from_json(songs)
+            with span('spotify'):
+                songs = add_tracks_spotify_data_from_json(songs)
            
-            songs = add_apple_track_data_from_json(songs)
+            with span('apple'):
+                songs = add_apple_track_data_from_json(songs)
             
-            json.dump(songs,open(complete_songs_path,'w'),indent=4)
+            atomic_write_json(complete_songs_path, songs, indent=4)
             
         songs = json.load(open(complete_songs_path))
         
         logger.info(f'Adding {len(songs)} tracks to set {set.id}')
         
-        add_tracks_from_json(songs,set,add_to_set=True)
+        with span('add_tracks'):
+            add_tracks_from_json(songs,set,add_to_set=True)
 
+        save_segment_classification(video_id, results_path)
         if delete_temp_files:
             shutil.rmtree(vid_dir)
 
         return {'set_id':set.id}
-    except Exception as e:        
-        if delete_temp_files:
-            shutil.rmtree(vid_dir)           
+    except Exception as e:
+        # the artifacts are kept for a retry to start from them, the artifact store evicts them otherwise
+        save_segment_classification(video_info.get('video_id'), f"{dl_dir}/{video_info.get('video_id')}/{SEGMENT_RESULTS_FILE}")
         return error_out(str(e)) 
     
     
@@ -280,6 +463,17 @@ def add_tracks_from_json(tracks_json, set_instance=None, add_to_set=False,relate
         
         db.session.commit()
         
+        if add_to_set:
+            try:
+                update_set_similarity_index(set_instance.id)
+            except Exception as e:
+                logger.error(f"Error updating the set similarity index for set {set_instance.id}: {e}")
+            try:
+                refresh_sets_stats([set_instance.id])
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error computing the stats of set {set_instance.id}: {e}")
+        
         # Set related_tracks if related_track_id is provided
         if related_track_id and not add_to_set:
             logger.info(f'Related track ID provided: {related_track_id}')
@@ -1,8 +1,11 @@
 from web.controller.set import extract_time_from_reason, is_set_exists, is_set_in_queue
-from web.controller.set_process import insert_set, remove_set_temp_files
+from web.controller.set_process import SET_MAX_DURATION_S, SET_MIN_DURATION_S, SET_MIN_UNIQUE_TRACKS, SHAZAM_UNAVAILABLE, insert_set, remove_set_temp_files
 from web.lib.utils import as_dict
-from web.lib.av_apis.youtube import youbube_video_info, youtube_video_exists
-from web.model import  Set, SetQueue, Channel
+from web.lib.av_apis.youtube import youbube_video_info, youtube_video_exists, youtube_video_infos
+from web.lib.metrics import observe_queue_resolve
+from web.lib.artifact_store import artifact_dir, directory_size, estimated_artifact_bytes, has_room_for
+from web.model import  Set, SetProcessSpan, SetQueue, Channel, YoutubeExtraction
+from sqlalchemy import func
 from datetime import datetime, timedelta, timezone
 from boilersaas.utils.db import db
 
@@ -11,6 +14,14 @@ from web.lib.format import cut_to_if_needed
 from web.logger import logger
 
 import dotenv
+import os
+import time
+
+# Prequeued sets resolved (video info + queue rules) per batch by cron_set_queue.py, and how often the batch is committed
+SET_QUEUE_RESOLVE_BATCH = int(os.getenv('SET_QUEUE_RESOLVE_BATCH', 20))
+SET_QUEUE_RESOLVE_COMMIT_EVERY = int(os.getenv('SET_QUEUE_RESOLVE_COMMIT_EVERY', 10))
+# A prequeued set claimed for longer than this (worker killed...) is put back in the prequeue
+SET_QUEUE_RESOLVE_TIMEOUT = timedelta(minutes=15)
 
 def clean_discarded_reason(reason, video_id=None):
     # Remove video_id from the reason. like in "n5l6paz89bg: this live event will begin in..."
@@ -20,7 +31,7 @@ def clean_discarded_reason(reason, video_id=None):
     reason = reason.lstrip(":").strip()
     return cut_to_if_needed(reason, 255)
 
-def queue_set_discarded(video_id, reason, existing_entry=None):
+def queue_set_discarded(video_id, reason, existing_entry=None, commit=True):
     
     reason_cleaned = clean_discarded_reason(reason, video_id)
     
@@ -28,7 +39,8 @@ def queue_set_discarded(video_id, reason, existing_entry=None):
         existing_entry.status = 'discarded'
         existing_entry.discarded_reason = reason_cleaned
         existing_entry.updated_at = datetime.now(timezone.utc)  # Manually update updated_at
-        db.session.commit()
+        if commit:
+            db.session.commit()
         return existing_entry
     
     discarded_entry = SetQueue(
@@ -39,11 +51,12 @@ def queue_set_discarded(video_id, reason, existing_entry=None):
         n_attempts=1  
     )
     db.session.add(discarded_entry)
-    db.session.commit()
+    if commit:
+        db.session.commit()
     return {'error': reason_cleaned}
   
 
-def queue_set_premiered(video_id, reason, existing_entry=None):
+def queue_set_premiered(video_id, reason, existing_entry=None, commit=True):
     # Extract time from the reason (only days, hours, or minutes, not a combination)
     premiere_duration = extract_time_from_reason(reason)
     premiere_ends = datetime.now(timezone.utc) + premiere_duration
@@ -58,7 +71,8 @@ def queue_set_premiered(video_id, reason, existing_entry=None):
         existing_entry.premiere_ends = premiere_ends
         existing_entry.discarded_reason = reason_cleaned
         existing_entry.updated_at = datetime.now(timezone.utc)  # Manually update updated_at
-        db.session.commit()
+        if commit:
+            db.session.commit()
         return existing_entry
     
     discarded_entry = SetQueue(
@@ -70,13 +84,14 @@ def queue_set_premiered(video_id, reason, existing_entry=None):
         n_attempts=1  
     )
     db.session.add(discarded_entry)
-    db.session.commit()
+    if commit:
+        db.session.commit()
     return {'error': reason}
 
-def queue_set_to_retry(video_id, reason, existing_entry=None):
+def queue_set_to_retry(video_id, reason, existing_entry=None, commit=True):
     
     if existing_entry:
-       return queue_reset_set(existing_entry,reason)
+       return queue_reset_set(existing_entry,reason,commit)
     
     failed_entry = SetQueue(
         video_id=video_id,
@@ -87,7 +102,8 @@ def queue_set_to_retry(video_id, reason, existing_entry=None):
         n_attempts=1  # Initialize n_attempts for new entries
     )
     db.session.add(failed_entry)
-    db.session.commit()
+    if commit:
+        db.session.commit()
     #return failed_entry
     return {'error': reason}  
   
@@ -123,37 +139,46 @@ def queue_set(video_id,user_id=None,discard_if_exists=False,send_email=False,pla
         video_info = youbube_video_info(video_id)
     except Exception as e:
         return queue_set_discarded(video_id,f'Error getting video info : "{str(e)}"',existing_queue_entry)
-    
+
+    return queue_set_from_info(video_id, video_info, existing_queue_entry, user_id, send_email, play_sound)
+
+
+def queue_set_from_info(video_id, video_info, existing_queue_entry=None, user_id=None, send_email=False, play_sound=False, commit=True, channels=None):
+    """
+    Applies the queue rules to the info of a video (youbube_video_info) : retried, premiered, discarded,
+    or pending with its info. commit=False leaves the commit to the caller, and channels (channel_id -> Channel)
+    saves the channel lookup (batches, see resolve_prequeued_sets).
+    """
     if 'error' in video_info:
         video_info['error'] = video_info['error'].lower()
         if 'not a bot' in video_info['error'] or 'bot verification' in video_info['error']:
-            return queue_set_to_retry(video_id, video_info['error'],existing_queue_entry)
+            return queue_set_to_retry(video_id, video_info['error'],existing_queue_entry,commit)
         elif 'premiere' in video_info['error'] : #or 'this live event' in video_info['error']:
-            return queue_set_premiered(video_id,video_info['error'],existing_queue_entry)
+            return queue_set_premiered(video_id,video_info['error'],existing_queue_entry,commit)
         
-        return queue_set_discarded(video_id,video_info['error'],existing_queue_entry)
+        return queue_set_discarded(video_id,video_info['error'],existing_queue_entry,commit)
    
     if video_info is None:        
-        return queue_set_discarded(video_id,'Error getting video info.',existing_queue_entry)
+        return queue_set_discarded(video_id,'Error getting video info.',existing_queue_entry,commit)
     
     chapters = video_info.get('chapters',[]) or []
     # ditch chapters if there are less than 5 songs.
     # We will then use the regular chapter less method
     # Reason : some sets are discarted, because the chapters are not done by songs
     # EX : mixtape : face A , face B
-    if len(chapters) and len(chapters) < 5:
+    if len(chapters) and len(chapters) < SET_MIN_UNIQUE_TRACKS:
         chapters = []
         #return queue_set_discarded(video_id,f'{len(chapters)} songs in the chapters. Only sets with 5 or more songs are accepted.',existing_queue_entry)
     
-    if video_info.get('duration',0) < 900:
-        return queue_set_discarded(video_id,'Video shorter than 15m. Only sets longer than 15m are accepted.',existing_queue_entry)
+    if video_info.get('duration',0) < SET_MIN_DURATION_S:
+        return queue_set_discarded(video_id,'Video shorter than 15m. Only sets longer than 15m are accepted.',existing_queue_entry,commit)
     
-    if video_info.get('duration',0) > 14400:
-        return queue_set_discarded(video_id,'Video longer than 4h. Only sets shorter than 4h are accepted for now.',existing_queue_entry)
+    if video_info.get('duration',0) > SET_MAX_DURATION_S:
+        return queue_set_discarded(video_id,'Video longer than 4h. Only sets shorter than 4h are accepted for now.',existing_queue_entry,commit)
 
     
     if not video_info.get('playable_in_embed',False):
-        return queue_set_discarded(video_id,'Video is not embeddable. (Set by the uploader)',existing_queue_entry)
+        return queue_set_discarded(video_id,'Video is not embeddable. (Set by the uploader)',existing_queue_entry,commit)
     
 
 
@@ -179,7 +204,7 @@ def queue_set(video_id,user_id=None,discard_if_exists=False,send_email=False,pla
     channel_follower_count = video_info.get('channel_follower_count')
 
     # Check if the channel exists in the database
-    channel = Channel.query.filter_by(channel_id=channel_id).first()
+    channel = channels.get(channel_id) if channels is not None else Channel.query.filter_by(channel_id=channel_id).first()
 
     if channel:
         # Log old and new follower count
@@ -194,8 +219,11 @@ def queue_set(video_id,user_id=None,discard_if_exists=False,send_email=False,pla
         # Save the updated channel info to the database
         db.session.add(channel)
 
+    save_youtube_extraction(video_id, video_info.get('extraction'))
+
     # Commit the changes to the database
-    db.session.commit()
+    if commit:
+        db.session.commit()
     
     if existing_queue_entry:
         existing_queue_entry.status = 'pending'
@@ -206,7 +234,8 @@ def queue_set(video_id,user_id=None,discard_if_exists=False,send_email=False,pla
         existing_queue_entry.nb_chapters = len(chapters)
         # existing_queue_entry.send_email = send_email
         # existing_queue_entry.play_sound = play_sound
-        db.session.commit()
+        if commit:
+            db.session.commit()
         return existing_queue_entry
     
     
@@ -222,10 +251,21 @@ def queue_set(video_id,user_id=None,discard_if_exists=False,send_email=False,pla
         play_sound=play_sound
     )
     db.session.add(queued_entry)
-    db.session.commit()
+    if commit:
+        db.session.commit()
     return queued_entry
   
   
+def save_youtube_extraction(video_id, extraction):
+    """ Keeps the yt-dlp extraction of a queued set for its download (not committed), see YoutubeExtraction. """
+    if not extraction:
+        return
+    row = YoutubeExtraction.query.filter_by(video_id=video_id).first() or YoutubeExtraction(video_id=video_id)
+    row.info = extraction['info']
+    row.expires_at = datetime.fromtimestamp(extraction['expires_at'], timezone.utc) if extraction.get('expires_at') else None
+    db.session.add(row)
+
+
 def queue_discard_set(set_queue_item):
     remove_set_temp_files(set_queue_item.video_id)
     set_queue_item.status = 'discarded'
@@ -233,7 +273,7 @@ def queue_discard_set(set_queue_item):
     set_queue_item.n_attempts += 1  
     db.session.commit()
 
-def queue_reset_set(set_queue_item,discarded_reason=None):
+def queue_reset_set(set_queue_item,discarded_reason=None,commit=True):
     # Put the set back in the queue with the 'pending' status
     # If the set already has info, no need to make a whole queue set request
     if set_queue_item.video_info_json:
@@ -244,7 +284,8 @@ def queue_reset_set(set_queue_item,discarded_reason=None):
     set_queue_item.n_attempts += 1
     set_queue_item.updated_at=datetime.now(timezone.utc)
     set_queue_item.discarded_reason = discarded_reason
-    db.session.commit()
+    if commit:
+        db.session.commit()
     return set_queue_item
   
   
@@ -304,6 +345,80 @@ def pre_queue_set(video_id, user_id=None, discard_if_exists=False, send_email=Fa
     return queued_entry
 
 
+def claim_prequeued_sets(batch_size=SET_QUEUE_RESOLVE_BATCH):
+    """
+    Takes the oldest prequeued sets and marks them as processing, video_info_json still empty. Safe with several workers.
+    """
+    try:
+        stuck_before = datetime.now(timezone.utc) - SET_QUEUE_RESOLVE_TIMEOUT
+        SetQueue.query.filter(
+            SetQueue.status == 'processing',
+            SetQueue.video_info_json.is_(None),
+            SetQueue.updated_at < stuck_before
+        ).update({'status': 'prequeued'}, synchronize_session=False)
+
+        entries = SetQueue.query.filter_by(status='prequeued') \
+            .order_by(SetQueue.updated_at.asc()) \
+            .limit(batch_size) \
+            .with_for_update(skip_locked=True) \
+            .all()
+        for entry in entries:
+            entry.status = 'processing'
+            entry.updated_at = datetime.now(timezone.utc)
+        db.session.commit()
+        return entries
+    except Exception as e:
+        logger.error(f'Error claiming prequeued sets : {e}')
+        db.session.rollback()
+        return []
+
+
+def resolve_prequeued_sets(batch_size=SET_QUEUE_RESOLVE_BATCH, commit_every=SET_QUEUE_RESOLVE_COMMIT_EVERY):
+    """
+    Queues a batch of prequeued sets : their video info is fetched concurrently (youtube_video_infos),
+    then queue_set_from_info applies the queue rules, committed every commit_every sets.
+
+    Returns:
+        dict: number of sets per outcome (status), empty if there was nothing to resolve.
+    """
+    entries = claim_prequeued_sets(batch_size)
+    if not entries:
+        return {}
+
+    start = time.perf_counter()
+    entries_by_video_id = {entry.video_id: entry for entry in entries}
+    outcomes = {}
+    # sets published since they were prequeued, in one query
+    published = {video_id for (video_id,) in db.session.query(Set.video_id).filter(Set.video_id.in_(entries_by_video_id), Set.published == True)}
+    for video_id in published:
+        queue_set_discarded(video_id, 'Set was already here.', entries_by_video_id.pop(video_id), commit=False)
+        outcomes['discarded'] = outcomes.get('discarded', 0) + 1
+
+    channels = {}
+    resolved = 0
+    for video_id, video_info in youtube_video_infos(list(entries_by_video_id)):
+        entry = entries_by_video_id[video_id]
+        try:
+            channel_id = video_info.get('channel_id')
+            if channel_id and channel_id not in channels:
+                channels[channel_id] = Channel.query.filter_by(channel_id=channel_id).first()
+            queue_set_from_info(video_id, video_info, entry, entry.user_id, entry.send_email, entry.play_sound, commit=False, channels=channels)
+        except Exception as e:
+            logger.error(f'Error queueing set {video_id} : {e}')
+            queue_set_discarded(video_id, f'Error getting video info : "{str(e)}"', entry, commit=False)
+
+        outcomes[entry.status] = outcomes.get(entry.status, 0) + 1
+        resolved += 1
+        if resolved % commit_every == 0:
+            db.session.commit()
+    db.session.commit()
+
+    duration_s = time.perf_counter() - start
+    observe_queue_resolve(outcomes, duration_s)
+    logger.info(f'Resolved {len(entries)} prequeued sets in {duration_s:.1f}s ({len(entries) / duration_s:.2f}/s) : {outcomes}')
+    return outcomes
+
+
 def insert_set_from_queue():
     
     logger.info('Starting insert_set_from_queue function')
@@ -330,6 +445,12 @@ def insert_set_from_queue():
     if not pending_entry:
         logger.info('No pending entry found')
         return None
+
+    # what a retry already has on disk is not downloaded again
+    needed_bytes = estimated_artifact_bytes(pending_entry.duration) - directory_size(artifact_dir(pending_entry.video_id))
+    if not has_room_for(max(needed_bytes, 0)):
+        logger.warning(f'Not enough disk space to process {pending_entry.video_id}, not claiming it')
+        return None
     
 
     # Update the status to 'processing' and commit
@@ -357,6 +478,7 @@ def insert_set_from_queue():
     'ffmpeg exited',
     '[0;31mERROR',
     'Private video',
+    SHAZAM_UNAVAILABLE,
     ]
     
     premiere_keywords = [
@@ -380,6 +502,7 @@ def insert_set_from_queue():
             # Too long, too short, not enough tracks found errors
             
             pending_entry.status = 'discarded'
+            remove_set_temp_files(pending_entry.video_id) # no retry to reuse them
         
         logger.error(f'Set insertion {pending_entry.status}. Reason: {distarted_reason}')
         logger.error(result)
@@ -387,6 +510,9 @@ def insert_set_from_queue():
         pending_entry.discarded_reason = clean_discarded_reason(distarted_reason, pending_entry.video_id)
         
 
+    if pending_entry.status != 'pending': # no download to come, the extraction is not needed anymore
+        YoutubeExtraction.query.filter_by(video_id=pending_entry.video_id).delete()
+
     # Commit the changes
     pending_entry.updated_at = datetime.now(timezone.utc)
     db.session.commit()
@@ -423,3 +549,53 @@ def update_premiered_to_prequeued():
 
         # Commit the changes to the database
         db.session.commit()
+
+
+def get_set_process_stage_summary(days=7, nb_slowest=20):
+    """
+    Where the insert_set time goes, from the SetProcessSpan rows of the last `days` days.
+
+    Returns:
+        dict: 'stages' (one dict per stage, biggest share of the total wall time first) and
+              'slowest' (the nb_slowest runs, with their total wall time and failed stage if any).
+    """
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+
+    rows = (
+        db.session.query(
+            SetProcessSpan.stage,
+            func.count(SetProcessSpan.id).label('nb_runs'),
+            func.sum(SetProcessSpan.wall_s).label('total_wall_s'),
+            func.avg(SetProcessSpan.wall_s).label('avg_wall_s'),
+            func.percentile_cont(0.5).within_group(SetProcessSpan.wall_s).label('p50_wall_s'),
+            func.percentile_cont(0.95).within_group(SetProcessSpan.wall_s).label('p95_wall_s'),
+            func.avg(SetProcessSpan.cpu_s).label('avg_cpu_s'),
+            func.max(SetProcessSpan.peak_rss_mb).label('max_peak_rss_mb'),
+            func.avg(SetProcessSpan.bytes_downloaded).label('avg_bytes_downloaded'),
+            func.avg(SetProcessSpan.external_calls).label('avg_external_calls'),
+            func.avg(SetProcessSpan.db_round_trips).label('avg_db_round_trips'),
+            func.count(SetProcessSpan.id).filter(SetProcessSpan.status == 'error').label('nb_errors'),
+        )
+        .filter(SetProcessSpan.run_started_at >= since)
+        .group_by(SetProcessSpan.stage)
+        .all()
+    )
+    total_wall_s = sum(row.total_wall_s for row in rows) or 1
+    stages = [dict(row._mapping, share=row.total_wall_s / total_wall_s) for row in rows]
+    stages.sort(key=lambda stage: stage['total_wall_s'], reverse=True)
+
+    slowest = (
+        db.session.query(
+            SetProcessSpan.video_id,
+            SetProcessSpan.run_started_at,
+            func.sum(SetProcessSpan.wall_s).label('wall_s'),
+            func.max(SetProcessSpan.stage).filter(SetProcessSpan.status == 'error').label('failed_stage'),
+        )
+        .filter(SetProcessSpan.run_started_at >= since)
+        .group_by(SetProcessSpan.video_id, SetProcessSpan.run_started_at)
+        .order_by(func.sum(SetProcessSpan.wall_s).desc())
+        .limit(nb_slowest)
+        .all()
+    )
+
+    return {'stages': stages, 'slowest': [dict(row._mapping) for row in slowest]}
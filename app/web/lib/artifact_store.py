@@ -0,0 +1,152 @@
+import json
+import os
+import shutil
+import socket
+import time
+from contextlib import contextmanager
+
+import logging
+logger = logging.getLogger('root')
+
+# temp_downloads/<video_id>/ holds the artifacts of a set (audio, segments, shazam results...). They are kept after a failure,
+# for the retry to start from them, and evicted least recently used first once over the budget or too old.
+# A set being processed is pinned and never evicted.
+TEMP_DOWNLOADS_PATH = os.getenv('TEMP_DOWNLOADS_PATH', 'temp_downloads')
+TEMP_DOWNLOADS_BUDGET_BYTES = int(float(os.getenv('TEMP_DOWNLOADS_BUDGET_GB', 20)) * 2**30)
+TEMP_DOWNLOADS_MIN_FREE_BYTES = int(float(os.getenv('TEMP_DOWNLOADS_MIN_FREE_GB', 5)) * 2**30) # no new set is claimed below
+TEMP_DOWNLOADS_MAX_AGE_S = 24 * 3600
+PIN_TIMEOUT_S = 12 * 3600 # a pin older than this is stale (worker killed on another host)
+AUDIO_BYTES_PER_S = 40_000 # disk used per second of set : the audio as downloaded, and its segments
+
+PIN_FILE = '.pinned'
+LAST_USED_FILE = '.last_used'
+
+
+def artifact_dir(video_id):
+    return os.path.join(TEMP_DOWNLOADS_PATH, video_id)
+
+
+def estimated_artifact_bytes(duration_s):
+    return int((duration_s or 0) * AUDIO_BYTES_PER_S)
+
+
+@contextmanager
+def atomic_open(path, mode='w'):
+    """ Writes path through a temp file renamed over it once complete : a reader never sees a partial file. """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_write_json(path, data, **kwargs):
+    with atomic_open(path) as f:
+        json.dump(data, f, **kwargs)
+
+
+def touch(video_id):
+    """ Marks the artifacts of video_id as used now, for the LRU eviction. """
+    with open(os.path.join(artifact_dir(video_id), LAST_USED_FILE), 'w'):
+        pass
+
+
+def last_used(path):
+    marker = os.path.join(path, LAST_USED_FILE)
+    return os.path.getmtime(marker if os.path.exists(marker) else path)
+
+
+@contextmanager
+def pinned(video_id):
+    """ The artifacts of video_id, created if needed, kept from eviction while the block runs. """
+    path = artifact_dir(video_id)
+    os.makedirs(path, exist_ok=True)
+    atomic_write_json(os.path.join(path, PIN_FILE), {'host': socket.gethostname(), 'pid': os.getpid(), 'at': time.time()})
+    touch(video_id)
+    try:
+        yield path
+    finally:
+        if os.path.isdir(path): # removed by the job itself once done
+            touch(video_id)
+            try:
+                os.remove(os.path.join(path, PIN_FILE))
+            except FileNotFoundError:
+                pass
+
+
+def is_pinned(path):
+    try:
+        pin = json.load(open(os.path.join(path, PIN_FILE)))
+    except (OSError, ValueError):
+        return False
+    if time.time() - pin.get('at', 0) > PIN_TIMEOUT_S:
+        return False
+    if pin.get('host') == socket.gethostname():
+        try:
+            os.kill(pin['pid'], 0)
+        except ProcessLookupError:
+            return False # its worker died
+        except (PermissionError, KeyError, TypeError):
+            pass
+    return True
+
+
+def directory_size(path):
+    size = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass # removed while walking
+    return size
+
+
+def evict_artifacts(needed_bytes=0, budget_bytes=TEMP_DOWNLOADS_BUDGET_BYTES, max_age_s=TEMP_DOWNLOADS_MAX_AGE_S):
+    """
+    Removes the unpinned artifacts older than max_age_s, then the least recently used ones
+    until the rest and needed_bytes fit in budget_bytes.
+
+    Returns:
+        int: bytes freed.
+    """
+    if not os.path.isdir(TEMP_DOWNLOADS_PATH):
+        return 0
+    now = time.time()
+    artifacts = []
+    for name in os.listdir(TEMP_DOWNLOADS_PATH):
+        path = os.path.join(TEMP_DOWNLOADS_PATH, name)
+        if os.path.isdir(path):
+            try:
+                artifacts.append({'path': path, 'size': directory_size(path), 'last_used': last_used(path), 'pinned': is_pinned(path)})
+            except OSError:
+                pass # removed meanwhile
+
+    total = sum(a['size'] for a in artifacts)
+    freed = 0
+    for artifact in sorted(artifacts, key=lambda a: a['last_used']):
+        too_old = now - artifact['last_used'] > max_age_s
+        if artifact['pinned'] or not (too_old or total + needed_bytes - freed > budget_bytes):
+            continue
+        logger.info(f"Evicting {artifact['path']} ({artifact['size'] / 2**20:.0f} MB, last used {(now - artifact['last_used']) / 3600:.1f}h ago)")
+        shutil.rmtree(artifact['path'], ignore_errors=True)
+        freed += artifact['size']
+    return freed
+
+
+def has_room_for(needed_bytes):
+    """
+    True if needed_bytes more can be written in the temp downloads, evicting to make room if needed :
+    within the budget, and leaving TEMP_DOWNLOADS_MIN_FREE_BYTES free on the volume.
+    """
+    evict_artifacts(needed_bytes)
+    os.makedirs(TEMP_DOWNLOADS_PATH, exist_ok=True)
+    free = shutil.disk_usage(TEMP_DOWNLOADS_PATH).free
+    if free - needed_bytes < TEMP_DOWNLOADS_MIN_FREE_BYTES:
+        logger.warning(f'Low disk : {free / 2**30:.1f} GB free, {needed_bytes / 2**30:.1f} GB needed, {TEMP_DOWNLOADS_MIN_FREE_BYTES / 2**30:.1f} GB kept free')
+        return False
+    return True
@@ -1,77 +1,92 @@
-
-
 import math
 import os
-from pydub import AudioSegment
-import socket
+import subprocess
 
 from web.lib.utils import is_dev_env
 
-# Determine if running on localhost
-is_localhost = is_dev_env()
+from concurrent.futures import ThreadPoolExecutor
+import logging
+logger = logging.getLogger('root')
 
+# ffmpeg processes run at once by cut_audio. Every segment is decoded by its own ffmpeg (single threaded),
+# so the cutting scales with the cores. Lower it on hosts shared with other workers.
+AUDIO_WORKERS = int(os.getenv('AUDIO_WORKERS', os.cpu_count() or 1))
 
-if not is_localhost:
-    # Set the ffmpeg converter path dynamically for non-localhost environments
-    ffmpeg_path = f"{os.getcwd()}/ffmpeg/ffmpeg"
 
-    if os.path.isfile(ffmpeg_path):
-        AudioSegment.converter = ffmpeg_path
-        print("Using ffmpeg at:", AudioSegment.converter)
-    else:
-        raise FileNotFoundError(f"ffmpeg not found at {ffmpeg_path}")
-else:
-    print("Running on localhost; ffmpeg configuration skipped.")
+def ffmpeg_binary(name='ffmpeg'):
+    """ The bundled ffmpeg / ffprobe outside localhost, the ones on the PATH otherwise. Checked on use, not on import. """
+    if is_dev_env():
+        return name
+    path = f"{os.getcwd()}/ffmpeg/{name}"
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"{name} not found at {path}")
+    return path
 
-from concurrent.futures import ThreadPoolExecutor
-import logging
-logger = logging.getLogger('root')
 
-def cut_audio(file_path, chapters=[],segment_length_s=120, frame_rate=None, segments_dir='segments'):
-    logger.info('cutting audio')
-    # Load the audio file
-    logger.info('extracting audio segment (this may take a while)')
-    audio = AudioSegment.from_file(file_path)
+def audio_duration_s(file_path):
+    result = subprocess.run(
+        [ffmpeg_binary('ffprobe'), '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', file_path],
+        capture_output=True, text=True, check=True,
+    )
+    return float(result.stdout.strip())
+
 
+def export_range(file_path, start_s, end_s, out_path, frame_rate=None, input_options=[]):
+    """
+    Decodes only start_s to end_s of file_path (ffmpeg input seek) and encodes it to opus at out_path.
+    file_path can be an http url, input_options (headers, proxy) then apply to it.
+    """
+    command = [ffmpeg_binary(), '-loglevel', 'error', '-y', '-threads', '1', *input_options,
+               '-ss', f'{start_s:.3f}', '-t', f'{end_s - start_s:.3f}', '-i', file_path, '-vn']
     if frame_rate:
-        audio = audio.set_frame_rate(frame_rate)
-        
-    logger.info('Audio segment extracted')
-
-    # Calculate the number of segments
-    duration_ms = len(audio)
-    segment_length_ms = segment_length_s * 1000
-    logger.info(f'duration_ms: {duration_ms}')
-    if len(chapters):
-        num_segments = len(chapters)
-        logger.info(f'num_segments (from chapters): {num_segments}')
-    else:
-        num_segments = math.ceil(duration_ms / segment_length_ms)
-        logger.info(f'num_segments (from duration): {num_segments}')
+        command += ['-ar', str(frame_rate)]
+    command += ['-c:a', 'libopus', '-f', 'opus', out_path]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'ffmpeg failed to cut {start_s}-{end_s}s of {file_path}: {result.stderr.strip()}')
+    return out_path
+
 
-    # Create segments directory if it does not exist
+def export_ranges(file_path, ranges, segments_dir, frame_rate=None, max_workers=AUDIO_WORKERS, input_options=[]):
+    """
+    Cuts {i: (start_s, end_s)} of file_path into segments_dir/segment_<i>.opus, max_workers ffmpeg at once.
+
+    Returns:
+        dict: i -> path of the segment.
+    """
     os.makedirs(segments_dir, exist_ok=True)
 
     def process_segment(i):
-        logger.info(f"Cutting segment {i+1}/{num_segments}")
-        if not len(chapters):
-            start_ms = i * segment_length_ms
-            end_ms = min(start_ms + segment_length_ms, duration_ms)
-        else:
-            start_ms = int(chapters[i]['start_time'] * 1000)
-            end_ms = int(chapters[i]['end_time'] * 1000)
-            
-        segment = audio[start_ms:end_ms]
-        segment.export(f"{segments_dir}/segment_{i}.opus", format="opus")
-        return segment
+        logger.info(f"Cutting segment {i+1}/{len(ranges)}")
+        start_s, end_s = ranges[i]
+        return export_range(file_path, start_s, end_s, f"{segments_dir}/segment_{i}.opus", frame_rate, input_options)
 
-    # Cut the audio into segments and save them using multithreading
-    with ThreadPoolExecutor(max_workers=30) as executor:
-        segments = list(executor.map(process_segment, range(num_segments)))
+    # the threads only wait for their ffmpeg, the decoding runs in parallel in the ffmpeg processes
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(ranges, executor.map(process_segment, ranges)))
 
-    return segments
 
+def segment_ranges(duration_s, chapters=[], segment_length_s=120):
+    """ (start_s, end_s) of every segment : the chapters if any, fixed length segments otherwise. """
+    if len(chapters):
+        return [(chapter['start_time'], chapter['end_time']) for chapter in chapters]
+    num_segments = math.ceil(duration_s / segment_length_s)
+    return [(i * segment_length_s, min((i + 1) * segment_length_s, duration_s)) for i in range(num_segments)]
 
 
+def cut_audio(file_path, chapters=[],segment_length_s=120, frame_rate=None, segments_dir='segments', max_workers=AUDIO_WORKERS):
+    """
+    Cuts file_path into segments_dir/segment_<i>.opus, one per chapter or one every segment_length_s.
+    The file is never decoded as a whole : every segment is a separate ffmpeg seeking to its range,
+    max_workers of them at once.
 
+    Returns:
+        list: the paths of the segments, in order.
+    """
+    logger.info('cutting audio')
+    duration_s = audio_duration_s(file_path)
+    ranges = segment_ranges(duration_s, chapters, segment_length_s)
+    logger.info(f'duration_s: {duration_s}, num_segments: {len(ranges)} (from {"chapters" if len(chapters) else "duration"}), {max_workers} workers')
 
+    paths = export_ranges(file_path, dict(enumerate(ranges)), segments_dir, frame_rate, max_workers)
+    return [paths[i] for i in range(len(ranges))]
@@ -1,10 +1,12 @@
 import asyncio
-import sys
 
 
-import applemusicpy
+import time
+import jwt
 
 from web.lib.utils import safe_get
+from web.lib.av_apis.http_client import get_http_client
+from web.lib.spans import count
 import os
 import dotenv
 
@@ -17,14 +19,22 @@ logger = logging.getLogger('root')
 
 APPLE_KEY_ID = os.getenv('APPLE_KEY_ID')
 APPLE_TEAM_ID = os.getenv('APPLE_TEAM_ID')
-APPLE_PRIVATE_KEY = os.getenv('APPLE_PRIVATE_KEY').replace("\\n", "\n")
+APPLE_PRIVATE_KEY = (os.getenv('APPLE_PRIVATE_KEY') or '').replace("\\n", "\n")
 APPLE_TOKEN_EXPIRY_LENGTH = os.getenv('APPLE_TOKEN_EXPIRY_LENGTH')  # 6 months
+APPLE_MUSIC_API_URL = os.getenv('APPLE_MUSIC_API_URL', 'https://api.music.apple.com/v1') # overridable to point at a local stub (api_stub.py)
+APPLE_STOREFRONT = 'us'
+APPLE_MAX_IDS_PER_REQUEST = 300 # catalog songs endpoint limit
+APPLE_SESSION_LENGTH = 12 * 3600 # same as applemusicpy
 
 #os.environ.pop("APPLE_PRIVATE_KEY", None)
 
-if not all([APPLE_KEY_ID, APPLE_TEAM_ID, APPLE_PRIVATE_KEY]):
-    logger.error("Error: One or more environment variables are not set.")
-    sys.exit(1)
+def apple_keys_configured() -> bool:
+    return all([APPLE_KEY_ID, APPLE_TEAM_ID, APPLE_PRIVATE_KEY])
+
+
+if not apple_keys_configured():
+    # not fatal : the processes that never call Apple (most workers) still start, the Apple calls return nothing
+    logger.warning("Apple Music keys are not set (APPLE_KEY_ID, APPLE_TEAM_ID, APPLE_PRIVATE_KEY), Apple data will be skipped.")
 
 
 # logger.info(f'APPLE_KEY_ID: {APPLE_KEY_ID}')
@@ -34,38 +44,13 @@ if not all([APPLE_KEY_ID, APPLE_TEAM_ID, APPLE_PRIVATE_KEY]):
 # print(APPLE_PRIVATE_KEY)
 # sys.exit(1)
 
-def am_songs(song_ids_list: list) -> dict:
+def parse_am_songs(results: dict) -> dict:
+    """ Turns an Apple Music catalog songs response into a dict apple id -> track fields. """
     def convert_and_check(value, multiplier=100): # conver from 0 to 1 to 0 to 100
         return int(value * multiplier) if value is not None else None
 
-    
-
-    keys = {
-            'APPLE_KEY_ID': APPLE_KEY_ID,
-            'APPLE_TEAM_ID': APPLE_TEAM_ID,
-            'APPLE_PRIVATE_KEY': APPLE_PRIVATE_KEY
-        }
-    
-        
-    try:
-       
-        am = applemusicpy.AppleMusic(APPLE_PRIVATE_KEY, APPLE_KEY_ID, APPLE_TEAM_ID )
-    except Exception as e:
-        logger.error(f'error connecting to AppleMusic : {e}, {APPLE_KEY_ID}, {APPLE_TEAM_ID}, {APPLE_PRIVATE_KEY}')
-        return {}
-        
-    
-    try:
-        
-
-        results = am.songs(song_ids_list)
-          
-    except Exception as e:
-        logger.error(f'error in am_songs: {e}')
-        results = {}
-
     out = {}
-    for item in results['data']:
+    for item in results.get('data', []):
         id_apple = safe_get(item, ['attributes','playParams', 'id'])
         genres =  safe_get(item, ['attributes','genreNames'])
         release_date = safe_get(item, ['attributes','releaseDate'])
@@ -91,9 +76,79 @@ def am_songs(song_ids_list: list) -> dict:
             'duration_s': convert_and_check(safe_get(item, ['attributes','durationInMillis']),0.001),
         }
         out[id_apple] = inf
+
+    return out
+
+
+def am_songs(song_ids_list: list) -> dict:
+    if not apple_keys_configured():
+        return {}
+    try:
+        import applemusicpy # heavy, only imported by the workers that use it
+        am = applemusicpy.AppleMusic(APPLE_PRIVATE_KEY, APPLE_KEY_ID, APPLE_TEAM_ID )
+        am.root = f'{APPLE_MUSIC_API_URL}/'
+    except Exception as e:
+        logger.error(f'error connecting to AppleMusic : {e}, {APPLE_KEY_ID}, {APPLE_TEAM_ID}, {APPLE_PRIVATE_KEY}')
+        return {}
         
     
+    try:
+        
+
+        count('external_calls')
+        results = am.songs(song_ids_list)
+          
+    except Exception as e:
+        logger.error(f'error in am_songs: {e}')
+        results = {}
 
+    return parse_am_songs(results)
+
+
+apple_token = {} # developer token of the async calls. {'token':..., 'expires_at':...}
+
+def apple_developer_token() -> str:
+    """ Same token as the one applemusicpy generates, cached until it expires. """
+    if apple_token.get('token') and apple_token.get('expires_at', 0) > time.time() + 60:
+        return apple_token['token']
+
+    now = int(time.time())
+    headers = {'alg': 'ES256', 'kid': APPLE_KEY_ID}
+    payload = {'iss': APPLE_TEAM_ID, 'iat': now, 'exp': now + APPLE_SESSION_LENGTH}
+    apple_token['token'] = jwt.encode(payload, APPLE_PRIVATE_KEY, algorithm='ES256', headers=headers)
+    apple_token['expires_at'] = now + APPLE_SESSION_LENGTH
+    return apple_token['token']
+
+
+async def am_songs_async(song_ids_list: list) -> dict:
+    """ Async version of am_songs, through the shared aiohttp session. Ids are requested by chunks of 300. """
+    if not apple_keys_configured():
+        return {}
+    try:
+        token = apple_developer_token()
+    except Exception as e:
+        logger.error(f'error generating AppleMusic token : {e}, {APPLE_KEY_ID}, {APPLE_TEAM_ID}')
+        return {}
+
+    client = get_http_client()
+    headers = {'Authorization': f'Bearer {token}'}
+
+    async def fetch(ids):
+        url = f'{APPLE_MUSIC_API_URL}/catalog/{APPLE_STOREFRONT}/songs'
+        try:
+            async with client.get(url, params={'ids': ','.join(ids)}, headers=headers) as resp:
+                if resp.status != 200:
+                    logger.error(f'error in am_songs_async: {resp.status} {await resp.text()}')
+                    return {}
+                return parse_am_songs(await resp.json())
+        except Exception as e:
+            logger.error(f'error in am_songs_async: {e}')
+            return {}
+
+    chunks = [song_ids_list[i:i + APPLE_MAX_IDS_PER_REQUEST] for i in range(0, len(song_ids_list), APPLE_MAX_IDS_PER_REQUEST)]
+    out = {}
+    for result in await asyncio.gather(*[fetch(chunk) for chunk in chunks]):
+        out.update(result)
     return out
 
 
@@ -113,21 +168,19 @@ def add_apple_track_data_from_json(tracks):
     return tracks
 
 async def add_apple_track_data_from_json_async(tracks):
-    """ Async wrapper for add_apple_track_data_from_json """
-    return await asyncio.to_thread(add_apple_track_data_from_json, tracks)
-
-
-async def add_apple_track_data_one(track):
-    """ Async wrapper for add_apple_track_data_from_json """
-    ret = await asyncio.to_thread(add_apple_track_data_from_json, [track])
-    return ret[0]
-
-
+    """ Async version of add_apple_track_data_from_json """
+    key_apple_tracks = [song["key_track_apple"] for song in tracks]
+    key_apple_tracks = list(set(filter(None, key_apple_tracks)))
 
+    apple_tracks_info = await am_songs_async(key_apple_tracks) if key_apple_tracks else {}
 
+    for song in tracks:
+        song.update(apple_tracks_info.get(song["key_track_apple"], {}))
 
+    return tracks
 
 
-    
-    
-    
\ No newline at end of file
+async def add_apple_track_data_one(track):
+    """ Async version of add_apple_track_data_from_json, for one track """
+    ret = await add_apple_track_data_from_json_async([track])
+    return ret[0]
@@ -0,0 +1,125 @@
+import asyncio
+import os
+import weakref
+
+import aiohttp
+from aiohttp_retry import ExponentialRetry, RetryClient
+from shazamio import HTTPClient, Shazam
+from shazamio.exceptions import BadMethod
+from shazamio.utils import validate_json
+
+from web.lib.spans import count
+from web.lib.metrics import count_external_request, service_from_host
+
+import logging
+logger = logging.getLogger('root')
+
+# One aiohttp session (and connection pool) per event loop, shared by the Shazam, Spotify and Apple calls.
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 100))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv('HTTP_MAX_CONNECTIONS_PER_HOST', 50))
+HTTP_TIMEOUT_S = int(os.getenv('HTTP_TIMEOUT_S', 30))
+# Replaces the Shazam hosts in the shazamio urls, to point them at a local stub (api_stub.py)
+SHAZAM_API_URL = os.getenv('SHAZAM_API_URL')
+SHAZAM_HOSTS = ('https://amp.shazam.com', 'https://www.shazam.com', 'https://cdn.shazam.com')
+
+DEFAULT_RETRY_OPTIONS = ExponentialRetry(attempts=20, max_timeout=60, statuses={500, 502, 503, 504, 429})
+
+_clients = weakref.WeakKeyDictionary()  # event loop -> RetryClient
+_locks = weakref.WeakKeyDictionary()  # event loop -> {name: asyncio.Lock}
+
+
+async def count_request(session, context, params):
+    count('external_calls')
+
+
+async def count_response_chunk(session, context, params):
+    count('bytes_downloaded', len(params.chunk))
+
+
+async def count_request_end(session, context, params):
+    count_external_request(service_from_host(params.url.host), params.response.status < 400)
+
+
+async def count_request_exception(session, context, params):
+    count_external_request(service_from_host(params.url.host), False)
+
+
+def get_http_client() -> RetryClient:
+    """
+    Returns the RetryClient bound to the running event loop, creating it on first use.
+    Every call made from the same loop goes through the same connection pool.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client._client.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_MAX_CONNECTIONS, limit_per_host=HTTP_MAX_CONNECTIONS_PER_HOST)
+        trace_config = aiohttp.TraceConfig()  # feeds the insert_set spans and the external requests metrics
+        trace_config.on_request_start.append(count_request)
+        trace_config.on_response_chunk_received.append(count_response_chunk)
+        trace_config.on_request_end.append(count_request_end)
+        trace_config.on_request_exception.append(count_request_exception)
+        session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT_S), trace_configs=[trace_config])
+        client = RetryClient(client_session=session, retry_options=DEFAULT_RETRY_OPTIONS, raise_for_status=False)
+        _clients[loop] = client
+        logger.debug(f'Created shared http client (limit={HTTP_MAX_CONNECTIONS}, limit_per_host={HTTP_MAX_CONNECTIONS_PER_HOST})')
+    return client
+
+
+def get_loop_lock(name: str) -> asyncio.Lock:
+    """ Returns a lock named `name`, unique to the running event loop. """
+    loop = asyncio.get_running_loop()
+    locks = _locks.setdefault(loop, {})
+    if name not in locks:
+        locks[name] = asyncio.Lock()
+    return locks[name]
+
+
+async def close_http_client():
+    """ Closes the shared session of the running event loop, if any. """
+    loop = asyncio.get_running_loop()
+    client = _clients.pop(loop, None)
+    _locks.pop(loop, None)
+    if client is not None:
+        await client.close()
+
+
+def run_async(coro):
+    """
+    Runs a coroutine to completion in a fresh event loop from sync code,
+    closing the shared http session before the loop goes away.
+    """
+    async def runner():
+        try:
+            return await coro
+        finally:
+            await close_http_client()
+
+    return asyncio.run(runner())
+
+
+def shazam_url(url: str) -> str:
+    if SHAZAM_API_URL:
+        for host in SHAZAM_HOSTS:
+            if url.startswith(host):
+                return SHAZAM_API_URL + url[len(host):]
+    return url
+
+
+class SharedHTTPClient(HTTPClient):
+    """ shazamio http client that goes through the shared session instead of opening one per request. """
+
+    def __init__(self, retry_options=None):
+        super().__init__(retry_options=retry_options or DEFAULT_RETRY_OPTIONS)
+
+    async def request(self, method: str, url: str, *args, **kwargs):
+        client = get_http_client()
+        method = str(getattr(method, 'value', method)).upper()
+        if method not in ('GET', 'POST'):
+            raise BadMethod("Accept only GET/POST")
+
+        async with client.request(method, shazam_url(url), retry_options=self.retry_options, **kwargs) as resp:
+            return await validate_json(resp, *args)
+
+
+def shazam_client(retry_options=None) -> Shazam:
+    return Shazam(http_client=SharedHTTPClient(retry_options))
@@ -1,8 +1,8 @@
 from aiohttp_retry import ExponentialRetry
-from shazamio import HTTPClient, Shazam
 from shazamio.exceptions import FailedDecodeJson, BadParseData,BadMethod
 import asyncio
 import os
+import threading
 import json
 import dotenv
 
@@ -10,7 +10,9 @@ from web.lib.utils import safe_get
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 dotenv.load_dotenv(dotenv_path)
 
-from web.lib.process_shazam_json import transform_track_data
+from web.lib.process_shazam_json import append_segment_result, latest_segment_results, segment_index, transform_track_data
+from web.lib.av_apis.http_client import close_http_client, run_async, shazam_client
+from web.lib.music_detector import classify_segment
 import logging
 logger = logging.getLogger('root')
 
@@ -41,7 +43,7 @@ async def shazam_track_add_label(track, semaphore, MAX_RETRIES=3, RETRY_DELAY=0,
             return track
         
         if not shazam:
-            shazam = Shazam()
+            shazam = shazam_client()
         logger.info(f"Getting label for track {track['title']}")
         
         retries = 0
@@ -98,7 +100,7 @@ async def shazam_related_tracks(track_id, limit=20,shazam=None):
     logger.info(f'Starting shazam_related_tracks for {track_id} with limit {limit}')
     try:
         if not shazam:
-            shazam = Shazam()
+            shazam = shazam_client()
             logger.info('Initialized Shazam client')
         
         related = await shazam.related_tracks(track_id=track_id, limit=limit, proxy=PROXY_URL)
@@ -127,11 +129,9 @@ async def shazam_related_tracks(track_id, limit=20,shazam=None):
 
 
 async def recognize_song(file_path, proxy, retries=1):
-    shazam = Shazam(
-        http_client=HTTPClient(
-            retry_options=ExponentialRetry(
-                attempts=5, max_timeout=204.8, statuses={500, 502, 503, 504, 429}
-            ),
+    shazam = shazam_client(
+        retry_options=ExponentialRetry(
+            attempts=5, max_timeout=204.8, statuses={500, 502, 503, 504, 429}
         ),
     )
     attempt = 0
@@ -148,49 +148,123 @@ async def recognize_song(file_path, proxy, retries=1):
                 return {"error": str(e)}
             
 
-async def process_segment(file, folder_path,results_folder_path,semaphore):
+async def process_segment(file, folder_path,results_path,semaphore,start_s=None,end_s=None):
     async with semaphore:
         file_path = os.path.join(folder_path, file)
-        out = await recognize_song(file_path,PROXY_URL)
+        classification = await asyncio.to_thread(classify_segment, file_path)
+        if classification['music']:
+            out = await recognize_song(file_path,PROXY_URL)
+        else: # no call, the segment stays unidentified (and is not recognized again)
+            logger.debug(f"Skipping {file}, not music (score {classification['music_score']:.2f})")
+            out = {'skipped': 'non-music', 'music_score': classification['music_score'], 'features': classification['features']}
         #print(out)
 
-        # Define the path for the output JSON file
-        output_file_path = os.path.join(results_folder_path, f"{os.path.splitext(file)[0]}.json")
+        # one line of the results log of the set
+        append_segment_result(results_path, segment_index(file), start_s, end_s, out)
 
-        # Write the output to a JSON file
-        with open(output_file_path, 'w') as json_file:
-            json.dump(out, json_file, indent=4)
+        logger.debug(f"Results for {os.path.basename(file)} saved to ...{os.path.basename(results_path)}")
+        return out
 
-        file_name = os.path.basename(file)
-        output_file_name = os.path.basename(output_file_path)
-        logger.debug(f"Results for {file_name} saved to ...{output_file_name}")
 
+def recognized_records(results_path):
+    """ segment index -> record of the results log, for the segments already recognized without an error. """
+    return {index: record for index, record in latest_segment_results(results_path).items() if 'error' not in record['result']}
 
-async def process_segments(folder_path,results_path):
+
+def recognized_segments(results_path):
+    """ segment index -> Shazam result, for the segments of the results log already recognized without an error. """
+    return {index: record['result'] for index, record in recognized_records(results_path).items()}
+
+
+async def process_segments(folder_path,results_path,ranges={}):
+    """ Recognizes the segments of folder_path not in the results log yet. ranges: segment index -> (start_s, end_s) in the set. """
     logger.debug(f'process_segments from folder_path {folder_path} to results_path {results_path}')
-    files = [f for f in os.listdir(folder_path) if f.endswith('.opus')]
-    sorted_files = sorted(files)
+    # segments recognized while downloading (SegmentRecognizer) already have their results
+    recognized = recognized_segments(results_path)
+    files = [f for f in os.listdir(folder_path) if f.endswith('.opus') and segment_index(f) not in recognized]
+    sorted_files = sorted(files, key=segment_index)
     
     semaphore = asyncio.Semaphore(30) # Limit the number of concurrent tasks to 10
     # Create a list of tasks for each file
-    tasks = [process_segment(file, folder_path,results_path,semaphore) for file in sorted_files]
+    tasks = [process_segment(file, folder_path,results_path,semaphore,*ranges.get(segment_index(file), (None, None))) for file in sorted_files]
 
     # Run tasks concurrently
     await asyncio.gather(*tasks)
 
-def sync_process_segments(folder_path,results_path):
+def sync_process_segments(folder_path,results_path,ranges={}):
     logger.info('sync_process_segments')
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    result = loop.run_until_complete(process_segments(folder_path,results_path))
-    loop.close()
-    return result
+    return run_async(process_segments(folder_path,results_path,ranges))
+
+
+class SegmentRecognizer:
+    """
+    Recognizes segments as they are submitted, from sync code (the download loop), in an event loop of its own thread.
+    Results are appended to the results log like process_segments does, and the shazam key of every recognized segment is kept in self.keys.
+    A segment Shazam failed on (error result) is only counted in self.nb_errors : it says nothing of the set.
+
+        with SegmentRecognizer(results_path) as recognizer:
+            recognizer.submit(segment_path, start_s, end_s)
+    """
+
+    def __init__(self, results_path, max_concurrent=30):
+        self.results_path = results_path
+        self.max_concurrent = max_concurrent
+        self.keys = {} # segment file -> shazam track key, None if not identified
+        self.nb_errors = 0
+        self.futures = []
+        self.submitted = set()
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.results_path) or '.', exist_ok=True)
+        self.recognized = recognized_records(self.results_path) # sampled before the download
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.semaphore = asyncio.run_coroutine_threadsafe(self.make_semaphore(), self.loop).result()
+        return self
+
+    async def make_semaphore(self):
+        return asyncio.Semaphore(self.max_concurrent)
+
+    async def recognize(self, segment_path, start_s, end_s):
+        file = os.path.basename(segment_path)
+        out = await process_segment(file, os.path.dirname(segment_path), self.results_path, self.semaphore, start_s, end_s)
+        if 'error' in out:
+            self.nb_errors += 1
+            return
+        self.keys[file] = safe_get(out, ['track', 'key'])
+
+    def submit(self, segment_path, start_s=None, end_s=None):
+        if segment_path in self.submitted: # the download was retried, the segment is the same
+            return
+        self.submitted.add(segment_path)
+        file = os.path.basename(segment_path)
+        record = self.recognized.get(segment_index(file))
+        # a result is reused for the same range only
+        if record and (start_s is None or (record['start_s'], record['end_s']) == (start_s, end_s)):
+            self.keys[file] = safe_get(record['result'], ['track', 'key'])
+            return
+        self.futures.append(asyncio.run_coroutine_threadsafe(self.recognize(segment_path, start_s, end_s), self.loop))
+
+    def __exit__(self, exc_type, exc, tb):
+        for future in self.futures:
+            if exc_type:
+                future.cancel()
+                continue
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f'Error recognizing a segment: {e}')
+        asyncio.run_coroutine_threadsafe(close_http_client(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
 
 
 async def shazam_search_track(track_name,  semaphore, MAX_RETRIES=3, RETRY_DELAY=0,shazam=None):
     async with semaphore:
         if not shazam:
-            shazam = Shazam()
+            shazam = shazam_client()
         logger.info(f"Searching for track: {track_name}")
 
         retries = 0
@@ -1,5 +1,6 @@
 import asyncio
 from itertools import islice
+import aiohttp
 import json
 import os
 import time
@@ -11,6 +12,9 @@ from spotipy import SpotifyException
 from spotipy.oauth2 import SpotifyClientCredentials,SpotifyOAuth
 from web.lib.utils import extract_full_date, extract_year, safe_get
 from web.lib.log_config import setup_logging;setup_logging()
+from web.lib.av_apis.http_client import get_http_client, get_loop_lock
+from web.lib.spans import count
+from web.lib.metrics import count_external_request
 import logging
 import dotenv,os
 
@@ -19,6 +23,9 @@ dotenv.load_dotenv(dotenv_path)
 logger = logging.getLogger('root')
 
 SPOTIPY_REDIRECT_URI = os.getenv('SPOTIPY_REDIRECT_URI') #'http://localhost:50001/spotify_callback'
+SPOTIFY_API_URL = os.getenv('SPOTIFY_API_URL', 'https://api.spotify.com/v1') # overridable to point at a local stub (api_stub.py)
+SPOTIFY_ACCOUNTS_URL = os.getenv('SPOTIFY_ACCOUNTS_URL', 'https://accounts.spotify.com/api/token')
+SPOTIFY_MAX_CONCURRENT_REQUESTS = int(os.getenv('SPOTIFY_MAX_CONCURRENT_REQUESTS', 20))
 PROXY_URL = os.getenv('SHAZAM_PROXY_URL')
 
 # Scope for the data you want to access and modify
@@ -30,8 +37,17 @@ proxies = {
     'https': PROXY_URL
 }
 
-client_credentials_manager = SpotifyClientCredentials(client_id=os.getenv('SPOTIFY_CLIENT_ID'), client_secret=os.getenv('SPOTIFY_CLIENT_SECRET'))
-sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager) 
+spotify_clients = {} # client credentials client of the sync calls, created on first use : importing this module needs no keys
+
+
+def spotify_client():
+    if 'sp' not in spotify_clients:
+        client_credentials_manager = SpotifyClientCredentials(client_id=os.getenv('SPOTIFY_CLIENT_ID'), client_secret=os.getenv('SPOTIFY_CLIENT_SECRET'))
+        client_credentials_manager.OAUTH_TOKEN_URL = SPOTIFY_ACCOUNTS_URL
+        sp = spotipy.Spotify(client_credentials_manager=client_credentials_manager) 
+        sp.prefix = f'{SPOTIFY_API_URL}/'
+        spotify_clients['sp'] = sp
+    return spotify_clients['sp']
 
 
 
@@ -80,7 +96,7 @@ def add_tracks_audio_features_spotify(tracks):
     logger.info(track_ids)
     try:
         logger.info('Getting audio features from Spotify...')
-        audio_features = sp.audio_features(track_ids)
+        audio_features = spotify_client().audio_features(track_ids)
         
        
     except SpotifyException as e:
@@ -146,7 +162,9 @@ def add_tracks_and_artist_spotify(track_title, artist_name,write_to_file=False):
     song_id = None
 
     try:
-        song_info = sp.search(q=f'track:{track_title}, {artist_name}', type='track', limit=1)
+        count('external_calls')
+        song_info = spotify_client().search(q=f'track:{track_title}, {artist_name}', type='track', limit=1)
+        count_external_request('spotify', True)
         if song_info['tracks']['total'] > 0:        
             song = song_info['tracks']['items'][0]        
             song_id = song['id']
@@ -156,6 +174,7 @@ def add_tracks_and_artist_spotify(track_title, artist_name,write_to_file=False):
             
         
     except SpotifyException as e:
+        count_external_request('spotify', False)
         logging.error(f'Error finding Spotify song : "{track_title}": {e}')
 
     except Exception as e:
@@ -165,12 +184,15 @@ def add_tracks_and_artist_spotify(track_title, artist_name,write_to_file=False):
 
 
     try:
-        artist_info = sp.search(q=f'artist_name:{artist_name}', type='artist', limit=1)
+        count('external_calls')
+        artist_info = spotify_client().search(q=f'artist_name:{artist_name}', type='artist', limit=1)
+        count_external_request('spotify', True)
         artist_fields = artist_info['artists']['items'][0]
         artist_id = artist_fields['id']
         artist_genres = artist_fields['genres']
         artist_popularity = artist_fields['popularity'] 
     except SpotifyException as e:
+        count_external_request('spotify', False)
         logging.error(f'{e}')
     except Exception as e:
         logging.error(f'Artist fields not found "{artist_name}": {e}')
@@ -242,9 +264,87 @@ def add_tracks_and_artist_spotify(track_title, artist_name,write_to_file=False):
 import concurrent.futures
 
 
+spotify_token = {}  # client credentials token of the async calls. {'access_token':..., 'expires_at':...}
+
+async def spotify_access_token():
+    """
+    Returns a client credentials token for the Spotify Web API, shared by all the calls of the running loop.
+    Refreshed a minute before it expires.
+    """
+    async with get_loop_lock('spotify_token'):
+        if spotify_token.get('access_token') and spotify_token.get('expires_at', 0) > time.time() + 60:
+            return spotify_token['access_token']
+
+        client = get_http_client()
+        auth = aiohttp.BasicAuth(os.getenv('SPOTIFY_CLIENT_ID'), os.getenv('SPOTIFY_CLIENT_SECRET'))
+        async with client.post(SPOTIFY_ACCOUNTS_URL, data={'grant_type': 'client_credentials'}, auth=auth) as resp:
+            if resp.status != 200:
+                raise SpotifyException(resp.status, -1, f'Error getting Spotify token: {await resp.text()}')
+            token_info = await resp.json()
+
+        spotify_token['access_token'] = token_info['access_token']
+        spotify_token['expires_at'] = time.time() + token_info.get('expires_in', 3600)
+        return spotify_token['access_token']
+
+
+async def spotify_search_async(q, search_type, limit=1):
+    """ Same as sp.search, through the shared aiohttp session. """
+    token = await spotify_access_token()
+    client = get_http_client()
+    params = {'q': q, 'type': search_type, 'limit': limit}
+    async with client.get(f'{SPOTIFY_API_URL}/search', params=params, headers={'Authorization': f'Bearer {token}'}) as resp:
+        if resp.status != 200:
+            raise SpotifyException(resp.status, -1, f'Spotify search error: {await resp.text()}')
+        return await resp.json()
+
+
+async def async_add_tracks_and_artist_spotify(track_title, artist_name):
+    """ Async version of add_tracks_and_artist_spotify. Track and artist searches run concurrently. """
+    song, artist_fields = {}, {}
+
+    song_info, artist_info = await asyncio.gather(
+        spotify_search_async(f'track:{track_title}, {artist_name}', 'track'),
+        spotify_search_async(f'artist_name:{artist_name}', 'artist'),
+        return_exceptions=True
+    )
+
+    if isinstance(song_info, Exception):
+        logger.error(f'Error finding Spotify song : "{track_title}": {song_info}')
+    elif safe_get(song_info, ['tracks', 'total'], 0) > 0:
+        song = song_info['tracks']['items'][0]
+        logger.info(f'Song found by Spotify : "{track_title}", id: {song["id"]}')
+    else:
+        logger.info(f'Song not found by Spotify : "{track_title}"')
+
+    if isinstance(artist_info, Exception):
+        logger.error(f'Artist fields not found "{artist_name}": {artist_info}')
+    else:
+        artist_fields = safe_get(artist_info, ['artists', 'items', 0], {})
 
-async def async_add_track_spotify_info(track):
-    return await asyncio.to_thread(add_track_spotify_info, track)
+    return {
+        'key_track_spotify': song.get('id'),
+        'key_artist_spotify': artist_fields.get('id'),
+        'preview_uri_spotify': song.get('preview_url'),
+        'album': safe_get(song, ['album', 'name']),
+        'cover_art_spotify': safe_get(song, ['album', 'images', 0, 'url']),
+        'release_date': safe_get(song, ['album', 'release_date']),
+        'artist_genres_spotify': artist_fields.get('genres'),
+        'artist_popularity_spotify': artist_fields.get('popularity'),
+        'duration_ms': song.get('duration_ms'),
+    }
+
+
+async def async_add_track_spotify_info(track, semaphore=None):
+    if track and 'title' in track and 'artist_name' in track:
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(SPOTIFY_MAX_CONCURRENT_REQUESTS)
+        async with semaphore:
+            song_info = await async_add_tracks_and_artist_spotify(track['title'], track['artist_name'])
+        if song_info:
+            track.update(song_info)
+        else:
+            logger.error(f'Error adding Spotify data to track: {track}')
+    return track
 
 
 def add_track_spotify_info(track):
@@ -258,18 +358,9 @@ def add_track_spotify_info(track):
                 # @TODO : add error handling
         return track
 
-def add_tracks_spotify_data_from_json(tracks_json,try_count=0,max_tries=3):
-    
-    #json.dump(tracks_json, open('tracks.json', 'w'), indent=4)
-    
-    def first_match(tracks,title,artist):
-        first_match = None
-        for track in tracks:
-            if track['title'] == title and track['artist_name'] == artist:
-                first_match = track
-                break
-        return first_match
-   
+
+def unique_tracks_by_title_artist(tracks_json):
+    """ Returns a dict title+artist_name -> first track with that title and artist. """
     tracks_unique = {}
     try:
         for track in tracks_json:
@@ -279,7 +370,50 @@ def add_tracks_spotify_data_from_json(tracks_json,try_count=0,max_tries=3):
                     tracks_unique[key] = track
     except Exception as e:
         logger.error(f'Error creating unique tracks: {e}')
-        
+    return tracks_unique
+
+
+def merge_spotify_data_into_tracks(tracks_json, tracks_unique, processed_tracks):
+    """ Copies the Spotify data of the processed unique tracks back onto every track of tracks_json. """
+
+    def first_match(tracks,title,artist):
+        first_match = None
+        for track in tracks:
+            if track['title'] == title and track['artist_name'] == artist:
+                first_match = track
+                break
+        return first_match
+
+    try:
+        for original_track in tracks_json:
+            if original_track and 'title' in original_track and 'artist_name' in original_track and original_track['title'] and original_track['artist_name']:
+                key = original_track['title'] + original_track['artist_name']
+                if key in tracks_unique:
+                    updated_info = first_match(processed_tracks,original_track['title'],original_track['artist_name'])
+                    
+                    if updated_info:
+                        # keep the start_time and end_time
+                        # Otherwise, repeated songs would get the same start_time and end_time
+                        # Need this check because this also runs on the related tracks, which don't have start_time and end_time
+                        if 'start_time' in original_track and 'end_time' in original_track:
+                            start_time = original_track['start_time']
+                            end_time = original_track['end_time']
+                            
+                        original_track.update(updated_info)
+                        
+                        if 'start_time' in original_track and 'end_time' in original_track:
+                            original_track['start_time'] = start_time
+                            original_track['end_time'] = end_time
+    except Exception as e:
+        logger.error(f'Error updating original tracks: {e}')
+    return tracks_json
+
+
+def add_tracks_spotify_data_from_json(tracks_json,try_count=0,max_tries=3):
+    
+    #json.dump(tracks_json, open('tracks.json', 'w'), indent=4)
+    
+    tracks_unique = unique_tracks_by_title_artist(tracks_json)
                 
     logger.info(f'Adding Spotify data to {len(tracks_unique)} unique tracks. Vs {len(tracks_json)} tracks total.')
 
@@ -290,30 +424,7 @@ def add_tracks_spotify_data_from_json(tracks_json,try_count=0,max_tries=3):
         with concurrent.futures.ThreadPoolExecutor() as executor:
             processed_tracks = list(executor.map(add_track_spotify_info, tracks_unique.values()))
             
-
-        try:
-            for original_track in tracks_json:
-                if original_track and 'title' in original_track and 'artist_name' in original_track and original_track['title'] and original_track['artist_name']:
-                    key = original_track['title'] + original_track['artist_name']
-                    if key in tracks_unique:
-                        updated_info = first_match(processed_tracks,original_track['title'],original_track['artist_name'])
-                        
-                        if updated_info:
-                            # keep the start_time and end_time
-                            # Otherwise, repeated songs would get the same start_time and end_time
-                            # Need this check because this also runs on the related tracks, which don't have start_time and end_time
-                            if 'start_time' in original_track and 'end_time' in original_track:
-                                start_time = original_track['start_time']
-                                end_time = original_track['end_time']
-                                
-                            original_track.update(updated_info)
-                            
-                            if 'start_time' in original_track and 'end_time' in original_track:
-                                original_track['start_time'] = start_time
-                                original_track['end_time'] = end_time
-        except Exception as e:
-            logger.error(f'Error updating original tracks: {e}')
-            
+        merge_spotify_data_into_tracks(tracks_json, tracks_unique, processed_tracks)
             
         logger.info('Spotify data added to tracks.')
         #logger.info('Adding audio features...')
@@ -343,9 +454,20 @@ def add_tracks_spotify_data_from_json(tracks_json,try_count=0,max_tries=3):
     return tracks_json
 
 
-async def add_tracks_spotify_data_from_json_async(tracks_json, try_count=0, max_tries=3):
-    """ Async wrapper for add_tracks_spotify_data_from_json """
-    return await asyncio.to_thread(add_tracks_spotify_data_from_json, tracks_json, try_count, max_tries)
+async def add_tracks_spotify_data_from_json_async(tracks_json, max_concurrent_requests=SPOTIFY_MAX_CONCURRENT_REQUESTS):
+    """ Async version of add_tracks_spotify_data_from_json. Searches go through the shared aiohttp session, no threads. """
+    tracks_unique = unique_tracks_by_title_artist(tracks_json)
+    logger.info(f'Adding Spotify data to {len(tracks_unique)} unique tracks. Vs {len(tracks_json)} tracks total.')
+
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+    try:
+        processed_tracks = await asyncio.gather(*[async_add_track_spotify_info(track, semaphore) for track in tracks_unique.values()])
+        merge_spotify_data_into_tracks(tracks_json, tracks_unique, processed_tracks)
+        logger.info('Spotify data added to tracks.')
+    except Exception as e:
+        logger.error(f'error: {e}')
+
+    return tracks_json
 
 
 
@@ -1,12 +1,22 @@
 import logging, dotenv, os
+import copy
+import json
+import math
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
 from venv import logger
 import requests
 import re
-from yt_dlp import YoutubeDL
 import xml.etree.ElementTree as ET
 
 from web.lib.utils import is_dev_env
+from web.lib.audio import ffmpeg_binary
 
 # for list of options see https://github.com/ytdl-org/youtube-dl/blob/3e4cedf9e8cd3157df2457df7274d0c842421945/youtube_dl/YoutubeDL.py#L137-L312
 
@@ -16,6 +26,20 @@ PROXY_URL = os.getenv('SHAZAM_PROXY_URL')
 PROXY_URL_SOCKS5 = os.getenv('PROXY_URL_SOCKS5')
 PROXY_URL_HTTP = os.getenv('PROXY_URL_HTTP')
 
+# Audio only, in the codec YouTube serves it in : opus (webm) first, then aac (m4a). Never transcoded before the segments.
+YOUTUBE_AUDIO_FORMAT = 'bestaudio[acodec=opus]/bestaudio[ext=m4a]/bestaudio'
+FULL_AUDIO_NAME = 'full.mka' # any audio codec, as downloaded
+DOWNLOAD_POLL_S = 1 # how often the segments of a running download are checked
+# yt-dlp cache (player code, signature functions), shared by every worker instead of one per user home / container
+YTDLP_CACHE_DIR = os.getenv('YTDLP_CACHE_DIR', os.path.join(os.getcwd(), 'yt_dlp_cache'))
+# Videos resolved at once by youtube_video_infos, each thread with its own long lived YoutubeDL
+YOUTUBE_INFO_WORKERS = int(os.getenv('YOUTUBE_INFO_WORKERS', 4))
+# A stored extraction is reused by the download only if its stream urls are valid for that long still
+YTDLP_EXTRACTION_MARGIN_S = int(os.getenv('YTDLP_EXTRACTION_MARGIN_S', 1800))
+# What the download needs from an extraction (yt-dlp --load-info-json), the audio only formats are kept
+EXTRACTION_KEYS = ('id', 'title', 'duration', 'extractor', 'extractor_key', 'webpage_url', 'webpage_url_basename',
+                   'webpage_url_domain', 'original_url', 'display_id', 'epoch', '_type', '_version')
+
 logger = logging.getLogger('root')
 
 # Regular expressions for YouTube URL and video ID validation
@@ -97,6 +121,30 @@ def youtube_video_exists(input_str: str) -> bool:
     except requests.RequestException:
         return False
 
+def ydl_options(**options) -> dict:
+    """ YoutubeDL params shared by every call : proxy, quiet, and the shared cache dir. """
+    return {'proxy': PROXY_URL_HTTP, 'quiet': True, 'no_warnings': True, 'noplaylist': True, 'nocheckcertificate': True,
+            'cachedir': YTDLP_CACHE_DIR, **options}
+
+
+def audio_extraction(info: dict) -> dict:
+    """
+    The part of a yt-dlp extraction the download can start from without extracting the page again :
+    the audio only formats (deciphered urls, headers) and when their urls expire.
+    """
+    formats = [f for f in info.get('formats') or [] if f.get('vcodec') == 'none' and f.get('url')]
+    expires = [int(parse_qs(urlparse(f['url']).query)['expire'][0]) for f in formats if 'expire' in parse_qs(urlparse(f['url']).query)]
+    return {
+        'info': {**{key: info[key] for key in EXTRACTION_KEYS if key in info}, 'formats': formats},
+        'expires_at': min(expires) if expires else None,
+    }
+
+
+def extraction_is_valid(extraction, margin_s=YTDLP_EXTRACTION_MARGIN_S) -> bool:
+    return bool(extraction and extraction.get('info', {}).get('formats') and extraction.get('expires_at')
+                and extraction['expires_at'] - margin_s > time.time())
+
+
 # def youbube_video_info(video_id:str)->dict:
 #     properties_to_keep = ['upload_date','thumbnail', 'title','description','channel','','channel_id','channel_url','duration','playable_in_embed','chapters','channel_follower_count','like_count','view_count','is_live','availability','error']
 #     options = {'quiet':True,'no_warnings':True,'proxy':PROXY_URL }
@@ -119,7 +167,12 @@ def youtube_video_exists(input_str: str) -> bool:
 #         ret['video_id'] = video_id
 #         return ret
     
-def youbube_video_info(video_id: str, retry_count: int = 10) -> dict:
+def youbube_video_info(video_id: str, retry_count: int = 10, ydl=None) -> dict:
+    """
+    Video info for the queue. On success, ret['extraction'] (see audio_extraction) lets the download skip a new extraction.
+    ydl : a YoutubeDL to reuse (see youtube_video_infos), a new one is made otherwise.
+    """
+    from yt_dlp import YoutubeDL # heavy, only imported by the workers that use it
     #ua = UserAgent(platforms='pc')
     properties_to_keep = [
         'upload_date', 'thumbnail', 'title', 'description', 'channel', 
@@ -127,23 +180,23 @@ def youbube_video_info(video_id: str, retry_count: int = 10) -> dict:
         'chapters', 'channel_follower_count', 'like_count', 'view_count', 
         'is_live', 'availability', 'error'
     ]
-    options = {'quiet': True, 'no_warnings': True, 'noplaylist': True,'nocheckcertificate': True, 'proxy': PROXY_URL_HTTP, 
+    options = ydl_options(
                #'headers': {
               #  'User-Agent': ua.random,  # Random User-Agent for each request
                # 'Accept-Language': 'en-US,en;q=0.9',
               #  'Referer': 'https://www.youtube.com',
         #}
-               }
-    print(f'getting vid info with options {options} ')
+               )
+    logger.debug(f'getting vid info with options {options} ')
 
     attempt = 0
     while attempt < retry_count:
         #ua = UserAgent(platforms='pc')
         #options['headers']['User-Agent'] = ua.random
-        with YoutubeDL(params=options) as ydl:
+        with (nullcontext(ydl) if ydl else YoutubeDL(params=options)) as extractor:
             yt = f"https://www.youtube.com/watch?v={video_id}"
             try:
-                video_info = ydl.extract_info(yt, download=False)
+                video_info = extractor.extract_info(yt, download=False)
                 break  # Exit loop if successful
             except Exception as e:
                 video_info = {'video_id': video_id, 'error': str(e)}
@@ -159,6 +212,8 @@ def youbube_video_info(video_id: str, retry_count: int = 10) -> dict:
         if "not a bot" in e.lower():
             ret['error'] = e =  f"bot verification required after {retry_count} attempts"
         logger.error(f'Error getting video info for {video_id} : {e}')
+    else:
+        ret['extraction'] = audio_extraction(YoutubeDL.sanitize_info(video_info)) # json safe
 
     ret['video_id'] = video_id
     return ret
@@ -166,53 +221,66 @@ def youbube_video_info(video_id: str, retry_count: int = 10) -> dict:
  
 
 
-def download_youtube_video(id: str, vid_dir: str, retry_count: int = 10) -> str:
+def youtube_video_infos(video_ids: list, max_workers: int = YOUTUBE_INFO_WORKERS):
+    """
+    youbube_video_info of many videos, max_workers at once. Every thread keeps its YoutubeDL (and its cache,
+    cookies and connections) for all the videos it resolves.
+
+    Yields:
+        tuple: (video_id, video info), as they are resolved.
+    """
+    from yt_dlp import YoutubeDL
+    local = threading.local()
+    extractors = []
+
+    def resolve(video_id):
+        if not hasattr(local, 'ydl'):
+            local.ydl = YoutubeDL(params=ydl_options())
+            extractors.append(local.ydl)
+        return video_id, youbube_video_info(video_id, ydl=local.ydl)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for future in as_completed([executor.submit(resolve, video_id) for video_id in video_ids]):
+                yield future.result()
+    finally:
+        for extractor in extractors:
+            extractor.close()
+
+
+def download_youtube_video(id: str, vid_dir: str, retry_count: int = 10, extraction=None) -> str:
+    """
+    Downloads the audio only, in its native container (webm/opus or m4a/aac, no transcode), to vid_dir/full.<ext>.
+    See stream_youtube_audio to cut it into segments while it downloads.
+    A valid extraction (youbube_video_info) is used for the first attempt instead of extracting the page again.
+
+    Returns:
+        str: path of the downloaded file.
+    """
+    from yt_dlp import YoutubeDL # heavy, only imported by the workers that use it
    # ua = UserAgent(platforms='pc')
     def my_hook(d):
-        if d['status'] == 'downloading':
+        if d['status'] == 'downloading' and d.get('total_bytes'):
             logger.debug(f"{d['downloaded_bytes'] / d['total_bytes'] * 100:.2f}% downloaded")
     
-    options = {
-        'proxy': PROXY_URL_HTTP,
+    options = ydl_options(**{
         'progress_hooks': [my_hook],
         #'write-thumbnail': True,
-        'format': 'bestaudio/best',
+        'format': YOUTUBE_AUDIO_FORMAT,
         'outtmpl': f'{vid_dir}/full.%(ext)s',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'opus',
-            'preferredquality': '192', #'192',
-        }],
         'fragment-retries': 1,  # Reduce retries on fragment failure
         'retries': 3,           # General retries count for failed downloads
         'concurrent-fragments': 10,  # Download 5 fragments concurrently (default is 1)
         'http_chunk_size': 10 * 1024 * 1024,  # Chunk size (10MB for faster throughput)
-        'noplaylist': True,
-        'nocheckcertificate': True,
-        'quiet': True,  # Suppresses most of the output
         'skip-download': False,  # Forces the download without extra checks
        # 'headers': {
         #    'User-Agent': ua.random,  # Random User-Agent for each request
        #     'Accept-Language': 'en-US,en;q=0.9',
        #     'Referer': 'https://www.youtube.com',
        # },
-    }
-    
-    # Determine if running on localhost
-    is_localhost = is_dev_env()
-
-
-    if not is_localhost:
-        # Set the ffmpeg converter path dynamically for non-localhost environments
-        ffmpeg_path = f"{os.getcwd()}/ffmpeg/ffmpeg"
-        ffprobe_path = f"{os.getcwd()}/ffmpeg/ffprobe"
-        from yt_dlp.postprocessor import FFmpegPostProcessor
-        FFmpegPostProcessor._ffmpeg_location.set(ffmpeg_path)
-        
-        os.environ["PATH"] += os.pathsep + os.path.dirname(ffmpeg_path)
-        os.environ["PATH"] += os.pathsep + os.path.dirname(ffprobe_path)
-        print("PATH updated to include ffmpeg/ffprobe:", os.environ["PATH"])
-
+    })
+    if not is_dev_env():
+        options['ffmpeg_location'] = os.path.dirname(ffmpeg_binary()) # instead of adding it to the PATH of the process
     
     yt = f"https://www.youtube.com/watch?v={id}"
     
@@ -221,16 +289,154 @@ def download_youtube_video(id: str, vid_dir: str, retry_count: int = 10) -> str:
             #ua = UserAgent(platforms='pc')
             #options['headers']['User-Agent'] = ua.random
             with YoutubeDL(params=options) as ydl:
-                print(f"Downloading with options: {options}")
-                ydl.download([yt])
-                return f"{id}.opus"
+                logger.info(f"Downloading {id} with format {options['format']}")
+                if attempt == 0 and extraction_is_valid(extraction):
+                    info = ydl.process_ie_result(copy.deepcopy(extraction['info']), download=True)
+                else:
+                    info = ydl.extract_info(yt, download=True)
+                return ydl.prepare_filename(info)
         except Exception as e:
             logger.error(f"Attempt {attempt + 1} failed: {str(e)}")
             if attempt + 1 == retry_count:
                 raise e
             logger.info("Retrying...")
 
-    
+
+def youtube_audio_source(video_id: str, extraction=None):
+    """
+    Direct url of the audio stream of video_id (YOUTUBE_AUDIO_FORMAT), for ffmpeg to seek into without downloading the rest.
+    Picked from extraction if it is still valid, without any request to YouTube.
+
+    Returns:
+        tuple: (url, ffmpeg input options : the headers yt-dlp would send, and the proxy).
+    """
+    from yt_dlp import YoutubeDL
+    with YoutubeDL(params=ydl_options(format=YOUTUBE_AUDIO_FORMAT)) as ydl:
+        if extraction_is_valid(extraction):
+            info = ydl.process_ie_result(copy.deepcopy(extraction['info']), download=False)
+        else:
+            info = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
+    input_options = []
+    if info.get('http_headers'):
+        input_options += ['-headers', ''.join(f'{name}: {value}\r\n' for name, value in info['http_headers'].items())]
+    if PROXY_URL_HTTP:
+        input_options += ['-http_proxy', PROXY_URL_HTTP]
+    return info['url'], input_options
+
+
+def yt_dlp_stream_command(video_id: str, info_json_path: str = None) -> list:
+    """ yt-dlp writing the audio stream of video_id to its stdout, from a stored extraction if info_json_path is given. """
+    command = [sys.executable, '-m', 'yt_dlp', '--quiet', '--no-warnings', '--no-playlist', '--no-check-certificates',
+               '--cache-dir', YTDLP_CACHE_DIR, '--format', YOUTUBE_AUDIO_FORMAT,
+               '--retries', '3', '--fragment-retries', '1', '--http-chunk-size', '10M', '--output', '-']
+    if PROXY_URL_HTTP:
+        command += ['--proxy', PROXY_URL_HTTP]
+    if info_json_path:
+        return command + ['--load-info-json', info_json_path]
+    return command + [f'https://www.youtube.com/watch?v={video_id}']
+
+
+def segmenter_command(full_path: str, segments_dir: str, chapters=[], segment_length_s=120) -> list:
+    """
+    ffmpeg reading the stream on its stdin : a copy of it (no transcode) to full_path,
+    and the opus segments, cut at the chapters if any, every segment_length_s otherwise.
+    """
+    if len(chapters):
+        cuts = ['-segment_times', ','.join(f"{chapter['start_time']:.3f}" for chapter in chapters[1:])]
+    else:
+        cuts = ['-segment_time', str(segment_length_s)]
+    return [ffmpeg_binary(), '-loglevel', 'error', '-y', '-i', 'pipe:0',
+            '-map', '0:a', '-c:a', 'copy', '-f', 'matroska', full_path,
+            '-map', '0:a', '-c:a', 'libopus', '-f', 'segment', '-segment_format', 'opus', '-reset_timestamps', '1', *cuts,
+            f'{segments_dir}/segment_%d.opus']
+
+
+def watch_segments(segmenter, segments_dir: str, on_segment=None, max_segments=None):
+    """
+    Calls on_segment(i, path) for every segment the segmenter has finished, until it exits.
+
+    Returns:
+        str: the reason to abort the download (from on_segment, or more than max_segments), None once it is complete.
+    """
+    done = 0
+    while True:
+        finished = segmenter.poll() is not None
+        produced = len([f for f in os.listdir(segments_dir) if f.startswith('segment_') and f.endswith('.opus')])
+        ready = produced if finished else produced - 1 # the last one is still being written
+        while done < ready:
+            if max_segments and done >= max_segments:
+                return f'Audio longer than {max_segments} segments.'
+            reason = on_segment(done, f'{segments_dir}/segment_{done}.opus') if on_segment else None
+            done += 1
+            if reason:
+                return reason
+        if finished:
+            return None
+        time.sleep(DOWNLOAD_POLL_S)
+
+
+def stream_youtube_audio(video_id: str, vid_dir: str, segments_dir: str, chapters=[], segment_length_s=120,
+                         max_duration_s=None, on_segment=None, retry_count: int = 3, extraction=None) -> str:
+    """
+    Downloads the audio only and cuts it into segments while it downloads :
+    yt-dlp streams it to ffmpeg, that keeps it in its native codec as vid_dir/full.mka and writes segments_dir/segment_<i>.opus.
+
+    Args:
+        on_segment (callable, optional): on_segment(i, path), called for every finished segment while the download goes on.
+            Returning a reason (str) stops the download.
+        max_duration_s (int, optional): stops the download past this duration (sets without chapters).
+        extraction (dict, optional): stored by youbube_video_info. Used for the first attempt if still valid, the page is not extracted again.
+
+    Returns:
+        str: path of the full audio.
+
+    Raises:
+        Exception: the download failed retry_count times (yt-dlp error), or was aborted (the reason).
+    """
+    full_path = f'{vid_dir}/{FULL_AUDIO_NAME}'
+    part_path = f'{full_path}.part'
+    max_segments = math.ceil(max_duration_s / segment_length_s) if max_duration_s and not len(chapters) else None
+
+    info_json_path = None
+    if extraction_is_valid(extraction):
+        info_json_path = f'{vid_dir}/info.json'
+        with open(info_json_path, 'w') as f:
+            json.dump(extraction['info'], f)
+
+    for attempt in range(retry_count):
+        shutil.rmtree(segments_dir, ignore_errors=True)
+        os.makedirs(segments_dir, exist_ok=True)
+        with open(f'{vid_dir}/yt_dlp.log', 'wb') as yt_dlp_log, open(f'{vid_dir}/ffmpeg.log', 'wb') as ffmpeg_log:
+            # the stored extraction is only trusted once : a failure may come from urls revoked before their expiry
+            command = yt_dlp_stream_command(video_id, info_json_path if attempt == 0 else None)
+            downloader = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=yt_dlp_log)
+            segmenter = subprocess.Popen(segmenter_command(part_path, segments_dir, chapters, segment_length_s), stdin=downloader.stdout, stderr=ffmpeg_log)
+            downloader.stdout.close() # the segmenter owns the pipe, the downloader gets SIGPIPE if it exits
+            try:
+                abort_reason = watch_segments(segmenter, segments_dir, on_segment, max_segments)
+            except BaseException:
+                abort_reason = 'interrupted'
+                raise
+            finally:
+                if abort_reason:
+                    downloader.kill()
+                    segmenter.kill()
+                downloader.wait()
+                segmenter.wait()
+
+        if abort_reason:
+            logger.info(f'Download of {video_id} aborted: {abort_reason}')
+            raise Exception(abort_reason)
+        if downloader.returncode == 0 and segmenter.returncode == 0:
+            os.replace(part_path, full_path)
+            return full_path
+
+        error = (open(f'{vid_dir}/yt_dlp.log', errors='replace').read() or open(f'{vid_dir}/ffmpeg.log', errors='replace').read()).strip()
+        error = error or f'yt-dlp exited with {downloader.returncode}, ffmpeg exited with {segmenter.returncode}'
+        logger.error(f"Attempt {attempt + 1} failed: {error}")
+        if attempt + 1 == retry_count:
+            raise Exception(error)
+        logger.info("Retrying...")
 
 
 def youtube_get_channel_feed_video_ids(channel_id: str)->list[str]:
@@ -0,0 +1,105 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from boilersaas.utils.db import db
+from web.model import ChangeLog, ChangeLogCursor
+from web.logger import logger
+
+CHANGE_LOG_BATCH = 1000
+# Changes older than this are pruned, even if a consumer is still behind
+CHANGE_LOG_RETENTION_DAYS = int(os.getenv('CHANGE_LOG_RETENTION_DAYS', 30))
+
+
+def get_change_log_cursor(consumer):
+    """ (txid, id) of the last change applied by consumer, (0, 0) for a new consumer. """
+    cursor = db.session.get(ChangeLogCursor, consumer)
+    return (cursor.last_txid, cursor.last_id) if cursor else (0, 0)
+
+
+def read_changes(consumer, limit=CHANGE_LOG_BATCH, tables=None):
+    """
+    Returns the next changes for consumer, in commit order, without moving its cursor.
+    Changes of transactions that may still be running are held back, so none can be skipped.
+
+    Args:
+        consumer (str): Name of the consumer (e.g. 'sync_remote', 'search_index').
+        limit (int): Max number of changes returned.
+        tables (list, optional): Only these tables. The cursor still moves past the other ones on ack.
+
+    Returns:
+        list: dicts with id, txid, table_name, op ('I', 'U' or 'D'), row_id, data and changed_at.
+    """
+    query = (
+        select(ChangeLog.__table__)
+        .where(tuple_(ChangeLog.txid, ChangeLog.id) > tuple_(*get_change_log_cursor(consumer)))
+        .where(ChangeLog.txid < func.txid_snapshot_xmin(func.txid_current_snapshot()))
+        .order_by(ChangeLog.txid, ChangeLog.id)
+        .limit(limit)
+    )
+    if tables:
+        query = query.where(ChangeLog.table_name.in_(tables))
+    return [dict(row._mapping) for row in db.session.execute(query)]
+
+
+def ack_changes(consumer, last_change):
+    """ Moves the cursor of consumer past last_change (as returned by read_changes), once the changes are applied. """
+    table = ChangeLogCursor.__table__
+    statement = insert(table).values(consumer=consumer, last_txid=last_change['txid'], last_id=last_change['id'])
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[table.c.consumer],
+        set_={'last_txid': statement.excluded.last_txid, 'last_id': statement.excluded.last_id, 'updated_at': func.now()},
+    ))
+    db.session.commit()
+
+
+def consume_changes(consumer, handler, tables=None, batch_size=CHANGE_LOG_BATCH):
+    """
+    Feeds the pending changes to handler by batches, acking each batch once handler returned.
+    A failing handler leaves the cursor on the last applied batch, so its changes are read again on the next call.
+
+    Returns:
+        dict: {'message': ...} or {'error': ...}
+    """
+    nb_changes = 0
+    while True:
+        changes = read_changes(consumer, batch_size, tables)
+        if not changes:
+            break
+        try:
+            handler(changes)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f'Error applying changes {changes[0]["id"]}-{changes[-1]["id"]} for {consumer}: {e}')
+            return {'error': f'Error applying changes for {consumer}: {e}'}
+        ack_changes(consumer, changes[-1])
+        nb_changes += len(changes)
+        if len(changes) < batch_size:
+            break
+    return {'message': f'{nb_changes} changes applied for {consumer}'}
+
+
+def compact_changes(changes):
+    """ Keeps the last change of every (table_name, row_id, data), for consumers that only need the final state. """
+    latest = {}
+    for change in changes:
+        key = (change['table_name'], change['row_id'], repr(change['data']))
+        latest.pop(key, None)
+        latest[key] = change
+    return list(latest.values())
+
+
+def prune_change_log(retention_days=CHANGE_LOG_RETENTION_DAYS):
+    """ Deletes the changes every consumer has applied, and all the ones older than retention_days. """
+    min_txid = db.session.query(func.min(ChangeLogCursor.last_txid)).scalar() or 0
+    oldest = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    try:
+        result = db.session.execute(ChangeLog.__table__.delete().where((ChangeLog.txid < min_txid) | (ChangeLog.changed_at < oldest)))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f'Error pruning the change log: {e}')
+        return {'error': f'Error pruning the change log: {e}'}
+    return {'message': f'{result.rowcount} changes pruned'}
@@ -0,0 +1,121 @@
+import numpy as np
+
+# The deduplicated segments of a set (see process_shazam_json) to its songs, in one pass over columns of the segments
+# instead of a pass per rule over the list of dicts :
+# - a track found again within look_ahead segments absorbs what is in between (its consecutive segments included),
+# - an unidentified song shorter than min_unidentified_s goes to the song before it.
+# The result is the one of the former merge_tracks_by_shazam_key then remove_small_unidentified_segments
+# (kept as the reference in bench_consolidation.py), without changing the segments.
+
+
+def track_columns(tracks):
+    """
+    (key, start, end, titled) arrays of tracks : key is a code per shazam key (-1 without one),
+    titled is True for the tracks with a title.
+    """
+    n = len(tracks)
+    codes = {}
+    key = np.fromiter((-1 if t.get('key_track_shazam') is None else codes.setdefault(t['key_track_shazam'], len(codes)) for t in tracks), dtype=np.int64, count=n)
+    start = np.fromiter((t['start_time'] for t in tracks), dtype=np.float64, count=n)
+    end = np.fromiter((t['end_time'] for t in tracks), dtype=np.float64, count=n)
+    titled = np.fromiter((bool(t.get('title')) for t in tracks), dtype=bool, count=n)
+    return key, start, end, titled
+
+
+def chains(key, titled, look_ahead):
+    """
+    Every track chained to the next one of the same key if it comes within look_ahead tracks.
+
+    Returns:
+        tuple: (order, position, chain_last, chain_titled) : tracks sorted by key then time (a chain is a run of it),
+            position of every track in that order, position of the last track of its chain,
+            and whether a track from it to the end of its chain has a title.
+    """
+    n = len(key)
+    order = np.argsort(key, kind='stable')
+    position = np.empty(n, dtype=np.int64)
+    position[order] = np.arange(n)
+
+    sorted_key = key[order]
+    linked = (sorted_key[1:] == sorted_key[:-1]) & (sorted_key[1:] >= 0) & (order[1:] - order[:-1] <= look_ahead)
+    chain_id = np.concatenate(([0], np.cumsum(~linked)))
+    last_of_chain = np.flatnonzero(np.append(chain_id[1:] != chain_id[:-1], True))
+    chain_last = last_of_chain[chain_id]
+
+    titled_at = np.where(titled[order], np.arange(n), n)
+    next_titled = np.minimum.accumulate(titled_at[::-1])[::-1]
+    chain_titled = np.empty(n, dtype=bool)
+    chain_titled[order] = next_titled <= chain_last
+    return order, position, chain_last, chain_titled
+
+
+def fill_missing(song, track):
+    """ The empty fields of song from track, but its start. """
+    for key, value in track.items():
+        if key != 'start_time' and value and not song.get(key):
+            song[key] = value
+
+
+def consolidate(tracks, look_ahead=4, min_unidentified_s=90):
+    """
+    Songs of the deduplicated segments of a set (dicts with 'key_track_shazam', 'start_time', 'end_time', 'title'...).
+    A song is the first segment of its chain, its missing fields filled from the rest of the chain in order.
+
+    Returns:
+        tuple: (songs, number of unique tracks by title and artist)
+    """
+    if not tracks:
+        return [], 0
+    key, start, end, titled = track_columns(tracks)
+    order, position, chain_last, chain_titled = chains(key, titled, look_ahead)
+    chain_end = order[chain_last[position]] # track ending the chain of every track
+
+    # a song starts after the end of the chain of the previous one, the tracks in between are absorbed
+    heads = []
+    i = 0
+    while i < len(tracks):
+        heads.append(i)
+        i = chain_end[i] + 1
+    heads = np.array(heads)
+
+    small = ~chain_titled[heads] & (end[chain_end[heads]] - start[heads] < min_unidentified_s)
+    kept = np.flatnonzero(~small)
+    absorbed_until = np.append(kept[1:], len(heads)) - 1 # a song ends where the small ones after it end
+
+    songs = []
+    unique_tracks = set()
+    for k, until in zip(kept, absorbed_until):
+        head = heads[k]
+        song = dict(tracks[head])
+        for p in range(position[head] + 1, chain_last[position[head]] + 1):
+            fill_missing(song, tracks[order[p]])
+        song['end_time'] = tracks[chain_end[heads[until]]]['end_time']
+        songs.append(song)
+        if song.get('title') and song.get('artist_name'):
+            unique_tracks.add(song['title'] + song['artist_name'])
+    return songs, len(unique_tracks)
+
+
+def place_track_starts(songs):
+    """
+    Moves every identified song to the start of its track in the set as Shazam matched it (track_start_s, see
+    process_shazam_json.segment_match), the song before it ending there : the boundary is no longer the one of the segments.
+    An estimate before the start of the song before it, or after the end of the song, is ignored.
+    An unidentified song left empty is removed.
+    """
+    placed = []
+    for song in songs:
+        estimate = song.get('track_start_s')
+        if placed and song.get('title') and estimate is not None:
+            previous = placed[-1]
+            # an identified song keeps a second at least
+            lowest = previous['start_time'] + (1 if previous.get('title') else 0)
+            start = int(estimate)
+            if lowest <= start < song['end_time'] and start != song['start_time']:
+                song = {**song, 'start_time': start}
+                if start > previous['start_time']:
+                    placed[-1] = {**previous, 'end_time': start}
+                else:
+                    placed.pop()
+        placed.append(song)
+    return placed
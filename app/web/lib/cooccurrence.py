@@ -0,0 +1,86 @@
+import numpy as np
+from scipy import sparse
+
+
+def build_cooccurrence_matrix(set_ids, track_ids, positions, window=3, adjacency_weight=1.0):
+    """
+    Builds a sparse track x track score matrix from the track_sets rows.
+
+    Two tracks score 1 for every set they both appear in, plus adjacency_weight / distance
+    for every time they are played within `window` positions of each other.
+    Columns are then divided by sqrt(number of sets of the track), so that tracks present in every set
+    don't end up related to everything. Row rankings are the same as with a cosine normalisation.
+
+    Args:
+        set_ids, track_ids, positions (array-like): One entry per track_sets row.
+        window (int): How many positions apart two tracks can be to count as adjacent.
+        adjacency_weight (float): Weight of a direct transition, relative to simply being in the same set.
+
+    Returns:
+        tuple: (scores as a csr_matrix, array mapping matrix index -> track id)
+    """
+    set_ids = np.asarray(set_ids)
+    track_ids = np.asarray(track_ids)
+    positions = np.asarray(positions)
+
+    tracks, track_idx = np.unique(track_ids, return_inverse=True)
+    sets, set_idx = np.unique(set_ids, return_inverse=True)
+    n_tracks = len(tracks)
+
+    # set x track incidence, binary even if a track is played twice in the same set
+    incidence = sparse.csr_matrix((np.ones(len(track_idx), dtype=np.float32), (set_idx, track_idx)), shape=(len(sets), n_tracks))
+    incidence.sum_duplicates()
+    incidence.data[:] = 1
+    nb_sets = np.asarray(incidence.sum(axis=0)).ravel()
+
+    scores = (incidence.T @ incidence).tocsr()
+
+    # transitions : rows sorted by set then position, compare each row with the next `window` ones
+    order = np.lexsort((positions, set_idx))
+    s, t = set_idx[order], track_idx[order]
+    rows, cols, weights = [], [], []
+    for k in range(1, window + 1):
+        same_set = s[:-k] == s[k:]
+        a, b = t[:-k][same_set], t[k:][same_set]
+        rows.extend([a, b])
+        cols.extend([b, a])
+        weights.append(np.full(2 * len(a), adjacency_weight / k, dtype=np.float32))
+
+    if rows:
+        adjacency = sparse.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))), shape=(n_tracks, n_tracks))
+        scores = scores + adjacency
+
+    scores = sparse.csr_matrix(scores.multiply(1 / np.sqrt(np.maximum(nb_sets, 1))[np.newaxis, :]))
+    scores.setdiag(0)
+    scores.eliminate_zeros()
+    return scores, tracks
+
+
+def top_k_neighbours(scores, tracks, k=30, min_score=0.0):
+    """
+    Returns the k best scored neighbours of every track.
+
+    Args:
+        scores (csr_matrix): As returned by build_cooccurrence_matrix.
+        tracks (np.ndarray): Matrix index -> track id.
+        k (int): Max number of neighbours per track.
+        min_score (float): Neighbours scoring below this are ignored.
+
+    Returns:
+        dict: track id -> list of (related track id, score), best first. Ties are broken by track id.
+    """
+    neighbours = {}
+    indptr, indices, data = scores.indptr, scores.indices, scores.data
+    for row in range(scores.shape[0]):
+        start, end = indptr[row], indptr[row + 1]
+        if start == end:
+            continue
+        row_cols, row_scores = indices[start:end], data[start:end]
+        keep = row_scores > min_score
+        row_cols, row_scores = row_cols[keep], row_scores[keep]
+        if not len(row_cols):
+            continue
+        related = tracks[row_cols]
+        best = np.lexsort((related, -row_scores))[:k]
+        neighbours[int(tracks[row])] = [(int(related[i]), float(row_scores[i])) for i in best]
+    return neighbours
@@ -0,0 +1,172 @@
+import os
+import shutil
+import time
+
+from flask import g, has_request_context, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess, push_to_gateway
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+
+from web.lib.artifact_store import TEMP_DOWNLOADS_PATH, directory_size
+
+import logging
+logger = logging.getLogger('root')
+
+# Prometheus metrics of the web app and of the cron workers.
+# The cron workers are separate processes : set PROMETHEUS_MULTIPROC_DIR (same empty dir for every process, wiped on restart)
+# and /metrics aggregates the files they write. Workers on another host can push to a gateway instead.
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+PROMETHEUS_PUSHGATEWAY_URL = os.getenv('PROMETHEUS_PUSHGATEWAY_URL')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN') # if set, /metrics requires "Authorization: Bearer <token>"
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Web request latency', ['blueprint', 'route', 'method', 'status'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+HTTP_REQUEST_DB_QUERIES = Histogram(
+    'http_request_db_queries', 'Database queries per web request', ['blueprint', 'route'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+CACHE_REQUESTS = Counter('cache_requests_total', 'Cache lookups', ['cache', 'result'])
+EXTERNAL_REQUESTS = Counter('external_requests_total', 'Calls to external APIs', ['service', 'outcome'])
+SET_PROCESS_SECONDS = Histogram(
+    'set_process_duration_seconds', 'insert_set duration', ['result'],
+    buckets=(30, 60, 120, 300, 600, 1200, 1800, 3600, 7200),
+)
+SET_PROCESS_STAGE_SECONDS = Histogram(
+    'set_process_stage_duration_seconds', 'insert_set stage duration', ['stage'],
+    buckets=(0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1200),
+)
+SET_QUEUE_RESOLVED = Counter('set_queue_resolved_total', 'Prequeued sets resolved by cron_set_queue.py', ['outcome'])
+SET_QUEUE_RESOLVE_BATCH_SECONDS = Histogram(
+    'set_queue_resolve_batch_duration_seconds', 'Duration of a batch of prequeued sets resolution',
+    buckets=(1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+SYNC_REMOTE_LAG_SECONDS = Gauge('sync_remote_lag_seconds', 'updated_at of the latest set on the source minus the latest one replicated', multiprocess_mode='liveall')
+SYNC_REMOTE_SETS_PER_MINUTE = Gauge('sync_remote_sets_per_minute', 'Replication rate of the current sync_remote run', multiprocess_mode='liveall')
+SYNC_REMOTE_REMAINING_SETS = Gauge('sync_remote_remaining_sets', 'Sets left to replicate', multiprocess_mode='liveall')
+SYNC_REMOTE_TRACK_CHANGES = Counter('sync_remote_track_changes_total', 'Track updates replicated from the change log')
+APP_STARTUP_SECONDS = Gauge('app_startup_seconds', 'Time from the first import of the web package to the app being ready', ['kind'], multiprocess_mode='liveall')
+APP_STARTUP_RSS_MB = Gauge('app_startup_rss_mb', 'Resident memory once the app is ready', ['kind'], multiprocess_mode='liveall')
+APP_STARTUP_MODULES = Gauge('app_startup_modules', 'Modules imported once the app is ready', ['kind'], multiprocess_mode='liveall')
+
+
+def count_cache(cache, hit):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def service_from_host(host):
+    host = host or ''
+    for service in ('shazam', 'spotify', 'apple'):
+        if service in host:
+            return service
+    return 'other'
+
+
+def count_external_request(service, ok):
+    EXTERNAL_REQUESTS.labels(service, 'ok' if ok else 'error').inc()
+
+
+def observe_set_process(tracer, result):
+    """ Feeds the spans of an insert_set run (see web/lib/spans.py) to the duration histograms. """
+    for span in tracer.spans:
+        SET_PROCESS_STAGE_SECONDS.labels(span['stage']).observe(span['wall_s'])
+    SET_PROCESS_SECONDS.labels(result).observe(sum(span['wall_s'] for span in tracer.spans))
+
+
+def observe_queue_resolve(outcomes, seconds):
+    """ A batch of prequeued sets resolved, outcomes being the number of sets per resulting status. """
+    for outcome, nb in outcomes.items():
+        SET_QUEUE_RESOLVED.labels(outcome).inc(nb)
+    SET_QUEUE_RESOLVE_BATCH_SECONDS.observe(seconds)
+
+
+def observe_sync_progress(lag_s, sets_per_minute, remaining_sets):
+    """ Progress of cron_sync_remote.py, set after every batch. """
+    SYNC_REMOTE_LAG_SECONDS.set(lag_s)
+    SYNC_REMOTE_SETS_PER_MINUTE.set(sets_per_minute)
+    SYNC_REMOTE_REMAINING_SETS.set(remaining_sets)
+
+
+def observe_startup(kind, seconds, rss_mb, nb_modules):
+    """ Startup cost of a process, kind is 'web' or 'worker' (see web.create_app and web.create_worker_app). """
+    APP_STARTUP_SECONDS.labels(kind).set(seconds)
+    APP_STARTUP_RSS_MB.labels(kind).set(rss_mb)
+    APP_STARTUP_MODULES.labels(kind).set(nb_modules)
+
+
+class QueueCollector:
+    """ Gauges read at scrape time : queue depths and temp dir disk use. """
+
+    def collect(self):
+        from boilersaas.utils.db import db
+        from web.model import RelatedTracksQueue, SetQueue
+
+        set_queue = GaugeMetricFamily('set_queue_depth', 'SetQueue rows per status', labels=['status'])
+        for status, nb in db.session.query(SetQueue.status, func.count(SetQueue.id)).group_by(SetQueue.status):
+            set_queue.add_metric([status], nb)
+        yield set_queue
+
+        related_queue = GaugeMetricFamily('related_tracks_queue_depth', 'RelatedTracksQueue rows per status', labels=['status'])
+        for status, nb in db.session.query(RelatedTracksQueue.status, func.count(RelatedTracksQueue.id)).group_by(RelatedTracksQueue.status):
+            related_queue.add_metric([status], nb)
+        yield related_queue
+
+        if os.path.isdir(TEMP_DOWNLOADS_PATH):
+            yield GaugeMetricFamily('temp_downloads_bytes', 'Disk used by the temp downloads', value=directory_size(TEMP_DOWNLOADS_PATH))
+            yield GaugeMetricFamily('temp_downloads_free_bytes', 'Free disk on the temp downloads volume', value=shutil.disk_usage(TEMP_DOWNLOADS_PATH).free)
+
+
+queue_registry = CollectorRegistry()
+queue_registry.register(QueueCollector())
+
+
+def generate_metrics():
+    """ The exposition text of /metrics : the metrics of every process, then the scrape time gauges. """
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry) + generate_latest(queue_registry)
+
+
+def metrics_authorized():
+    return not METRICS_TOKEN or request.headers.get('Authorization') == f'Bearer {METRICS_TOKEN}'
+
+
+def push_metrics(job):
+    """ Pushes the metrics of this worker to the gateway, when there is one and no shared multiprocess dir. """
+    if not PROMETHEUS_PUSHGATEWAY_URL or PROMETHEUS_MULTIPROC_DIR:
+        return
+    try:
+        push_to_gateway(PROMETHEUS_PUSHGATEWAY_URL, job=job, registry=REGISTRY)
+    except Exception as e:
+        logger.error(f'Error pushing metrics to {PROMETHEUS_PUSHGATEWAY_URL}: {e}')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_request_db_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'db_queries' in g:
+        g.db_queries += 1
+
+
+def init_metrics(app):
+    """ Times every request and counts its db queries. """
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_start = time.perf_counter()
+        g.db_queries = 0
+
+    @app.after_request
+    def observe_request_metrics(response):
+        if 'request_start' in g:
+            blueprint = request.blueprint or ''
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            HTTP_REQUEST_SECONDS.labels(blueprint, route, request.method, response.status_code).observe(time.perf_counter() - g.request_start)
+            HTTP_REQUEST_DB_QUERIES.labels(blueprint, route).observe(g.db_queries)
+        return response
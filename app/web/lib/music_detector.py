@@ -0,0 +1,109 @@
+import os
+import subprocess
+
+import numpy as np
+
+from web.lib.audio import ffmpeg_binary
+
+import logging
+logger = logging.getLogger('root')
+
+# Segments scored below NON_MUSIC_THRESHOLD (0 to 1) are not sent to Shazam : silence, crowd noise, talk...
+# Shazam only ever answers "Unknown Track" for them. A skipped segment is never recognized again, so 0 (every segment
+# sent) until calibrate_music_detector.py has been run on segments of real sets.
+NON_MUSIC_THRESHOLD = float(os.getenv('NON_MUSIC_THRESHOLD', 0))
+DETECTOR_SAMPLE_RATE = 8000 # mono, enough for the energy, the tonality and the beats
+FRAME_SIZE = 512 # 64 ms
+HOP_SIZE = 256
+ACTIVE_DB = -45 # frames quieter than this (dBFS) are silence
+MIN_ACTIVE_SHARE = 0.1 # a segment sounding less than that is silence
+FLATNESS_BANDS = [(2 ** k, 2 ** (k + 1)) for k in range(2, 8)] # octaves of FFT bins from 62 Hz, the spectrum slope is not flatness
+FLATNESS_TONAL = 0.1 # spectral flatness of music (harmonics) or lower
+FLATNESS_NOISE = 0.5 # spectral flatness of noise (crowd, hiss) or higher
+MUSIC_ONSET_RATE = 1.5 # onsets per second of music with a beat or more
+ONSET_MIN_FLUX = 0.1 # rise of the log magnitude (per bin, above its local median) of an onset, noise wobbles a few hundredths
+FLUX_FLOOR_DB = -50 # below the loudest bin of the segment, the leakage of steady tones (hum) would make onsets
+ONSET_MEDIAN_S = 0.5 # window of the local median of the flux
+ONSET_MIN_INTERVAL_S = 0.1 # onsets closer than that are one
+EPSILON = 1e-10
+
+
+def decode_pcm(file_path, sample_rate=DETECTOR_SAMPLE_RATE):
+    """ file_path decoded to mono float samples in -1..1 at sample_rate. """
+    result = subprocess.run(
+        [ffmpeg_binary(), '-loglevel', 'error', '-i', file_path, '-vn', '-ac', '1', '-ar', str(sample_rate), '-f', 's16le', 'pipe:1'],
+        capture_output=True, check=True,
+    )
+    return np.frombuffer(result.stdout, dtype=np.int16).astype(np.float32) / 32768
+
+
+def audio_features(samples, sample_rate=DETECTOR_SAMPLE_RATE):
+    """
+    active_share : share of the frames louder than ACTIVE_DB.
+    flatness : median spectral flatness of the active frames, 0 for a pure tone to about 0.6 for any noise (white, pink, crowd) :
+        the flatness of every octave, weighted by its power.
+    onset_rate : onsets per second, see onset_frames.
+    """
+    if len(samples) < FRAME_SIZE:
+        return {'active_share': 0.0, 'flatness': 1.0, 'onset_rate': 0.0}
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME_SIZE)[::HOP_SIZE]
+
+    rms_db = 10 * np.log10(np.mean(frames ** 2, axis=1) + EPSILON)
+    active = rms_db > ACTIVE_DB
+
+    power = np.abs(np.fft.rfft(frames * np.hanning(FRAME_SIZE), axis=1)) ** 2 + EPSILON
+    bands = [power[:, low:high] for low, high in FLATNESS_BANDS]
+    band_power = np.stack([band.sum(axis=1) for band in bands], axis=1)
+    band_flatness = np.stack([np.exp(np.mean(np.log(band), axis=1)) / np.mean(band, axis=1) for band in bands], axis=1)
+    flatness = np.sum(band_flatness * band_power, axis=1) / np.sum(band_power, axis=1)
+
+    log_magnitude = np.log(power + power.max() * 10 ** (FLUX_FLOOR_DB / 10)) / 2
+    flux = np.concatenate(([0], np.mean(np.maximum(np.diff(log_magnitude, axis=0), 0), axis=1)))
+
+    return {
+        'active_share': float(active.mean()),
+        'flatness': float(np.median(flatness[active])) if active.any() else 1.0,
+        'onset_rate': float(len(onset_frames(flux, active, sample_rate)) * sample_rate / len(samples)),
+    }
+
+
+def onset_frames(flux, active, sample_rate=DETECTOR_SAMPLE_RATE):
+    """
+    The onsets : active frames where the spectral flux peaks ONSET_MIN_FLUX above its local median, ONSET_MIN_INTERVAL_S apart at least.
+    The threshold does not depend on the rest of the segment : a steady sound or noise has no onset.
+    """
+    frame_s = HOP_SIZE / sample_rate
+    half = max(1, int(ONSET_MEDIAN_S / frame_s / 2))
+    local_median = np.median(np.lib.stride_tricks.sliding_window_view(np.pad(flux, half, mode='edge'), 2 * half + 1), axis=1)
+    peaks = np.flatnonzero((flux[1:-1] - local_median[1:-1] > ONSET_MIN_FLUX) & (flux[1:-1] >= flux[:-2]) & (flux[1:-1] > flux[2:]) & active[1:-1]) + 1
+
+    onsets = []
+    for frame in peaks:
+        if not onsets or (frame - onsets[-1]) * frame_s >= ONSET_MIN_INTERVAL_S:
+            onsets.append(int(frame))
+    return onsets
+
+
+def music_score(features):
+    """ 0 to 1 : how tonal and how rhythmic the segment is, 0 for a segment mostly silent. """
+    if features['active_share'] < MIN_ACTIVE_SHARE:
+        return 0.0
+    tonal = np.clip((FLATNESS_NOISE - features['flatness']) / (FLATNESS_NOISE - FLATNESS_TONAL), 0, 1)
+    rhythmic = np.clip(features['onset_rate'] / MUSIC_ONSET_RATE, 0, 1)
+    return float((tonal + rhythmic) / 2)
+
+
+def classify_segment(file_path, threshold=NON_MUSIC_THRESHOLD):
+    """
+    Whether file_path is worth recognizing, with its score and features.
+    A segment that cannot be decoded is recognized anyway, Shazam will tell.
+    """
+    if threshold <= 0:
+        return {'music': True, 'music_score': None}
+    try:
+        features = audio_features(decode_pcm(file_path))
+    except Exception as e:
+        logger.warning(f'Could not classify {os.path.basename(file_path)}: {e}')
+        return {'music': True, 'music_score': None}
+    score = music_score(features)
+    return {'music': score >= threshold, 'music_score': score, 'features': features}
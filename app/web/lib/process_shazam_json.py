@@ -1,6 +1,8 @@
 import json,os
-from typing import Dict, Any
+import threading
+from typing import Dict, Any, Iterable, Iterator
 from web.lib.utils import safe_get
+from web.lib.artifact_store import atomic_write_json
 import logging
 logger = logging.getLogger('root')
 
@@ -27,133 +29,144 @@ def transform_track_data(track: Dict[str, Any]):
     "release_date": safe_get(track, ["releasedate"])  # Adjust based on actual data if different
     }
 
-def extract_track_data(file_path: str) -> Dict[str, Any]:
-    try:
-        with open(file_path, 'r') as file:
-            data = json.load(file)
-
-        track = data.get('track', {})
-        return transform_track_data(track)
-        
-        
-
-
-    except FileNotFoundError:
-        logger.error("The file does not exist.")
-        return {}
-    except json.JSONDecodeError:
-        logger.error("Error decoding JSON ")
+def segment_index(file: str) -> int:
+    """ 3 for segment_3.opus """
+    return int(os.path.splitext(os.path.basename(file))[0].split('_')[1])
+
+
+# The Shazam results of a set : one line per recognized segment, {"segment": i, "start_s", "end_s": its range in the set, "result": response},
+# appended as they come (in any order). A segment recognized again (after an error) has a later line, the last one wins.
+SEGMENT_RESULTS_FILE = 'segment_results.ndjson'
+# the parts of a set named by its uploader that were not resolved (see set_process.write_tracklist_songs) : other ranges, other indices
+TRACKLIST_RESULTS_FILE = 'tracklist_results.ndjson'
+_results_lock = threading.Lock()
+SHAZAM_SIGNATURE_S = 10 # shazamio fingerprints the middle 10 s of a segment (shazamio_core Recognizer default)
+
+
+def append_segment_result(results_path: str, index: int, start_s, end_s, result: Dict[str, Any]):
+    line = json.dumps({'segment': index, 'start_s': start_s, 'end_s': end_s, 'result': result}, separators=(',', ':')) + '\n'
+    with _results_lock:
+        fd = os.open(results_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+
+def read_segment_results(results_path: str) -> Iterator[Dict[str, Any]]:
+    """ The lines of the results log, as written. A line cut by a crash is skipped. """
+    if not os.path.exists(results_path):
+        return
+    with open(results_path) as file:
+        for line in file:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping a truncated line of {results_path}")
+
+
+def latest_segment_results(results_path: str) -> Dict[int, Dict[str, Any]]:
+    """ segment index -> its last line in the results log """
+    return {record['segment']: record for record in read_segment_results(results_path)}
+
+
+def in_segment_order(records: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """
+    The records by segment index, each one yielded as soon as the ones before it came : it can follow a log being written.
+    An error is held until the records end, a later line of its segment (recognized again) replacing it.
+    Missing segments are skipped once the records end.
+    """
+    pending = {}
+    next_index = 0
+    for record in records:
+        if record['segment'] >= next_index:
+            pending[record['segment']] = record
+        while next_index in pending and 'error' not in pending[next_index]['result']:
+            yield pending.pop(next_index)
+            next_index += 1
+    for index in sorted(pending):
+        yield pending[index]
+
+
+def segment_match(record) -> Dict[str, Any]:
+    """
+    The match of a recognized segment : where the fingerprint is in the track (offset), its tempo and pitch skews,
+    and from the offset the start of the track in the set, if the range of the segment is known.
+    The skews are kept as they are, their sign convention is not documented.
+    """
+    match = safe_get(record, ['result', 'matches', 0])
+    if not match or match.get('offset') is None:
         return {}
-    except Exception as e:
-        logger.error(f"An unexpected error occurred: {e}")
-        return {}
-
-      
-def get_segments(directory_path: str):
-    # List all files in the directory
-    files = os.listdir(directory_path)
-    # Filter and sort files based on the numeric value after 'segment_'
-    segment_files = sorted(
-        (file for file in files if file.startswith("segment_") and file.endswith(".json")),
-        key=lambda x: int(x.split('_')[1].split('.')[0])
-    )
-
-    segments = []
-    for file_name in segment_files:
-            segments.append(file_name)
-
-    return segments
-
+    data = {
+        "match_offset_s": match.get('offset'),
+        "match_timeskew": match.get('timeskew'),
+        "match_frequencyskew": match.get('frequencyskew'),
+    }
+    if record.get('start_s') is not None and record.get('end_s') is not None:
+        fingerprint_start_s = record['start_s'] + max(0, (record['end_s'] - record['start_s'] - SHAZAM_SIGNATURE_S) / 2)
+        data["track_start_s"] = fingerprint_start_s - match['offset']
+    return data
 
-def write_segments_from_chapter(directory_path: str, output_file_path: str, chapters):
-    segment_files = get_segments(directory_path)
-    logger.info(f"writing segments from chapters at {directory_path} with {len(segment_files)} segments.")
 
-    with open(output_file_path, 'w') as file:
-        file.write('[')
-        first = True
-        
-        for i,file_name in enumerate(segment_files):
-            logger.info(f"Segments from chapters, processing {file_name}")
-            file_path = os.path.join(directory_path, file_name)
-            segment_data = extract_track_data(file_path)
-            
+def segment_track_data(record) -> Dict[str, Any]:
+    if not record:
+        return {}
+    track_data = transform_track_data(record['result'].get('track', {}))
+    if track_data["key_track_shazam"] is not None:
+        track_data.update(segment_match(record))
+    return track_data
+
+
+def deduplicated_segments(records: Iterable[Dict[str, Any]], segment_duration: int = 120) -> Iterator[Dict[str, Any]]:
+    """
+    The songs of records in segment order (see in_segment_order), the consecutive segments of the same track
+    (or not found) merged. Every song is yielded once the next one starts.
+    """
+    current_track_data = None
+    last_title = last_artist = None
+    for record in records:
+        start_time = record['start_s'] if record.get('start_s') is not None else record['segment'] * segment_duration
+        segment_data = segment_track_data(record)
+        title = segment_data.get("title")
+        artist_name = segment_data.get("subtitle")
+
+        # Track is the same as prev or track not found
+        if current_track_data is not None and ((last_title is not None and title == last_title and artist_name == last_artist) or (title is None and last_title is None)):
+            current_track_data["end_time"] = int(start_time) + segment_duration
+        else:
+            if current_track_data is not None:
+                yield current_track_data
             current_track_data = {
-                    "start_time": int(chapters[i]['start_time']),
-                    "end_time": int(chapters[i]['end_time'])
-                }
-               
-            if not first:
-                file.write(',')
-            else:
-                first = False
-            
-            current_track_data.update(segment_data)
-            json.dump(current_track_data, file, indent=4)
-
-        file.write(']')
-
-
-
-def write_deduplicated_segments(directory_path: str, output_file_path: str, segment_duration: int = 120,chapters={}):
-    segment_files = get_segments(directory_path)
-    current_start_time = 0  # Initialize start time for the first track
-    current_track_data = None  
-
-    with open(output_file_path, 'w') as file:
-        file.write('[')
-        first = True
-        logger.info(f"Deduplicating segments at {directory_path}")
-        for file_name in segment_files:
-            logger.info(f"Deduplication, processing {file_name}")
-            file_path = os.path.join(directory_path, file_name)
-            segment_data = extract_track_data(file_path)
-            title = segment_data.get("title")
-            artist_name = segment_data.get("subtitle")
-            
-
-            # First track 
-            if current_track_data is None:
-               
-                current_track_data = {
-                    "start_time": current_start_time,
-                    "end_time": current_start_time + segment_duration
-                }
-            
-            # Track is the same as prev or track not found    
-            elif (last_title is not None and title == last_title and artist_name == last_artist) or (title is None and last_title is None):
-                # If the title and subtitle haven't changed, extend the current track's duration
-                current_track_data["end_time"] += segment_duration
-            
-            # New track    
-            else:
-                
-                if not first:
-                    file.write(',')
-                else:
-                    first = False
-                json.dump(current_track_data, file, indent=4)
-
-                # Start new track
-                current_track_data = {
-                    "start_time": current_start_time,
-                    "end_time": current_start_time + segment_duration
-                }
-            
-            current_track_data.update(segment_data)
-
-            # Prepare for next segment
-            last_title = title
-            last_artist = artist_name
-
-            current_start_time += segment_duration
-
-        # After loop, write the last track if any
-        if current_track_data is not None:
-            if not first:
-                file.write(',')
-            json.dump(current_track_data, file, indent=4)
-
-        file.write(']')
-
-
+                "start_time": int(start_time),
+                "end_time": int(start_time) + segment_duration
+            }
+
+        current_track_data.update(segment_data)
+        last_title = title
+        last_artist = artist_name
+
+    if current_track_data is not None:
+        yield current_track_data
+
+
+def write_segments_from_chapter(results_path: str, output_file_path: str, chapters):
+    logger.info(f"writing segments from chapters at {results_path}")
+    songs = []
+    for record in in_segment_order(read_segment_results(results_path)):
+        if record['segment'] >= len(chapters):
+            continue
+        chapter = chapters[record['segment']]
+        songs.append({
+            "start_time": int(chapter['start_time']),
+            "end_time": int(chapter['end_time']),
+            **segment_track_data(record)
+        })
+    atomic_write_json(output_file_path, songs)
+    return songs
+
+
+def write_deduplicated_segments(results_path: str, output_file_path: str, segment_duration: int = 120):
+    logger.info(f"Deduplicating segments at {results_path}")
+    songs = list(deduplicated_segments(in_segment_order(read_segment_results(results_path)), segment_duration))
+    atomic_write_json(output_file_path, songs)
+    return songs
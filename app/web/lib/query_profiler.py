@@ -0,0 +1,178 @@
+import os
+import random
+import re
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+
+from flask import g, has_request_context, request
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+
+from boilersaas.utils.db import db
+from web.model import QueryProfile
+from web.lib.utils import is_dev_env
+
+import logging
+logger = logging.getLogger('root')
+
+# Per request SQL profile : query count, db time and repeated statement shapes (N+1), with the line that triggered them.
+# Always on in dev, sampled in production.
+QUERY_PROFILER_SAMPLE_RATE = float(os.getenv('QUERY_PROFILER_SAMPLE_RATE', 0.01))
+QUERY_PROFILER_N_PLUS_ONE = int(os.getenv('QUERY_PROFILER_N_PLUS_ONE', 5)) # same shape this many times in a request
+QUERY_PROFILE_HEADER = 'X-Query-Profile'
+# The profiles are pruned by cron_remove_temp_downloads : older than the retention, or the oldest beyond the max rows
+QUERY_PROFILES_RETENTION_DAYS = int(os.getenv('QUERY_PROFILES_RETENTION_DAYS', 30))
+QUERY_PROFILES_MAX_ROWS = int(os.getenv('QUERY_PROFILES_MAX_ROWS', 100_000))
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+IGNORED_FRAMES = ('query_profiler.py', '/site-packages/', '/sqlalchemy/')
+
+NUMBER = re.compile(r'\b\d+\b')
+PLACEHOLDER_LIST = re.compile(r'\((?:\s*(?:%\(\w+\)s|\?|__\[POSTCOMPILE_\w+\])\s*,?)+\)')
+PLACEHOLDER = re.compile(r'%\(\w+\)s|__\[POSTCOMPILE_\w+\]')
+
+
+def statement_shape(statement):
+    """ The statement with its parameters, literals and IN lists collapsed, so that N+1 queries share one shape. """
+    shape = PLACEHOLDER_LIST.sub('(?)', statement)
+    shape = PLACEHOLDER.sub('?', shape)
+    shape = NUMBER.sub('?', shape)
+    return ' '.join(shape.split())
+
+
+def call_site():
+    """ The innermost frame of the app (controller, route or template) that led to the query. """
+    for frame in reversed(traceback.extract_stack()):
+        if frame.filename.startswith(APP_DIR) and not any(ignored in frame.filename for ignored in IGNORED_FRAMES):
+            return f'{os.path.relpath(frame.filename, APP_DIR)}:{frame.lineno} {frame.name}'
+        if frame.filename.endswith('.html'): # lazy loads triggered from a template
+            return f'{frame.filename}:{frame.lineno}'
+    return 'unknown'
+
+
+def profiling():
+    return has_request_context() and g.get('query_profile') is not None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    if profiling():
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    if not profiling() or not conn.info.get('query_start'):
+        return
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    profile = g.query_profile
+    profile['count'] += 1
+    profile['db_time'] += duration
+
+    shape = profile['shapes'].setdefault(statement_shape(statement), {'count': 0, 'db_time': 0, 'call_sites': {}})
+    shape['count'] += 1
+    shape['db_time'] += duration
+    site = call_site()
+    shape['call_sites'][site] = shape['call_sites'].get(site, 0) + 1
+
+
+def n_plus_one(profile, threshold=QUERY_PROFILER_N_PLUS_ONE):
+    """ The shapes run at least threshold times, most repeated first, with their main call site. """
+    repeated = []
+    for shape, stats in profile['shapes'].items():
+        if stats['count'] >= threshold:
+            repeated.append({
+                'shape': shape,
+                'count': stats['count'],
+                'db_time_ms': round(stats['db_time'] * 1000, 1),
+                'call_site': max(stats['call_sites'], key=stats['call_sites'].get),
+            })
+    return sorted(repeated, key=lambda r: r['count'], reverse=True)
+
+
+def save_query_profile(profile, response, repeated):
+    g.query_profile = None # the insert itself is not profiled
+    db_queries = g.get('db_queries') # nor counted in the request metrics (see metrics.init_metrics, observed after this)
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(QueryProfile.__table__.insert().values(
+                endpoint=request.endpoint or 'unmatched',
+                path=request.path[:255],
+                status=response.status_code,
+                query_count=profile['count'],
+                db_time_ms=profile['db_time'] * 1000,
+                total_time_ms=(time.perf_counter() - profile['start']) * 1000,
+                n_plus_one=repeated or None,
+            ))
+    except Exception as e:
+        logger.error(f'Error saving the query profile of {request.path}: {e}')
+    if db_queries is not None:
+        g.db_queries = db_queries
+
+
+def prune_query_profiles(retention_days=QUERY_PROFILES_RETENTION_DAYS, max_rows=QUERY_PROFILES_MAX_ROWS):
+    """ Deletes the profiles older than retention_days, then the oldest ones beyond max_rows. Returns the number of rows deleted. """
+    table = QueryProfile.__table__
+    since = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    deleted = db.session.execute(table.delete().where(table.c.created_at < since)).rowcount
+    oldest_kept = db.session.query(QueryProfile.id).order_by(QueryProfile.id.desc()).offset(max(max_rows, 1) - 1).limit(1).scalar()
+    if oldest_kept is not None:
+        deleted += db.session.execute(table.delete().where(table.c.id < oldest_kept)).rowcount
+    db.session.commit()
+    return deleted
+
+
+def init_query_profiler(app):
+    """ Profiles the sampled requests, adds the X-Query-Profile header and stores the profile for /admin/queries. """
+    dev = is_dev_env()
+
+    @app.before_request
+    def start_query_profile():
+        sampled = dev or random.random() < QUERY_PROFILER_SAMPLE_RATE
+        g.query_profile = {'count': 0, 'db_time': 0, 'shapes': {}, 'start': time.perf_counter()} if sampled else None
+
+    @app.after_request
+    def end_query_profile(response):
+        profile = g.get('query_profile')
+        if profile is None or request.endpoint == 'static':
+            return response
+        repeated = n_plus_one(profile)
+        response.headers[QUERY_PROFILE_HEADER] = f"queries={profile['count']}; db_ms={profile['db_time'] * 1000:.1f}; n_plus_one={len(repeated)}"
+        for r in repeated:
+            logger.warning(f"N+1 on {request.path}: {r['count']}x from {r['call_site']}: {r['shape'][:200]}")
+        save_query_profile(profile, response, repeated)
+        return response
+
+
+def get_query_profiles_report(days=7, nb_shapes=20):
+    """
+    Query profiles of the last days, per endpoint (most db time per request first),
+    and the N+1 shapes seen the most often, with their call sites.
+    """
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    endpoints = (
+        db.session.query(
+            QueryProfile.endpoint,
+            func.count(QueryProfile.id).label('nb_requests'),
+            func.avg(QueryProfile.query_count).label('avg_queries'),
+            func.max(QueryProfile.query_count).label('max_queries'),
+            func.avg(QueryProfile.db_time_ms).label('avg_db_time_ms'),
+            func.percentile_cont(0.95).within_group(QueryProfile.db_time_ms).label('p95_db_time_ms'),
+            func.avg(QueryProfile.total_time_ms).label('avg_total_time_ms'),
+        )
+        .filter(QueryProfile.created_at >= since)
+        .group_by(QueryProfile.endpoint)
+        .order_by(func.avg(QueryProfile.db_time_ms).desc())
+        .all()
+    )
+
+    shapes = {}
+    for endpoint, repeated in db.session.query(QueryProfile.endpoint, QueryProfile.n_plus_one).filter(QueryProfile.created_at >= since, QueryProfile.n_plus_one.isnot(None)):
+        for r in repeated or []:
+            stats = shapes.setdefault((endpoint, r['shape'], r['call_site']), {'endpoint': endpoint, 'shape': r['shape'], 'call_site': r['call_site'], 'nb_requests': 0, 'max_count': 0})
+            stats['nb_requests'] += 1
+            stats['max_count'] = max(stats['max_count'], r['count'])
+
+    top_shapes = sorted(shapes.values(), key=lambda s: (s['nb_requests'], s['max_count']), reverse=True)[:nb_shapes]
+    return {'endpoints': [dict(row._mapping) for row in endpoints], 'n_plus_one': top_shapes}
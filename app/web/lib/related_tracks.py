@@ -3,12 +3,14 @@ from boilersaas.utils.db import db
 
 import asyncio
 
-from shazamio import Shazam
-
 from web.controller.set_process import add_tracks_from_json
+from web.lib.av_apis.http_client import run_async, shazam_client
 from web.lib.av_apis.apple import  add_apple_track_data_from_json_async
 from web.lib.av_apis.shazam import shazam_add_tracks_label, shazam_related_tracks
 from web.lib.av_apis.spotify import  add_tracks_spotify_data_from_json_async
+from web.lib.cooccurrence import build_cooccurrence_matrix, top_k_neighbours
+from web.model import RelatedTracks, Set, Track, TrackSet
+from web.logger import logger
 
 async def async_save_related_tracks(track):
     
@@ -16,7 +18,7 @@ async def async_save_related_tracks(track):
     
     try:
         track_id_shazam = track.key_track_shazam
-        shazam = Shazam()
+        shazam = shazam_client()
         tracks = await shazam_related_tracks(track_id_shazam, limit=30, shazam=shazam)
         
         if tracks:                    
@@ -50,16 +52,58 @@ async def async_save_related_tracks(track):
     
     
 def save_related_tracks(track):
+    # Shazam, Spotify and Apple calls all share one event loop and one aiohttp session
+    return run_async(async_save_related_tracks(track))
+
+
+RELATED_TRACKS_TOP_K = 30
+RELATED_TRACKS_WINDOW = 3 # tracks played up to 3 positions apart count as transitions
+RELATED_TRACKS_INSERT_BATCH = 5000
+
+
+def rebuild_related_tracks_from_sets(top_k=RELATED_TRACKS_TOP_K, window=RELATED_TRACKS_WINDOW):
+    """
+    Computes related tracks offline, from what DJs play together, and stores them in RelatedTracks.
+    Only tracks that were never fetched from Shazam (related_tracks_checked False) are (re)written,
+    so that /related_tracks is served from the database without any external call.
+
+    Returns:
+        dict: {'message': ...} with the number of tracks and rows written.
+    """
+    rows = (
+        db.session.query(TrackSet.set_id, TrackSet.track_id, TrackSet.pos)
+        .join(Set, Set.id == TrackSet.set_id)
+        .filter(Set.published == True, Set.hidden == False, TrackSet.track_id != 1) # 1 is the unknown track
+        .all()
+    )
+    if not rows:
+        return {'message': 'No track sets found, nothing to compute'}
+
+    set_ids, track_ids, positions = zip(*rows)
+    scores, tracks = build_cooccurrence_matrix(set_ids, track_ids, positions, window=window)
+    neighbours = top_k_neighbours(scores, tracks, k=top_k)
+    logger.info(f'Computed related tracks for {len(neighbours)} tracks from {len(rows)} track sets')
+
+    unchecked_ids = {track_id for (track_id,) in db.session.query(Track.id).filter(Track.related_tracks_checked.isnot(True))}
+
     try:
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            return asyncio.ensure_future(async_save_related_tracks(track))  # Run inside existing loop
-        else:
-            return loop.run_until_complete(async_save_related_tracks(track))
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        return loop.run_until_complete(async_save_related_tracks(track))
-    finally:
-        if not loop.is_running():
-            loop.close()
\ No newline at end of file
+        db.session.execute(RelatedTracks.__table__.delete().where(RelatedTracks.track_id.in_(
+            db.session.query(Track.id).filter(Track.related_tracks_checked.isnot(True))
+        )))
+
+        entries = [
+            {'track_id': track_id, 'related_track_id': related_id, 'insertion_order': i}
+            for track_id, related in neighbours.items() if track_id in unchecked_ids
+            for i, (related_id, _score) in enumerate(related)
+        ]
+        for start in range(0, len(entries), RELATED_TRACKS_INSERT_BATCH):
+            db.session.execute(RelatedTracks.__table__.insert(), entries[start:start + RELATED_TRACKS_INSERT_BATCH])
+
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f'Error saving related tracks from sets: {e}')
+        return {'error': f'Error saving related tracks from sets: {e}'}
+
+    nb_tracks = len({entry['track_id'] for entry in entries})
+    return {'message': f'{len(entries)} related tracks saved for {nb_tracks} tracks'}
@@ -0,0 +1,309 @@
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import and_, bindparam, func, or_, select, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+
+from web.model import Channel, Genre, Set, SyncIdMap, Track, TrackGenres, TrackSet
+from web.logger import logger
+from web.lib.change_log import consume_changes
+from web.lib.metrics import SYNC_REMOTE_TRACK_CHANGES, observe_sync_progress, push_metrics
+
+# Sets are replicated by batches : every batch is a handful of multi rows statements and one commit on the target
+SYNC_BATCH_SETS = int(os.getenv('SYNC_BATCH_SETS', 500))
+SYNC_INSERT_PAGE = 1000 # rows per multi rows INSERT
+SYNC_CONSUMER = 'sync_remote' # of the change log, for the updates of the tracks already replicated
+TRACK_TARGET_COLUMNS = ('id', 'nb_sets') # maintained by the target
+
+
+def chunks(rows, size=SYNC_INSERT_PAGE):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def fetch_rows(conn, table, column, values):
+    """ All the rows of `table` where `column` is in `values`, as dicts. """
+    rows = []
+    for page in chunks(list(values), 10000):
+        rows.extend(dict(row._mapping) for row in conn.execute(select(table).where(column.in_(page))))
+    return rows
+
+
+def upsert_by_id(conn, table, rows):
+    """ Multi rows INSERT ... ON CONFLICT (id) DO UPDATE, for the tables whose ids are the same on both sides. """
+    for page in chunks(rows):
+        statement = insert(table).values(page)
+        conn.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.id],
+            set_={column.name: statement.excluded[column.name] for column in table.columns if column.name != 'id'},
+        ))
+
+
+def reset_sequence(conn, table):
+    # once per batch instead of after every row with a preserved id
+    conn.execute(text(f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), (SELECT COALESCE(MAX(id), 1) FROM {table.name}))"))
+
+
+def load_id_map(conn, entity, source_ids):
+    table = SyncIdMap.__table__
+    id_map = {}
+    for page in chunks(list(source_ids), 10000):
+        id_map.update(conn.execute(
+            select(table.c.source_id, table.c.target_id).where(table.c.entity == entity, table.c.source_id.in_(page))
+        ).all())
+    return id_map
+
+
+def save_id_map(conn, entity, id_map):
+    table = SyncIdMap.__table__
+    rows = [{'entity': entity, 'source_id': source_id, 'target_id': target_id} for source_id, target_id in id_map.items()]
+    for page in chunks(rows):
+        statement = insert(table).values(page)
+        conn.execute(statement.on_conflict_do_update(index_elements=[table.c.entity, table.c.source_id], set_={'target_id': statement.excluded.target_id}))
+
+
+TRACK_KEYS = ('key_track_shazam', 'key_track_apple', 'key_track_spotify') # same lookup order as format.prepare_track_for_insertion
+
+
+def match_tracks_by_keys(conn, source_tracks):
+    """ source track id -> target track id, for the source tracks already in the target under one of their keys. """
+    table = Track.__table__
+    by_key = {key: {} for key in TRACK_KEYS}
+    filters = []
+    for key in TRACK_KEYS:
+        values = {track[key] for track in source_tracks if track[key] is not None}
+        if values:
+            filters.append(table.c[key].in_(values))
+    if not filters:
+        return {}
+
+    for row in conn.execute(select(table.c.id, *[table.c[key] for key in TRACK_KEYS]).where(or_(*filters))):
+        for key in TRACK_KEYS:
+            if row._mapping[key] is not None:
+                by_key[key][row._mapping[key]] = row.id
+
+    matched = {}
+    for track in source_tracks:
+        for key in TRACK_KEYS:
+            target_id = by_key[key].get(track[key])
+            if track[key] is not None and target_id is not None:
+                matched[track['id']] = target_id
+                break
+    return matched
+
+
+def replicate_tracks(source, target, track_ids):
+    """
+    Makes sure every source track exists on the target, and returns the source id -> target id mapping.
+    Track ids differ between the two databases : mappings are kept in sync_id_map, new tracks are matched by key first,
+    then inserted with ON CONFLICT DO NOTHING (any of the unique keys) and matched again.
+    """
+    id_map = load_id_map(target, 'tracks', track_ids)
+    missing = [track_id for track_id in track_ids if track_id not in id_map]
+    if not missing:
+        return id_map
+
+    source_tracks = fetch_rows(source, Track.__table__, Track.__table__.c.id, missing)
+    new_map = match_tracks_by_keys(target, source_tracks)
+
+    to_insert = [{key: value for key, value in track.items() if key != 'id'} for track in source_tracks if track['id'] not in new_map]
+    for page in chunks(to_insert):
+        target.execute(insert(Track.__table__).values(page).on_conflict_do_nothing())
+    if to_insert:
+        new_map.update(match_tracks_by_keys(target, [track for track in source_tracks if track['id'] not in new_map]))
+
+    save_id_map(target, 'tracks', new_map)
+    id_map.update(new_map)
+    return id_map
+
+
+def replicate_genres(source, target, source_track_ids, track_map):
+    """ Copies the genres of the tracks (matched by name) and their track_genres rows. Returns the target genre ids touched. """
+    rows = source.execute(
+        select(TrackGenres.__table__.c.track_id, Genre.__table__.c.name)
+        .join(Genre.__table__, Genre.__table__.c.id == TrackGenres.__table__.c.genre_id)
+        .where(TrackGenres.__table__.c.track_id.in_(source_track_ids))
+    ).all()
+    if not rows:
+        return set()
+
+    names = sorted({name for _, name in rows})
+    for page in chunks(names):
+        target.execute(insert(Genre.__table__).values([{'name': name, 'track_count': 0} for name in page]).on_conflict_do_nothing(index_elements=['name']))
+    genre_map = dict(target.execute(select(Genre.__table__.c.name, Genre.__table__.c.id).where(Genre.__table__.c.name.in_(names))).all())
+
+    track_genres = [{'track_id': track_map[track_id], 'genre_id': genre_map[name]} for track_id, name in rows if track_id in track_map]
+    for page in chunks(track_genres):
+        target.execute(insert(TrackGenres.__table__).values(page).on_conflict_do_nothing())
+    return set(genre_map.values())
+
+
+def recount_genres(target, genre_ids):
+    # counter maintained by the ORM on the source side
+    if genre_ids:
+        target.execute(
+            Genre.__table__.update().where(Genre.__table__.c.id.in_(genre_ids)).values(
+                track_count=select(func.count()).where(TrackGenres.__table__.c.genre_id == Genre.__table__.c.id).scalar_subquery()
+            )
+        )
+
+
+def replicate_track_updates(source, target, track_ids):
+    """
+    Copies the current columns and genres of the source tracks already on the target (the others come with their sets) :
+    Spotify / Apple enrichment, related tracks flags... A track whose new key belongs to another target track is skipped.
+
+    Returns:
+        int: number of tracks updated.
+    """
+    id_map = load_id_map(target, 'tracks', track_ids)
+    if not id_map:
+        return 0
+    table = Track.__table__
+    columns = [column.name for column in table.columns if column.name not in TRACK_TARGET_COLUMNS]
+    rows = [{'target_id': id_map[track['id']], **{f'new_{column}': track[column] for column in columns}}
+            for track in fetch_rows(source, table, table.c.id, id_map)]
+    statement = table.update().where(table.c.id == bindparam('target_id')).values({column: bindparam(f'new_{column}') for column in columns})
+    nb_updated = len(rows)
+    try:
+        if rows: # none for tracks deleted since, only their genres go
+            with target.begin_nested():
+                target.execute(statement, rows)
+    except IntegrityError:
+        # one at a time, to skip the tracks whose keys collide
+        for row in rows:
+            try:
+                with target.begin_nested():
+                    target.execute(statement, [row])
+            except IntegrityError as e:
+                nb_updated -= 1
+                logger.warning(f"Sync : track {row['target_id']} not updated, a key is taken: {e.orig}")
+
+    # the genres of a track are replaced as a whole
+    track_genres = TrackGenres.__table__
+    target_ids = list(id_map.values())
+    old_genre_ids = {genre_id for (genre_id,) in target.execute(select(track_genres.c.genre_id).where(track_genres.c.track_id.in_(target_ids)))}
+    target.execute(track_genres.delete().where(track_genres.c.track_id.in_(target_ids)))
+    genre_ids = replicate_genres(source, target, list(id_map), id_map)
+    recount_genres(target, old_genre_ids | genre_ids)
+    return nb_updated
+
+
+def sync_track_changes(source_engine, target_engine):
+    """
+    Replicates the updates of the tracks already on the target, from the change log (tracks and track_genres),
+    the sets high-water mark does not see them.
+
+    Returns:
+        dict: {'message': ...} or {'error': ...}
+    """
+    def apply(changes):
+        # a deleted track_genres row is a track whose genres changed, they are replaced as a whole
+        track_ids = sorted({change['row_id'] for change in changes if change['op'] != 'D' or change['table_name'] != 'tracks'})
+        if not track_ids:
+            return
+        with source_engine.connect() as source, target_engine.begin() as target:
+            nb_updated = replicate_track_updates(source, target, track_ids)
+        SYNC_REMOTE_TRACK_CHANGES.inc(nb_updated)
+
+    return consume_changes(SYNC_CONSUMER, apply, tables=['tracks', 'track_genres'])
+
+
+def replicate_sets_batch(source, target, sets):
+    """ Replicates a batch of sets with their channels, tracks, genres and track sets. """
+    set_ids = [s['id'] for s in sets]
+
+    channels = fetch_rows(source, Channel.__table__, Channel.__table__.c.id, {s['channel_id'] for s in sets})
+    upsert_by_id(target, Channel.__table__, channels)
+    upsert_by_id(target, Set.__table__, sets)
+
+    track_sets = fetch_rows(source, TrackSet.__table__, TrackSet.__table__.c.set_id, set_ids)
+    source_track_ids = sorted({track_set['track_id'] for track_set in track_sets})
+    track_map = replicate_tracks(source, target, source_track_ids)
+    genre_ids = replicate_genres(source, target, source_track_ids, track_map)
+
+    # the track sets of a set are replaced as a whole, a reprocessed set can have different tracks
+    old_track_ids = {track_id for (track_id,) in target.execute(select(TrackSet.__table__.c.track_id).where(TrackSet.__table__.c.set_id.in_(set_ids)))}
+    target.execute(TrackSet.__table__.delete().where(TrackSet.__table__.c.set_id.in_(set_ids)))
+    rows = [{**track_set, 'track_id': track_map[track_set['track_id']]} for track_set in track_sets if track_set['track_id'] in track_map]
+    for page in chunks(rows):
+        target.execute(insert(TrackSet.__table__).values(page).on_conflict_do_nothing())
+
+    # counters maintained by the ORM on the source side
+    touched_track_ids = old_track_ids | set(track_map.values())
+    if touched_track_ids:
+        target.execute(
+            Track.__table__.update().where(Track.__table__.c.id.in_(touched_track_ids)).values(
+                nb_sets=select(func.count(func.distinct(TrackSet.__table__.c.set_id))).where(TrackSet.__table__.c.track_id == Track.__table__.c.id).scalar_subquery()
+            )
+        )
+    recount_genres(target, genre_ids)
+
+    reset_sequence(target, Channel.__table__)
+    reset_sequence(target, Set.__table__)
+    return len(rows)
+
+
+def sync_lag_s(source_max, replicated_max):
+    return (source_max - replicated_max).total_seconds() if source_max else 0
+
+
+def sync_remote(source_engine, target_engine, batch_size=SYNC_BATCH_SETS, max_batches=None):
+    """
+    Replicates the sets updated since the high-water mark (the latest updated_at on the target),
+    batch after batch, until the target has caught up, then the updates of the tracks already replicated.
+    The lag, rate and remaining sets gauges are updated (and pushed) after every batch.
+
+    Returns:
+        dict: {'message': ...} with the number of sets and track sets replicated, or {'error': ...}
+    """
+    SyncIdMap.__table__.create(bind=target_engine, checkfirst=True)
+
+    with target_engine.connect() as target:
+        high_water_mark = target.execute(select(func.max(Set.__table__.c.updated_at))).scalar() or datetime.min
+    # sets sharing the high-water mark may not all be there yet, they are upserted again
+    cursor = (high_water_mark, 0)
+
+    with source_engine.connect() as source:
+        source_max = source.execute(select(func.max(Set.__table__.c.updated_at))).scalar()
+        remaining = source.execute(select(func.count()).where(Set.__table__.c.updated_at >= high_water_mark)).scalar()
+    logger.info(f'Sync : {remaining} sets to replicate, lag {(source_max - high_water_mark) if source_max else 0}')
+    observe_sync_progress(sync_lag_s(source_max, high_water_mark), 0, remaining)
+    push_metrics(SYNC_CONSUMER)
+
+    start = time.time()
+    nb_sets, nb_track_sets, nb_batches = 0, 0, 0
+    while max_batches is None or nb_batches < max_batches:
+        set_table = Set.__table__
+        with source_engine.connect() as source:
+            sets = [dict(row._mapping) for row in source.execute(
+                select(set_table)
+                .where(or_(set_table.c.updated_at > cursor[0], and_(set_table.c.updated_at == cursor[0], set_table.c.id > cursor[1])))
+                .order_by(set_table.c.updated_at, set_table.c.id)
+                .limit(batch_size)
+            )]
+            if not sets:
+                break
+
+            try:
+                with target_engine.begin() as target:
+                    nb_track_sets += replicate_sets_batch(source, target, sets)
+            except Exception as e:
+                logger.error(f"Error replicating sets {sets[0]['id']} to {sets[-1]['id']}: {e}")
+                return {'error': f"Error replicating sets {sets[0]['id']} to {sets[-1]['id']}: {e}"}
+
+        cursor = (sets[-1]['updated_at'], sets[-1]['id'])
+        nb_sets += len(sets)
+        nb_batches += 1
+        elapsed = time.time() - start
+        logger.info(f'Sync : {nb_sets}/{remaining} sets ({nb_sets / elapsed * 60:.0f} sets/min), '
+                    f'lag {(source_max - cursor[0]) if source_max else 0}')
+        observe_sync_progress(sync_lag_s(source_max, cursor[0]), nb_sets / elapsed * 60, max(remaining - nb_sets, 0))
+        push_metrics(SYNC_CONSUMER)
+
+    result = sync_track_changes(source_engine, target_engine)
+    if 'error' in result:
+        return result
+    return {'message': f'{nb_sets} sets and {nb_track_sets} track sets replicated in {time.time() - start:.1f}s, {result["message"]}'}
@@ -0,0 +1,281 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import func
+
+from boilersaas.utils.db import db
+from web.model import Set, TrackGenres, TrackSet
+from web.logger import logger
+from web.lib.metrics import count_cache
+
+# Index of published sets, as L2 normalised TF-IDF rows over 3 kinds of features :
+# tracks played (t<id>), genres of those tracks (g<id>) and the set artist popularity bucket (p<bucket>).
+# Stored as a .npz file, rebuilt by cron_related_tracks.py, plus a log of the sets published since (<path>.added),
+# so that the web processes pick up the publications of the insert worker. Shared by the web app and the workers.
+APP_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SET_SIMILARITY_INDEX_PATH = os.getenv('SET_SIMILARITY_INDEX_PATH', os.path.join(APP_DIR, 'set_similarity_index.npz'))
+
+GENRE_WEIGHT = 0.5 # a shared track says more than a shared genre
+POPULARITY_WEIGHT = 0.25
+POPULARITY_BUCKET_SIZE = 10 # artist_popularity_spotify is 0-100
+
+
+class SetSimilarityIndex:
+    """
+    Cosine similarity over sparse TF-IDF set vectors.
+    The base (build / load) is normalised as a whole. The sets added afterwards are kept apart, weighted with the idf
+    of the base, so that adding one costs its own features only. Their idf drift is reset by the next build.
+    """
+
+    def __init__(self):
+        self.set_ids = np.zeros(0, dtype=np.int64)
+        self.set_rows = {}  # set id -> row
+        self.vocabulary = {}  # feature -> column
+        self.counts = sparse.csr_matrix((0, 0), dtype=np.float32)  # raw feature weights, one row per set
+        self.idf = np.zeros(0, dtype=np.float32)
+        self.matrix = self.counts  # normalised tf-idf rows
+        self.columns = self.counts.tocsc()
+        self.superseded = np.zeros(0, dtype=bool)  # base rows replaced by an added set
+        self.added = {}  # set id -> (columns, normalised weights) of the sets added since the base
+        self.added_ids = np.zeros(0, dtype=np.int64)
+        self.added_matrix = sparse.csr_matrix((0, 0), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.set_ids) + sum(1 for set_id in self.added if set_id not in self.set_rows)
+
+    def _feature_columns(self, features):
+        cols, weights = [], []
+        for feature, weight in features.items():
+            if feature not in self.vocabulary:
+                self.vocabulary[feature] = len(self.vocabulary)
+            cols.append(self.vocabulary[feature])
+            weights.append(weight)
+        return cols, weights
+
+    def build(self, sets_features):
+        """ sets_features: dict set id -> {feature: weight} """
+        self.__init__()
+        rows, cols, data = [], [], []
+        for row, (set_id, features) in enumerate(sets_features.items()):
+            self.set_rows[set_id] = row
+            set_cols, set_weights = self._feature_columns(features)
+            rows.extend([row] * len(set_cols))
+            cols.extend(set_cols)
+            data.extend(set_weights)
+        self.set_ids = np.fromiter(sets_features.keys(), dtype=np.int64, count=len(sets_features))
+        self.counts = sparse.csr_matrix((np.asarray(data, dtype=np.float32), (rows, cols)), shape=(len(self.set_ids), len(self.vocabulary)))
+        self._normalise()
+        return self
+
+    def add_set(self, set_id, features):
+        """ Adds a set, or replaces its vector if it is already indexed. The base is left as it is. """
+        set_cols, set_weights = self._feature_columns(features)
+        cols = np.asarray(set_cols, dtype=np.int64)
+        # a feature unknown to the base is in this set only
+        idf = np.full(len(cols), np.log((1 + max(len(self.set_ids), 1)) / 2) + 1, dtype=np.float32)
+        known = cols < len(self.idf)
+        idf[known] = self.idf[cols[known]]
+        values = np.asarray(set_weights, dtype=np.float32) * idf
+        norm = np.sqrt(np.sum(values ** 2)) or 1
+
+        if set_id in self.set_rows:
+            self.superseded[self.set_rows[set_id]] = True
+        self.added[set_id] = (cols, (values / norm).astype(np.float32))
+        self._stack_added()
+
+    def _stack_added(self):
+        # the added sets only, a few per day between two builds
+        vectors = list(self.added.values())
+        rows = np.concatenate([np.full(len(cols), row, dtype=np.int64) for row, (cols, _values) in enumerate(vectors)])
+        cols = np.concatenate([cols for cols, _values in vectors])
+        data = np.concatenate([values for _cols, values in vectors])
+        self.added_ids = np.fromiter(self.added.keys(), dtype=np.int64, count=len(self.added))
+        self.added_matrix = sparse.csr_matrix((data, (rows, cols)), shape=(len(vectors), len(self.vocabulary)), dtype=np.float32)
+
+    def _normalise(self):
+        n_sets = max(self.counts.shape[0], 1)
+        df = np.bincount(self.counts.indices, minlength=self.counts.shape[1])
+        self.idf = np.log((1 + n_sets) / (1 + df)).astype(np.float32) + 1
+        matrix = sparse.csr_matrix(self.counts.multiply(self.idf[np.newaxis, :]), dtype=np.float32)
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        self.matrix = sparse.csr_matrix(sparse.diags(1 / norms) @ matrix, dtype=np.float32)
+        self.columns = self.matrix.tocsc()  # feature -> sets, queries only touch the columns of the queried set
+        self.superseded = np.zeros(self.counts.shape[0], dtype=bool)
+
+    def _vector(self, set_id):
+        if set_id in self.added:
+            return self.added[set_id]
+        row = self.set_rows.get(set_id)
+        if row is None:
+            return None
+        query = self.matrix[row]
+        return query.indices, query.data
+
+    def similar(self, set_id, k=10):
+        """ Returns [(set id, cosine similarity)] of the k most similar sets, best first. """
+        vector = self._vector(set_id)
+        if vector is None:
+            return []
+        cols, values = vector
+        in_base = cols < self.columns.shape[1]
+        base_scores = self.columns[:, cols[in_base]] @ values[in_base]
+        base_scores[self.superseded] = 0
+        added_scores = self.added_matrix[:, cols] @ values if self.added else np.zeros(0, dtype=np.float32)
+        scores = np.concatenate([base_scores, added_scores])
+        set_ids = np.concatenate([self.set_ids, self.added_ids])
+        scores[set_ids == set_id] = 0
+
+        k = min(k, len(scores) - 1)
+        if k <= 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        best = best[np.lexsort((set_ids[best], -scores[best]))]
+        return [(int(set_ids[i]), float(scores[i])) for i in best if scores[i] > 0]
+
+    def save(self, path=SET_SIMILARITY_INDEX_PATH):
+        """ Writes the base, the sets added since are in the log of the path (see update_set_similarity_index). """
+        # written next to the target then renamed, readers never see a half written file
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        vocabulary = np.array(sorted(self.vocabulary, key=self.vocabulary.get), dtype=str)
+        np.savez(tmp_path, set_ids=self.set_ids, vocabulary=vocabulary,
+                 data=self.counts.data, indices=self.counts.indices, indptr=self.counts.indptr,
+                 shape=np.array(self.counts.shape))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=SET_SIMILARITY_INDEX_PATH):
+        """ The base only, see replay_added_sets. """
+        index = cls()
+        with np.load(path) as stored:
+            index.set_ids = stored['set_ids']
+            index.vocabulary = {feature: col for col, feature in enumerate(stored['vocabulary'].tolist())}
+            index.counts = sparse.csr_matrix((stored['data'], stored['indices'], stored['indptr']), shape=tuple(stored['shape']))
+        index.set_rows = {int(set_id): row for row, set_id in enumerate(index.set_ids)}
+        index._normalise()
+        return index
+
+
+def added_sets_path(path):
+    return f'{path}.added'
+
+
+@contextmanager
+def index_lock(path):
+    """ Serialises the writers of the index at path (publications, builds) across processes. """
+    with open(f'{path}.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def replay_added_sets(index, path, offset=0):
+    """
+    Adds to index the sets logged since offset in the log of path (one json line per published set).
+    Returns the offset after the last complete line, a line being written is read next time.
+    """
+    try:
+        log = open(added_sets_path(path), 'rb')
+    except FileNotFoundError:
+        return 0
+    with log:
+        log.seek(offset)
+        for line in log:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            added = json.loads(line)
+            index.add_set(added['set_id'], added['features'])
+    return offset
+
+
+def popularity_feature(artist_popularity_spotify):
+    if artist_popularity_spotify is None:
+        return {}
+    return {f'p{int(artist_popularity_spotify) // POPULARITY_BUCKET_SIZE}': POPULARITY_WEIGHT}
+
+
+def get_sets_features(set_ids=None):
+    """ Returns dict set id -> {feature: weight} for the published sets (or only the given ones). """
+    sets_query = db.session.query(Set.id, Set.artist_popularity_spotify).filter(Set.published == True, Set.hidden == False)
+    tracks_query = db.session.query(TrackSet.set_id, TrackSet.track_id).join(Set, Set.id == TrackSet.set_id) \
+        .filter(Set.published == True, Set.hidden == False, TrackSet.track_id != 1).distinct()
+    genres_query = db.session.query(TrackSet.set_id, TrackGenres.genre_id, func.count(TrackGenres.genre_id)) \
+        .join(TrackGenres, TrackGenres.track_id == TrackSet.track_id) \
+        .join(Set, Set.id == TrackSet.set_id) \
+        .filter(Set.published == True, Set.hidden == False) \
+        .group_by(TrackSet.set_id, TrackGenres.genre_id)
+
+    if set_ids is not None:
+        sets_query = sets_query.filter(Set.id.in_(set_ids))
+        tracks_query = tracks_query.filter(TrackSet.set_id.in_(set_ids))
+        genres_query = genres_query.filter(TrackSet.set_id.in_(set_ids))
+
+    features = {set_id: popularity_feature(popularity) for set_id, popularity in sets_query}
+    for set_id, track_id in tracks_query:
+        if set_id in features:
+            features[set_id][f't{track_id}'] = 1.0
+    for set_id, genre_id, count in genres_query:
+        if set_id in features:
+            features[set_id][f'g{genre_id}'] = GENRE_WEIGHT * float(np.log1p(count))
+    return features
+
+
+set_similarity_index = {'index': None, 'mtime': None, 'offset': 0, 'missing_logged': False}
+
+def build_set_similarity_index(path=SET_SIMILARITY_INDEX_PATH):
+    """ Full rebuild from the database, the log of the sets added since folded in. Also resets their idf drift. """
+    with index_lock(path): # a publication waits, or it is in the database read here
+        index = SetSimilarityIndex().build(get_sets_features())
+        index.save(path)
+        open(added_sets_path(path), 'w').close()
+    set_similarity_index.update(index=index, mtime=os.path.getmtime(path), offset=0)
+    logger.info(f'Set similarity index built with {len(index)} sets and {len(index.vocabulary)} features')
+    return index
+
+
+def get_set_similarity_index(path=SET_SIMILARITY_INDEX_PATH):
+    """
+    Returns the index of this process, with the sets published by other processes since it was loaded.
+    Empty until cron_related_tracks.py has built it : it is never built within a request.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        if not set_similarity_index['missing_logged']:
+            logger.warning(f'No set similarity index at {path} yet, no similar sets until it is built')
+            set_similarity_index['missing_logged'] = True
+        return SetSimilarityIndex()
+
+    try:
+        log_size = os.path.getsize(added_sets_path(path))
+    except OSError:
+        log_size = 0
+    up_to_date = set_similarity_index['index'] is not None and set_similarity_index['mtime'] == mtime
+    count_cache('set_similarity_index', up_to_date and log_size == set_similarity_index['offset'])
+    if not up_to_date or log_size < set_similarity_index['offset']: # rebuilt, the log folded in
+        set_similarity_index.update(index=SetSimilarityIndex.load(path), mtime=mtime, offset=0)
+    if log_size != set_similarity_index['offset']:
+        set_similarity_index['offset'] = replay_added_sets(set_similarity_index['index'], path, set_similarity_index['offset'])
+    return set_similarity_index['index']
+
+
+def update_set_similarity_index(set_id, path=SET_SIMILARITY_INDEX_PATH):
+    """
+    Logs one set as added or refreshed, called when a set is published : the readers add it to their index,
+    the next build folds it in. Nothing to do before the first build, it will include the set.
+    """
+    features = get_sets_features([set_id]).get(set_id)
+    if features is None:
+        return
+    with index_lock(path):
+        if not os.path.exists(path):
+            return
+        with open(added_sets_path(path), 'a') as log:
+            log.write(json.dumps({'set_id': set_id, 'features': features}) + '\n')
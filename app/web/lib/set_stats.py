@@ -0,0 +1,170 @@
+import os
+import numpy as np
+from sqlalchemy import or_
+from sqlalchemy.dialects.postgresql import insert
+
+from boilersaas.utils.db import db
+from web.model import Genre, Set, SetStats, Track, TrackGenres, TrackSet
+from web.logger import logger
+from web.lib.metrics import count_cache
+
+SET_STATS_BATCH = int(os.getenv('SET_STATS_BATCH', 2000)) # sets computed (and upserted) at once
+
+
+def grouped_percentages(group_ids, values):
+    """
+    Share of each value within its group, for many groups at once.
+
+    Args:
+        group_ids, values (array-like): One entry per occurrence.
+
+    Returns:
+        dict: group id -> {value: percentage}, highest first (ties by value).
+    """
+    group_ids = np.asarray(group_ids)
+    if not len(group_ids):
+        return {}
+    uniq_values, value_idx = np.unique(np.asarray(values), return_inverse=True)
+    groups, group_idx = np.unique(group_ids, return_inverse=True)
+
+    pairs, counts = np.unique(group_idx.astype(np.int64) * len(uniq_values) + value_idx, return_counts=True)
+    pair_groups, pair_values = pairs // len(uniq_values), pairs % len(uniq_values)
+    totals = np.bincount(pair_groups, weights=counts)
+    percentages = counts * 100 / totals[pair_groups]
+    percentages = np.floor(percentages + 1e-9).astype(int) # as int(count / total * 100)
+
+    order = np.lexsort((pair_values, -percentages, pair_groups))
+    distribution = {}
+    for i in order:
+        distribution.setdefault(groups[pair_groups[i]].item(), {})[uniq_values[pair_values[i]].item()] = percentages[i].item()
+    return distribution
+
+
+def grouped_means(group_ids, values):
+    """ Mean of the non NaN values of each group, as a dict group id -> int (groups with no value are left out). """
+    group_ids = np.asarray(group_ids)
+    values = np.asarray(values, dtype=float)
+    known = ~np.isnan(values)
+    if not known.any():
+        return {}
+    groups, group_idx = np.unique(group_ids[known], return_inverse=True)
+    means = np.bincount(group_idx, weights=values[known]) / np.bincount(group_idx)
+    return {group.item(): int(mean) for group, mean in zip(groups, means)}
+
+
+def compute_sets_stats(set_ids, release_years, popularities, genre_set_ids, genre_names):
+    """
+    Computes the SetStats columns of many sets at once.
+
+    Args:
+        set_ids, release_years, popularities (array-like): One entry per known track of a set (NaN when unknown).
+        genre_set_ids, genre_names (array-like): One entry per (track of a set, genre of the track).
+
+    Returns:
+        dict: set id -> dict of SetStats columns.
+    """
+    set_ids = np.asarray(set_ids)
+    release_years = np.asarray(release_years, dtype=float)
+
+    sets, nb_tracks = np.unique(set_ids, return_counts=True)
+    avg_release_years = grouped_means(set_ids, release_years)
+    avg_popularities = grouped_means(set_ids, popularities)
+    genres = grouped_percentages(genre_set_ids, genre_names)
+
+    stats = {}
+    for set_id, count in zip(sets.tolist(), nb_tracks.tolist()):
+        stats[set_id] = {
+            'set_id': set_id,
+            'nb_tracks': count,
+            'genres': [{'name': name, 'percentage': percentage} for name, percentage in genres.get(set_id, {}).items()],
+            'avg_release_year': avg_release_years.get(set_id),
+            'avg_artist_popularity_spotify': avg_popularities.get(set_id),
+            'stale': False,
+        }
+    return stats
+
+
+def refresh_sets_stats(set_ids):
+    """
+    Recomputes and upserts the SetStats rows of set_ids, in one pass over their tracks.
+
+    Args:
+        set_ids (list): The sets to refresh.
+
+    Returns:
+        int: The number of rows written.
+    """
+    set_ids = list(set_ids)
+    if not set_ids:
+        return 0
+
+    track_rows = (
+        db.session.query(TrackSet.set_id, Track.release_year, Track.artist_popularity_spotify)
+        .join(Track, Track.id == TrackSet.track_id)
+        .filter(TrackSet.set_id.in_(set_ids), TrackSet.track_id != 1) # 1 is the unknown track
+        .all()
+    )
+    genre_rows = (
+        db.session.query(TrackSet.set_id, Genre.name)
+        .join(TrackGenres, TrackGenres.track_id == TrackSet.track_id)
+        .join(Genre, Genre.id == TrackGenres.genre_id)
+        .filter(TrackSet.set_id.in_(set_ids))
+        .all()
+    )
+
+    track_set_ids, release_years, popularities = (np.array(column, dtype=float) for column in zip(*track_rows)) if track_rows else ([], [], [])
+    genre_set_ids, genre_names = zip(*genre_rows) if genre_rows else ([], [])
+
+    stats = compute_sets_stats(np.asarray(track_set_ids, dtype=int), release_years, popularities,
+                               genre_set_ids, genre_names)
+    # sets without any known track still get a row, so that the cron does not recompute them every time
+    for set_id in set_ids:
+        stats.setdefault(set_id, {'set_id': set_id, 'nb_tracks': 0, 'genres': [],
+                                  'avg_release_year': None, 'avg_artist_popularity_spotify': None, 'stale': False})
+
+    rows = list(stats.values())
+
+    statement = insert(SetStats.__table__).values(rows)
+    updated = {key: statement.excluded[key] for key in rows[0] if key != 'set_id'}
+    updated['updated_at'] = db.func.current_timestamp()
+    db.session.execute(statement.on_conflict_do_update(index_elements=['set_id'], set_=updated))
+    db.session.commit()
+    return len(rows)
+
+
+def refresh_stale_sets_stats(batch_size=SET_STATS_BATCH):
+    """
+    Computes the stats of the published sets that have none yet (backfill), or whose tracks changed since.
+    Runs by batches of batch_size sets, each one computed with a single vectorised pass.
+
+    Returns:
+        dict: {'message': ...} or {'error': ...}
+    """
+    set_ids = [set_id for (set_id,) in (
+        db.session.query(Set.id)
+        .outerjoin(SetStats, SetStats.set_id == Set.id)
+        .filter(Set.published == True, or_(SetStats.set_id.is_(None), SetStats.stale == True))
+        .order_by(Set.id)
+        .all()
+    )]
+
+    nb_rows = 0
+    for start in range(0, len(set_ids), batch_size):
+        try:
+            nb_rows += refresh_sets_stats(set_ids[start:start + batch_size])
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f'Error computing set stats: {e}')
+            return {'error': f'Error computing set stats: {e}'}
+
+    return {'message': f'Stats computed for {nb_rows} sets'}
+
+
+def get_set_stats(set_id):
+    """
+    Returns the stored SetStats of a set, None if it has none yet. Read only : the stats are computed on publish
+    and by the cron (refresh_stale_sets_stats), a stale row is served until then.
+    """
+    set_stats = db.session.get(SetStats, set_id)
+    count_cache('set_stats', set_stats is not None and not set_stats.stale)
+    return set_stats
@@ -0,0 +1,121 @@
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import logging
+logger = logging.getLogger('root')
+
+# Per-stage instrumentation of a long job (insert_set). Counters are process wide :
+# anything that runs while a tracer is active (threads, event loops) is attributed to the current span.
+SPAN_COUNTERS = ('bytes_downloaded', 'external_calls', 'db_round_trips')
+RSS_SAMPLE_INTERVAL_S = 0.2
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+current_tracer = {'tracer': None}
+
+
+def current_rss_mb():
+    """ Resident memory of this process, in MB. Falls back to the lifetime peak where /proc is missing. """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def cpu_time_s():
+    """ CPU time of this process and of its waited for children (ffmpeg). """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+class StageTracer:
+    """ Collects one span per stage : wall time, CPU time, peak RSS and the SPAN_COUNTERS. """
+
+    def __init__(self):
+        self.started_at = datetime.now(timezone.utc)
+        self.spans = []
+        self.counters = dict.fromkeys(SPAN_COUNTERS, 0)
+        self.peak_rss_mb = 0
+        self.lock = threading.Lock()
+        self.sampling = threading.Event()
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def sample_rss(self):
+        while not self.sampling.wait(RSS_SAMPLE_INTERVAL_S):
+            self.peak_rss_mb = max(self.peak_rss_mb, current_rss_mb())
+
+    @contextmanager
+    def span(self, stage):
+        counters_before = dict(self.counters)
+        cpu_before = cpu_time_s()
+        wall_before = time.perf_counter()
+        self.peak_rss_mb = current_rss_mb()
+        self.sampling.clear()
+        sampler = threading.Thread(target=self.sample_rss, daemon=True)
+        sampler.start()
+
+        status = 'ok'
+        try:
+            yield self
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            self.sampling.set()
+            sampler.join()
+            span = {
+                'stage': stage,
+                'status': status,
+                'wall_s': time.perf_counter() - wall_before,
+                'cpu_s': cpu_time_s() - cpu_before,
+                'peak_rss_mb': max(self.peak_rss_mb, current_rss_mb()),
+            }
+            span.update({counter: self.counters[counter] - counters_before[counter] for counter in SPAN_COUNTERS})
+            self.spans.append(span)
+            logger.info(f"Stage {stage} {status} in {span['wall_s']:.1f}s (cpu {span['cpu_s']:.1f}s, "
+                        f"{span['external_calls']} calls, {span['db_round_trips']} db round trips)")
+
+
+@contextmanager
+def trace_stages():
+    """ Makes a new StageTracer the current one for the duration of the block. """
+    tracer = StageTracer()
+    current_tracer['tracer'] = tracer
+    try:
+        yield tracer
+    finally:
+        current_tracer['tracer'] = None
+
+
+@contextmanager
+def span(stage):
+    """ A span of the current tracer, or nothing if no tracer is active. """
+    tracer = current_tracer['tracer']
+    if tracer is None:
+        yield None
+        return
+    with tracer.span(stage):
+        yield tracer
+
+
+def count(counter, n=1):
+    """ Adds n to a counter of the current span, if any. """
+    tracer = current_tracer['tracer']
+    if tracer is not None:
+        tracer.count(counter, n)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_db_round_trip(conn, cursor, statement, parameters, context, executemany):
+    count('db_round_trips')
@@ -1,9 +1,9 @@
 import asyncio
 from typing import Any, Dict, Optional
 
-from shazamio import Shazam
 from web.controller.track import get_track_by_shazam_key
 from web.lib.av_apis.apple import add_apple_track_data_one
+from web.lib.av_apis.http_client import shazam_client
 from web.lib.av_apis.shazam import shazam_search_track, shazam_track_add_label
 from web.lib.av_apis.spotify import async_add_track_spotify_info
 from web.lib.format import prepare_track_for_insertion
@@ -74,7 +74,7 @@ async def add_tracks_from_title_artists(track_titles_artists: list,db):
           """Add tracks to the database from a list of title-artist strings.
           If the track is already in the database, it will not be added again"""
           semaphore = asyncio.Semaphore(50)  
-          shazam =Shazam()
+          shazam = shazam_client() # shares the loop's aiohttp session with the spotify and apple calls
             
           tasks = [get_track_info_from_title_artist(title, semaphore, shazam) for title in track_titles_artists]
           processed_tracks = await asyncio.gather(*tasks)
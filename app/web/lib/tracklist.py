@@ -0,0 +1,254 @@
+import asyncio
+import os
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+from sqlalchemy import func
+
+from web.lib.av_apis.http_client import run_async, shazam_client
+from web.lib.av_apis.shazam import PROXY_URL, shazam_search_track
+from web.lib.process_shazam_json import transform_track_data
+from web.lib.track_prompt import transform_track_data_from_shazam_search
+from web.model import Track
+
+import logging
+logger = logging.getLogger('root')
+
+# Tracks named by the uploader (chapter titles, timestamped tracklist in the description) resolved without listening to the audio.
+# A Shazam search hit is only trusted if its title and artist are this similar to the parsed ones (0 to 1).
+TRACKLIST_MIN_SIMILARITY = float(os.getenv('TRACKLIST_MIN_SIMILARITY', 0.8))
+TRACKLIST_MAX_CONCURRENT = int(os.getenv('TRACKLIST_MAX_CONCURRENT', 20))
+TRACKLIST_MIN_LINES = 5 # timestamped lines for a description to count as a tracklist
+GAP_MIN_S = 20 # shorter unnamed parts of a set are not listened to
+
+SEPARATOR = re.compile(r'\s+[-–—~|]\s+|\s*[–—]\s*')
+NUMBERING = re.compile(r'^\s*(?:#?\d{1,3}\s*[.):\]-]\s*|#\d{1,3}\s+)')
+TRAILING_LABEL = re.compile(r'\s*[\[{][^\]}]*[\]}]\s*$')
+FEATURING = re.compile(r'\s*[(\[]?\b(?:feat|ft|featuring)\b\.?.*$', re.IGNORECASE)
+PARENTHESES = re.compile(r'\([^)]*\)|\[[^\]]*\]')
+ARTISTS_SEPARATOR = re.compile(r'\s*(?:,|&|\band\b|\bx\b|\bvs\.?|\bfeat\.?|\bft\.?)\s*', re.IGNORECASE)
+UNKNOWN = {'id', 'unknown', '?', '??', '???', 'tba', 'untitled'}
+
+TIMESTAMP = r'(?:(\d{1,2}):)?(\d{1,2}):(\d{2})'
+# "00:00 Artist - Title", "[1:02:03] Artist - Title", "1. 12:34 - Artist - Title"
+LEADING_TIMESTAMP = re.compile(rf'^\s*(?:\d{{1,3}}[.)]\s+)?[\[(]?{TIMESTAMP}[\])]?\s*(?:[-–—:|.]\s*)?(.*)$')
+# "Artist - Title 12:34", "1. Artist - Title (1:02:03)"
+TRAILING_TIMESTAMP = re.compile(rf'^(.*?)\s*[-–—|@]?\s*[\[(]?{TIMESTAMP}[\])]?\s*$')
+
+ABOUT_KEYS = ('album', 'label', 'release_year', 'release_date') # missing from a search hit
+SONG_KEYS = ('key_track_shazam', 'key_track_apple', 'title', 'artist_name', 'album', 'label', 'release_year', 'release_date')
+
+
+def parse_artist_title(text):
+    """
+    "Artist - Title" (also –, —, ~, |, numbered or followed by a [label]) to (artist, title).
+    None if the text is not in that form, or if the track is an ID.
+    """
+    text = TRAILING_LABEL.sub('', NUMBERING.sub('', text or '')).strip().strip('"\'')
+    parts = SEPARATOR.split(text, maxsplit=1)
+    if len(parts) != 2:
+        return None
+    artist, title = (part.strip().strip('"\'') for part in parts)
+    if not artist or not title or normalize(artist) in UNKNOWN or normalize(title) in UNKNOWN:
+        return None
+    return artist, title
+
+
+def normalize(text):
+    """ Lowercase, no accents, no punctuation. """
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode()
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', text.lower()).split())
+
+
+def title_similarity(a, b):
+    """ 0 to 1, the featured artists and the (remix / edit) parts counted only if they are on both sides. """
+    full = SequenceMatcher(None, normalize(a), normalize(b)).ratio()
+    bare = SequenceMatcher(None, normalize(PARENTHESES.sub('', FEATURING.sub('', a))), normalize(PARENTHESES.sub('', FEATURING.sub('', b)))).ratio()
+    return max(full, bare)
+
+
+def artist_similarity(a, b):
+    """ 0 to 1, the whole credits or their main artists. """
+    main_a = ARTISTS_SEPARATOR.split(a, maxsplit=1)[0]
+    main_b = ARTISTS_SEPARATOR.split(b, maxsplit=1)[0]
+    return max(SequenceMatcher(None, normalize(a), normalize(b)).ratio(),
+               SequenceMatcher(None, normalize(main_a), normalize(main_b)).ratio())
+
+
+def is_confident_match(artist, title, track, min_similarity=TRACKLIST_MIN_SIMILARITY):
+    return bool(track and track.get('title') and track.get('artist_name')
+                and title_similarity(title, track['title']) >= min_similarity
+                and artist_similarity(artist, track['artist_name']) >= min_similarity)
+
+
+def song_from_track(track):
+    """ A catalogue Track as the track data of a segment (see process_shazam_json.transform_track_data). """
+    song = {key: getattr(track, key) for key in SONG_KEYS}
+    if song['release_date']:
+        song['release_date'] = song['release_date'].isoformat()
+    return song
+
+
+def resolve_from_catalogue(queries):
+    """
+    {i: (artist, title)} to {i: track data} for the tracks already in the catalogue, in one query.
+    """
+    titles = {normalize(title) for _artist, title in queries.values()}
+    lower_titles = {title.lower() for _artist, title in queries.values()}
+    candidates = {}
+    for track in Track.query.filter(func.lower(Track.title).in_(lower_titles), Track.key_track_shazam > 0):
+        if normalize(track.title) in titles:
+            candidates.setdefault(normalize(track.title), []).append(track)
+
+    resolved = {}
+    for i, (artist, title) in queries.items():
+        for track in candidates.get(normalize(title), []):
+            if artist_similarity(artist, track.artist_name or '') >= TRACKLIST_MIN_SIMILARITY:
+                resolved[i] = song_from_track(track)
+                break
+    return resolved
+
+
+async def add_track_about(track, semaphore, shazam, timeout_s=3):
+    """
+    The album, label and release of a search hit from its track_about, as a recognized segment has them
+    (the search only has the Apple product id as album). Left empty if the lookup fails.
+    """
+    about = None
+    async with semaphore:
+        try:
+            about = await asyncio.wait_for(shazam.track_about(track_id=track['key_track_shazam'], proxy=PROXY_URL), timeout=timeout_s)
+        except Exception as e:
+            logger.warning(f'No details for "{track["artist_name"]} - {track["title"]}": {e!r}')
+    details = transform_track_data(about) if about else {}
+    for key in ABOUT_KEYS:
+        track[key] = details.get(key)
+    return track
+
+
+async def search_tracks(queries, max_concurrent=TRACKLIST_MAX_CONCURRENT):
+    """ {i: (artist, title)} to {i: track data} for the Shazam search hits close enough to the query, with their details. """
+    semaphore = asyncio.Semaphore(max_concurrent)
+    shazam = shazam_client()
+
+    async def search(i, artist, title):
+        result = await shazam_search_track(f'{artist} {title}', semaphore, shazam=shazam)
+        track = transform_track_data_from_shazam_search(result) if result else None
+        if is_confident_match(artist, title, track):
+            return i, await add_track_about(track, semaphore, shazam)
+        logger.debug(f'No confident match for "{artist} - {title}": {track and (track.get("artist_name"), track.get("title"))}')
+        return i, None
+
+    results = await asyncio.gather(*[search(i, artist, title) for i, (artist, title) in queries.items()])
+    return {i: track for i, track in results if track}
+
+
+def resolve_tracks(queries):
+    """
+    {i: (artist, title)} to {i: track data} : the catalogue first, then Shazam search (concurrently) for the rest.
+    The ones missing from the result could not be resolved confidently.
+    """
+    resolved = resolve_from_catalogue(queries) if queries else {}
+    remaining = {i: query for i, query in queries.items() if i not in resolved}
+    if remaining:
+        resolved.update(run_async(search_tracks(remaining)))
+    logger.info(f'Resolved {len(resolved)}/{len(queries)} tracks from their titles')
+    return resolved
+
+
+def resolve_chapters(chapters):
+    """
+    Tracks of the chapters named "Artist - Title".
+
+    Returns:
+        dict: chapter index -> track data, for the chapters resolved confidently.
+    """
+    queries = {}
+    for i, chapter in enumerate(chapters):
+        parsed = parse_artist_title(chapter.get('title'))
+        if parsed:
+            queries[i] = parsed
+    return resolve_tracks(queries)
+
+
+def timestamp_s(hours, minutes, seconds):
+    return int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def parse_tracklist_line(line):
+    """ (start_s, text) of a timestamped line, None if the line has no timestamp at its start or its end. """
+    for pattern, text_group in ((LEADING_TIMESTAMP, 4), (TRAILING_TIMESTAMP, 1)):
+        match = pattern.match(line)
+        if match and match.group(text_group).strip():
+            offset = 1 if text_group == 4 else 2
+            return timestamp_s(*match.group(offset, offset + 1, offset + 2)), match.group(text_group).strip()
+    return None
+
+
+def parse_description_tracklist(description, duration_s):
+    """
+    The timestamped tracklist of a video description, one line per track.
+    Lines must come in time order within the video, the others are ignored (a "drop at 45:00" in the text...).
+
+    Returns:
+        list: {'start_time', 'end_time', 'query': (artist, title) or None if the line is not "Artist - Title"},
+            empty if the description has no tracklist.
+    """
+    entries = []
+    for line in (description or '').splitlines():
+        parsed = parse_tracklist_line(line)
+        if not parsed:
+            continue
+        start_s, text = parsed
+        if start_s >= duration_s or (entries and start_s <= entries[-1]['start_time']):
+            continue
+        entries.append({'start_time': start_s, 'query': parse_artist_title(text)})
+
+    if len(entries) < TRACKLIST_MIN_LINES:
+        return []
+    for entry, next_entry in zip(entries, entries[1:] + [{'start_time': duration_s}]):
+        entry['end_time'] = next_entry['start_time']
+    return entries
+
+
+def gap_pieces(start_s, end_s, segment_length_s):
+    """ An unnamed part of a set as segment_length_s pieces to recognize, the last one merged if too short. """
+    pieces = []
+    while end_s - start_s >= GAP_MIN_S:
+        piece_end = end_s if end_s - start_s < segment_length_s + GAP_MIN_S else start_s + segment_length_s
+        pieces.append((start_s, piece_end, None))
+        start_s = piece_end
+    return pieces
+
+
+def chapters_timeline(chapters):
+    """
+    The chapters as (start_s, end_s, track data or None if not resolved) and the number resolved from their titles.
+    An unresolved chapter is recognized as one segment, like without the fast path.
+    """
+    resolved = resolve_chapters(chapters)
+    timeline = [(chapter['start_time'], chapter['end_time'], resolved.get(i)) for i, chapter in enumerate(chapters)]
+    return timeline, len(resolved), len(chapters)
+
+
+def description_timeline(description, duration_s, segment_length_s):
+    """
+    The set as (start_s, end_s, track data or None) from the tracklist of its description : the tracks resolved
+    from their lines, and segment_length_s pieces for the rest (unresolved lines, before the first timestamp).
+
+    Returns:
+        tuple: (timeline, number of lines resolved, number of lines), an empty timeline if there is no tracklist.
+    """
+    entries = parse_description_tracklist(description, duration_s)
+    if not entries:
+        return [], 0, 0
+    resolved = resolve_tracks({i: entry['query'] for i, entry in enumerate(entries) if entry['query']})
+
+    timeline = gap_pieces(0, entries[0]['start_time'], segment_length_s)
+    for i, entry in enumerate(entries):
+        if i in resolved:
+            timeline.append((entry['start_time'], entry['end_time'], resolved[i]))
+        else:
+            timeline += gap_pieces(entry['start_time'], entry['end_time'], segment_length_s) or [(entry['start_time'], entry['end_time'], None)]
+    return timeline, len(resolved), len(entries)
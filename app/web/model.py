@@ -1,7 +1,7 @@
 #from boilersaas.routes import User
 from boilersaas.utils.db import db
 from datetime import datetime, timezone
-from sqlalchemy import DDL, Index, JSON,  Integer,SmallInteger, func
+from sqlalchemy import DDL, Index, JSON,  Integer,SmallInteger, func, inspect, select
 from sqlalchemy.event import listens_for
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy_utils.types import TSVectorType
@@ -170,6 +170,93 @@ class SetQueue(db.Model):
     play_sound = db.Column(db.Boolean, default=False, index=True)
     notification_email_sent = db.Column(db.Boolean, default=False, index=True)
     notification_sound_sent = db.Column(db.Boolean, default=False, index=True)
+    identification = db.relationship(
+        'SetIdentification',
+        primaryjoin='SetQueue.video_id == foreign(SetIdentification.video_id)',
+        uselist=False,
+        viewonly=True,
+    )
+
+
+class YoutubeExtraction(db.Model):
+    # The yt-dlp extraction made when queueing a set (audio formats and their expiry, see youtube.audio_extraction),
+    # reused by the download while its urls are valid. Kept out of video_info_json, which the queue pages load.
+    __tablename__ = 'youtube_extractions'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    video_id = db.Column(db.String(255), nullable=False, unique=True, index=True)  # SetQueue.video_id
+    extracted_at = db.Column(db.DateTime(timezone=True), nullable=False, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
+    expires_at = db.Column(db.DateTime(timezone=True), index=True)
+    info = db.Column(db.JSON, nullable=False)
+
+
+class SetIdentification(db.Model):
+    # Identification yield of the last insert_set run of a queued set, and why it stopped early if it did.
+    # A table of its own rather than columns of set_queue, see the early abort in web/controller/set_process.py
+    __tablename__ = 'set_identifications'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    video_id = db.Column(db.String(255), nullable=False, unique=True, index=True)  # SetQueue.video_id
+    checked_at = db.Column(db.DateTime(timezone=True), nullable=False, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
+    stage = db.Column(db.String(16), nullable=False)  # sample or download
+    expected_segments = db.Column(db.Integer, nullable=False)
+    recognized_segments = db.Column(db.Integer, nullable=False)
+    identified_segments = db.Column(db.Integer, nullable=False)
+    unique_tracks = db.Column(db.Integer, nullable=False)
+    estimated_tracks = db.Column(db.Float, nullable=False)
+    aborted = db.Column(db.Boolean, nullable=False, default=False, index=True)
+    abort_reason = db.Column(db.String(255))
+    audio_downloaded_s = db.Column(db.Float)  # seconds of audio fetched before the decision
+
+
+class SetSegmentClassification(db.Model):
+    # Segments of the last insert_set run of a set not sent to Shazam, classified as not music (web/lib/music_detector.py)
+    __tablename__ = 'set_segment_classifications'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    video_id = db.Column(db.String(255), nullable=False, unique=True, index=True)  # SetQueue.video_id
+    checked_at = db.Column(db.DateTime(timezone=True), nullable=False, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
+    segments = db.Column(db.Integer, nullable=False)  # in the results log
+    skipped_segments = db.Column(db.Integer, nullable=False)  # Shazam calls saved
+    threshold = db.Column(db.Float, nullable=False)  # NON_MUSIC_THRESHOLD of the run
+
+
+class SetProcessSpan(db.Model):
+    # One row per stage of an insert_set run, see web/lib/spans.py
+    __tablename__ = 'set_process_spans'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    video_id = db.Column(db.String(255), nullable=False, index=True)  # SetQueue.video_id
+    run_started_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+    stage = db.Column(db.String(32), nullable=False)
+    status = db.Column(db.String(8), nullable=False)  # ok or error
+    wall_s = db.Column(db.Float, nullable=False)
+    cpu_s = db.Column(db.Float, nullable=False)
+    peak_rss_mb = db.Column(db.Float)
+    bytes_downloaded = db.Column(db.BigInteger, default=0, nullable=False)
+    external_calls = db.Column(db.Integer, default=0, nullable=False)
+    db_round_trips = db.Column(db.Integer, default=0, nullable=False)
+
+
+class RelatedTracksQueue(db.Model):
+    # user-triggered related tracks fetches, processed by cron_related_tracks_queue.py. One row per track.
+    __tablename__ = 'related_tracks_queue'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    track_id = db.Column(db.Integer, db.ForeignKey('tracks.id'), nullable=False, unique=True, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    status = db.Column(ENUM('pending', 'processing', 'done', 'failed', name='related_tracks_status_enum'), nullable=False, default='pending', index=True)
+    queued_at = db.Column(db.DateTime(timezone=True), nullable=False, default=db.func.current_timestamp())
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
+    n_attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+
+
+class SetStats(db.Model):
+    # Materialized set statistics, computed on publish and refreshed when their tracks change (stale flag)
+    __tablename__ = 'set_stats'
+    set_id = db.Column(db.Integer, db.ForeignKey('sets.id'), primary_key=True)
+    nb_tracks = db.Column(db.Integer, default=0, nullable=False)  # known tracks, with repeats
+    genres = db.Column(db.JSON)  # [{'name': ..., 'percentage': ...}], by occurrence
+    avg_release_year = db.Column(SmallInteger)
+    avg_artist_popularity_spotify = db.Column(SmallInteger)
+    stale = db.Column(db.Boolean, default=False, nullable=False, index=True)
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
 
 
 class TrackSet(db.Model):
@@ -183,6 +270,54 @@ class TrackSet(db.Model):
     set = db.relationship('Set', backref='track_sets')  
         
 
+class SyncIdMap(db.Model):
+    # On the remote database : source id -> remote id, for the rows whose ids differ between the two (tracks)
+    __tablename__ = 'sync_id_map'
+    entity = db.Column(db.String(32), primary_key=True)
+    source_id = db.Column(db.Integer, primary_key=True)
+    target_id = db.Column(db.Integer, nullable=False)
+
+
+class ChangeLog(db.Model):
+    # Append only, written by the log_change() triggers. Compact : which row changed, not what it became
+    __tablename__ = 'change_log'
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
+    table_name = db.Column(db.String(32), nullable=False)
+    op = db.Column(db.String(1), nullable=False)  # I, U or D
+    row_id = db.Column(db.Integer, nullable=False)  # id, set_id for track_sets, track_id for track_genres
+    data = db.Column(db.JSON)  # the rest of the primary key, for track_sets and track_genres
+    changed_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=func.now())
+    # consumers read by (txid, id) and only below the oldest running transaction, ids alone can commit out of order
+    txid = db.Column(db.BigInteger, nullable=False, server_default=func.txid_current())
+
+    __table_args__ = (
+        Index('ix_change_log_txid_id', 'txid', 'id'),
+    )
+
+
+class ChangeLogCursor(db.Model):
+    # Last change_log (txid, id) applied by each consumer
+    __tablename__ = 'change_log_cursor'
+    consumer = db.Column(db.String(64), primary_key=True)
+    last_txid = db.Column(db.BigInteger, nullable=False, default=0)
+    last_id = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
+
+
+class QueryProfile(db.Model):
+    # Sampled per request SQL profiles, see web/lib/query_profiler.py
+    __tablename__ = 'query_profiles'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=func.now(), index=True)
+    endpoint = db.Column(db.String(255), nullable=False, index=True)
+    path = db.Column(db.String(255))
+    status = db.Column(db.SmallInteger)
+    query_count = db.Column(db.Integer, nullable=False)
+    db_time_ms = db.Column(db.Float, nullable=False)
+    total_time_ms = db.Column(db.Float, nullable=False)
+    n_plus_one = db.Column(db.JSON)  # [{'shape', 'count', 'db_time_ms', 'call_site'}]
+
+
 class AppConfig(db.Model):
     __tablename__ = 'app_config'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -201,6 +336,62 @@ def receive_after_remove(target, value, initiator):
     genre = value  # Here, value is the Genre instance being removed from the Track
     genre.track_count -= 1
     
+def mark_set_stats_stale(connection, set_ids):
+    connection.execute(SetStats.__table__.update().where(SetStats.set_id.in_(set_ids)).values(stale=True))
+
+
+@listens_for(TrackSet, 'after_insert')
+@listens_for(TrackSet, 'after_delete')
+def track_set_changed(mapper, connection, target):
+    mark_set_stats_stale(connection, [target.set_id])
+
+
+@listens_for(Track, 'after_update')
+def track_stats_changed(mapper, connection, target):
+    # nb_sets is updated on every publish, only the properties used by SetStats invalidate it
+    state = inspect(target)
+    if any(state.attrs[key].history.has_changes() for key in ('genres', 'release_year', 'artist_popularity_spotify')):
+        mark_set_stats_stale(connection, select(TrackSet.set_id).where(TrackSet.track_id == target.id))
+
+
+CHANGE_LOG_TABLES = ('tracks', 'sets', 'track_sets', 'track_genres', 'channel', 'genres')
+
+# Triggers rather than ORM events, so that bulk core statements (replication, backfills) are logged too
+log_change_function = DDL("""
+CREATE OR REPLACE FUNCTION log_change() RETURNS trigger AS $$
+DECLARE
+    r RECORD;
+BEGIN
+    IF TG_OP = 'DELETE' THEN r := OLD; ELSE r := NEW; END IF;
+    IF TG_TABLE_NAME = 'track_sets' THEN
+        INSERT INTO change_log (table_name, op, row_id, data) VALUES (TG_TABLE_NAME, left(TG_OP, 1), r.set_id, json_build_object('track_id', r.track_id, 'pos', r.pos));
+    ELSIF TG_TABLE_NAME = 'track_genres' THEN
+        INSERT INTO change_log (table_name, op, row_id, data) VALUES (TG_TABLE_NAME, left(TG_OP, 1), r.track_id, json_build_object('genre_id', r.genre_id));
+    ELSE
+        INSERT INTO change_log (table_name, op, row_id) VALUES (TG_TABLE_NAME, left(TG_OP, 1), r.id);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+""")
+
+@listens_for(db.metadata, 'after_create')
+def create_change_log_triggers(target, connection, **kw):
+    # after the whole create_all, the change_log table can be created before the tables it watches
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(log_change_function)
+    for table_name in CHANGE_LOG_TABLES:
+        connection.execute(DDL(f"""
+            DO $$ BEGIN
+                IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = '{table_name}_change_log') THEN
+                    CREATE TRIGGER {table_name}_change_log AFTER INSERT OR UPDATE OR DELETE ON {table_name}
+                    FOR EACH ROW EXECUTE FUNCTION log_change();
+                END IF;
+            END $$
+        """))
+
+
 # Event listener for updating search_vector
 @listens_for(Track, 'before_insert')
 @listens_for(Track, 'before_update')
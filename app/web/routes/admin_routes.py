@@ -1,9 +1,10 @@
 from flask import Blueprint, flash, redirect, render_template, request, url_for
 from web.controller.channel import channel_toggle_followable, channel_toggle_visibility, get_channels_with_feat
-from web.controller.set_queue import queue_discard_set, queue_reset_set
+from web.controller.set_queue import get_set_process_stage_summary, queue_discard_set, queue_reset_set
 from web.controller.set import get_hidden_sets, set_toggle_visibility
 from lang import Lang
 from web.controller.utils import get_set_searches, search_toggle_featured
+from web.lib.query_profiler import get_query_profiles_report
 from web.model import SetQueue
 from web.routes.routes_utils import is_admin
 from web.routes.routes_utils import tpl_utils
@@ -69,11 +70,14 @@ def admin():
         flash('You are not an admin', 'error')
         return redirect(url_for('set.sets'))
     
+    days = request.args.get('days', 7, type=int)
+    stage_summary = get_set_process_stage_summary(days)
+    
     l = {
         'page_title': Lang.ADMIN + ' - ' + 'Dashboard', 
     }
     
-    return render_template('admin/index.html',tpl_utils=tpl_utils,l=l)
+    return render_template('admin/index.html',stage_summary=stage_summary,days=days,tpl_utils=tpl_utils,l=l)
     
     
 @admin_bp.route('/admin/hidden_sets')
@@ -91,6 +95,22 @@ def hidden_sets():
     return render_template('admin/hidden_sets.html', sets=sets,tpl_utils=tpl_utils,l=l)
 
 
+@admin_bp.route('/admin/queries')
+def queries():
+    if not is_admin():
+        flash('You are not an admin', 'error')      
+        return redirect(url_for('set.sets'))
+    
+    days = request.args.get('days', 7, type=int)
+    report = get_query_profiles_report(days)
+    
+    l = {
+        'page_title': Lang.ADMIN + ' - ' + 'Queries', 
+    }
+    
+    return render_template('admin/queries.html', report=report,days=days,tpl_utils=tpl_utils,l=l)
+
+
 @admin_bp.route('/admin/channels',methods=['GET'])
 def channels():
     if not is_admin():
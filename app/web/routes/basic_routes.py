@@ -5,6 +5,7 @@ from flask import Blueprint, redirect, render_template, request, send_from_direc
 from flask_login import current_user
 from markdown import markdown
 from web.controller.set import get_playable_sets, get_playable_sets_number
+from web.lib.metrics import CONTENT_TYPE, generate_metrics, metrics_authorized
 from lang import Lang
 
 def load_markdown_file(file_path):
@@ -19,6 +20,13 @@ def health():
     return "OK", 200
 
 
+@basic_bp.route('/metrics', methods=['GET'])
+def metrics():
+    if not metrics_authorized():
+        return "Unauthorized", 401
+    return Response(generate_metrics(), mimetype=CONTENT_TYPE)
+
+
 
 @basic_bp.route('/')
 def index():
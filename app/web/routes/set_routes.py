@@ -10,7 +10,7 @@ from web.controller.track import get_track_by_id
 from web.controller.channel import get_channel_by_id
 from web.controller.set import get_all_featured_set_searches, get_set_id_by_video_id,get_set_queue_status,is_set_in_queue,is_set_exists,count_sets_with_all_statuses, get_my_sets_in_queue_not_notified, get_playable_sets, get_playable_sets_number, get_set_status, get_set_with_tracks, get_sets_in_queue, get_sets_with_zero_track
 from web.lib.format import format_db_track_for_template, format_db_tracks_for_template, format_set_queue_error
-from web.lib.related_tracks import save_related_tracks
+from web.controller.related_tracks_queue import get_related_tracks_job, queue_related_tracks
 from web.lib.utils import discarded_reason_to_ux
 from web.lib.av_apis.youtube import youtube_video_id_from_url, youtube_video_input_is_valid
 from web.model import SetQueue
@@ -473,17 +473,33 @@ def jax_check_save_related_tracks(track_id):
     if has_related_tracks and len(track.related_tracks) > 0:
         return jsonify({'message': f"Related tracks already saved this track"}), 200
     
-    if has_related_tracks and len(track.related_tracks) == 0:
-        return jsonify({'error': f"No related tracks found for this track"}), 500
+    if track.related_tracks_checked and not has_related_tracks:
+        return jsonify({'error': f"No related tracks found for this track"}), 409
     
-    try:    
-        ret = save_related_tracks(track)
-       
-        
-        if 'error' in ret:
-            # flash(ret['error'], 'error')
-            return jsonify({'error':f"{ret['error']}"}), 409
-        
-        return jsonify(ret),200
-    except Exception as e:
-        return jsonify({'error':f"Error saving related tracks: {e}"}), 500
\ No newline at end of file
+    # Fetched by cron_related_tracks_queue.py, the page polls the job status
+    job = queue_related_tracks(track.id, get_user_id())
+    return jsonify(related_tracks_job_response(job)), 202
+
+
+def related_tracks_job_response(job):
+    return {
+        'message': 'Fetching related tracks...',
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('set.jax_related_tracks_job_status', job_id=job.id)
+    }
+
+
+@set_bp.route('/jax/related_tracks_job/<int:job_id>', methods=['GET'])
+def jax_related_tracks_job_status(job_id):
+    job = get_related_tracks_job(job_id)
+    if not job:
+        return jsonify({'error': f"Job not found."}), 404
+
+    if job.status == 'failed':
+        return jsonify({'error': job.error or 'Error saving related tracks', 'status': job.status}), 409
+
+    if job.status == 'done':
+        return jsonify({'message': 'Related tracks saved', 'status': job.status}), 200
+
+    return jsonify(related_tracks_job_response(job)), 202